@@ -0,0 +1,79 @@
+"""Compares compression codecs for cache records.
+
+Packs a page of N synthetic CDMS-shaped contact records with each codec and
+level, reporting the bytes stored per page, the CPU time taken to pack it,
+and the CPU time and peak memory taken to unpack it from bytes and to read
+it from a file object (decompressing it as it is read).
+
+Usage:
+
+    python -m benchmarks.cache_compression [-n 5000] [-r 5]
+"""
+import argparse
+import io
+import json
+import sys
+import time
+import tracemalloc
+
+from benchmarks.json_decoding import make_page
+from scraper import record
+
+LEVELS = {
+    None: [None],
+    'zlib': [1, 6, 9],
+    'gzip': [1, 6, 9],
+    'zstd': [1, 3, 9, 19],
+}
+
+
+def cpu_ms(func, repeat):
+    """Returns the mean CPU time in milliseconds taken to call `func`."""
+    start = time.process_time()
+    for _ in range(repeat):
+        func()
+    return round((time.process_time() - start) / repeat * 1000, 1)
+
+
+def peak_bytes(func):
+    """Returns the peak memory allocated while calling `func`."""
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main(argv=None):
+    """Runs the benchmark and writes the results as JSON lines to stdout."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=5000, help='number of records per page')
+    parser.add_argument('-r', type=int, default=5, help='number of times to pack and unpack the page')
+    args = parser.parse_args(argv)
+    metadata = {'url': 'https://cdms.example.com/ContactSet', 'status': 200, 'timestamp': time.time()}
+    parts = {
+        'request_headers': b'Accept: application/json',
+        'response_headers': b'Content-Type: application/json; charset=utf-8',
+        'response_body': make_page(args.n),
+    }
+
+    for codec, levels in LEVELS.items():
+        if codec == 'zstd' and record.zstd is None:
+            continue
+        for level in levels:
+            data = record.pack(metadata, parts, compress=codec, level=level)
+            sys.stdout.write(json.dumps({
+                'codec': codec or 'none',
+                'level': level,
+                'body_bytes': len(parts['response_body']),
+                'record_bytes': len(data),
+                'pack_cpu_ms': cpu_ms(lambda: record.pack(metadata, parts, compress=codec, level=level), args.r),
+                'unpack_cpu_ms': cpu_ms(lambda: record.unpack(data), args.r),
+                'read_cpu_ms': cpu_ms(lambda: record.read(io.BytesIO(data)), args.r),
+                'unpack_peak_bytes': peak_bytes(lambda: record.unpack(data)),
+                'read_peak_bytes': peak_bytes(lambda: record.read(io.BytesIO(data))),
+            }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Compares the legacy and packed S3 cache layouts.
+
+Stores and then retrieves N synthetic OData responses against an in-memory
+bucket, reporting S3 calls and wall time per 10k responses.  The wall time
+excludes network latency; `--rtt-ms` is used to estimate the time spent
+waiting on S3 for a given round trip time.
+
+Usage:
+
+    python -m benchmarks.cache_format [-n 10000] [--rtt-ms 20]
+"""
+import argparse
+import functools
+import json
+import pickle
+import sys
+import time
+
+import scrapy
+from w3lib.http import headers_dict_to_raw
+
+from benchmarks.s3 import FakeBucket
+from scraper import storage
+
+SETTINGS = {
+    'S3CACHE_BUCKET': 'benchmark',
+    'AWS_REGION': 'eu-west-1',
+}
+
+
+def make_pairs(count, records_per_page=50):
+    """Yields synthetic (request, response) pairs shaped like CDMS pages."""
+    base = 'https://cdms.example.com/XRMServices/2011/OrganizationData.svc/ContactSet'
+    for page in range(count):
+        results = [
+            {
+                '__metadata': {
+                    'uri': "{}(guid'{:08d}-{:04d}')".format(base, page, i),
+                    'type': 'Microsoft.Crm.Sdk.Data.Services.Contact'},
+                'FirstName': 'First {}'.format(i),
+                'LastName': 'Last {}'.format(page),
+                'EMailAddress1': 'person{}@example.com'.format(i),
+            }
+            for i in range(records_per_page)]
+        body = json.dumps({'d': {'results': results, '__next': base}}).encode('utf-8')
+        url = '{}?$skiptoken={}'.format(base, page)
+        request = scrapy.Request(url, headers={'Accept': 'application/json'})
+        response = scrapy.http.TextResponse(
+            url, body=body, headers={'Content-Type': 'application/json'})
+        yield request, response
+
+
+def store_legacy(bucket, request, response):
+    """Stores a response using the legacy one-object-per-part layout."""
+    path = functools.partial(storage._storage_path, request)
+    metadata = {
+        'url': request.url,
+        'method': request.method,
+        'status': response.status,
+        'response_url': response.url,
+        'timestamp': time.time(),
+    }
+    pairs = (
+        ('meta', repr(metadata).encode('utf8')),
+        ('pickled_meta', pickle.dumps(metadata, protocol=2)),
+        ('request_headers', headers_dict_to_raw(request.headers)),
+        ('request_body', request.body),
+        ('response_headers', headers_dict_to_raw(response.headers)),
+        ('response_body', response.body),
+    )
+    for key, body in pairs:
+        storage._send_s3_text(bucket, path(key), body)
+
+
+def run(name, pairs, store, retrieve, bucket, rtt):
+    """Times storing and retrieving every pair, returning a result row."""
+    row = {'layout': name}
+    for phase, func in (('store', store), ('retrieve', retrieve)):
+        bucket.reset_calls()
+        start = time.perf_counter()
+        for request, response in pairs:
+            func(request, response)
+        elapsed = time.perf_counter() - start
+        scale = 10000 / len(pairs)
+        calls = bucket.total_calls() * scale
+        row[phase] = {
+            'calls_per_10k': round(calls),
+            'wall_seconds_per_10k': round(elapsed * scale, 2),
+            'estimated_seconds_per_10k': round(elapsed * scale + calls * rtt, 2),
+        }
+    return row
+
+
+def main(argv=None):
+    """Runs the benchmark and writes the results as JSON lines to stdout."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=10000, help='number of responses')
+    parser.add_argument('--rtt-ms', type=float, default=20.0,
+                        help='S3 round trip time used for the estimate')
+    args = parser.parse_args(argv)
+    pairs = list(make_pairs(args.n))
+    rtt = args.rtt_ms / 1000
+
+    cache = storage.S3CacheStorage(SETTINGS)
+    rows = []
+
+    cache.bucket = FakeBucket()
+    rows.append(run(
+        'legacy', pairs,
+        functools.partial(store_legacy, cache.bucket),
+        lambda request, _: cache.retrieve_response(None, request),
+        cache.bucket, rtt))
+
+    for compress in (False, True):
+        cache.compress = compress
+        cache.bucket = FakeBucket()
+        rows.append(run(
+            'packed-zlib' if compress else 'packed', pairs,
+            lambda request, response: cache.store_response(None, request, response),
+            lambda request, _: cache.retrieve_response(None, request),
+            cache.bucket, rtt))
+
+    for row in rows:
+        sys.stdout.write(json.dumps(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compares the JSON lines and columnar export formats.
+
+Writes N synthetic CDMS-shaped contact records in each format, and reports
+file size and the time taken to write and load them.
+
+Usage:
+
+    python -m benchmarks.export_format [-n 100000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from scraper import collect, columnar
+
+BASE = "https://cdms.example.com/XRMServices/2011/OrganizationData.svc"
+
+
+def _reference(logical_name, rng):
+    return {
+        '__metadata': {'type': 'Microsoft.Crm.Sdk.Data.Services.EntityReference'},
+        'Id': '{:08x}-0000-0000-0000-{:012x}'.format(rng.getrandbits(32), rng.getrandbits(48)),
+        'LogicalName': logical_name,
+        'Name': rng.choice(['Alice Smith', 'Bob Jones', None]),
+    }
+
+
+def make_records(count, seed=0):
+    """Yields synthetic records shaped like CDMS contacts."""
+    rng = random.Random(seed)
+    for i in range(count):
+        contact_id = '{:08x}-0000-0000-0000-{:012x}'.format(i, rng.getrandbits(48))
+        record = {
+            '__metadata': {
+                'uri': "{}/ContactSet(guid'{}')".format(BASE, contact_id),
+                'type': 'Microsoft.Crm.Sdk.Data.Services.Contact'},
+            'ContactId': contact_id,
+            'FirstName': rng.choice(['Alice', 'Bob', 'Carol', 'Dave', 'Eve']),
+            'LastName': rng.choice(['Smith', 'Jones', 'Taylor', 'Brown']),
+            'EMailAddress1': 'person{}@example.com'.format(i),
+            'Telephone1': '0{:010d}'.format(rng.getrandbits(32)),
+            'JobTitle': rng.choice(['Director', 'Manager', None]),
+            'CreatedOn': '/Date({})/'.format(1400000000000 + rng.getrandbits(32)),
+            'ModifiedOn': '/Date({})/'.format(1400000000000 + rng.getrandbits(32)),
+            'StateCode': {'__metadata': {'type': 'Microsoft.Crm.Sdk.Data.Services.OptionSetValue'},
+                          'Value': rng.choice([0, 1])},
+            'ParentCustomerId': _reference('account', rng),
+            'OwnerId': _reference('systemuser', rng),
+            'DoNotEMail': rng.choice([True, False]),
+            'contact_customer_accounts': {'__deferred': {
+                'uri': "{}/ContactSet(guid'{}')/contact_customer_accounts".format(BASE, contact_id)}},
+        }
+        for j in range(20):
+            record['optevia_Field{}'.format(j)] = rng.choice([None, None, 'value {}'.format(j), j])
+        yield record
+
+
+def write(records, directory, output_format):
+    """Writes records in a format, returning (path, seconds)."""
+    extension, writer_class, encode = collect.formats[output_format]
+    path = os.path.join(directory, 'Contact' + extension)
+    start = time.perf_counter()
+    writer = writer_class(path)
+    for record in records:
+        writer.write(encode(record))
+    writer.close()
+    return path, time.perf_counter() - start
+
+
+def timed(func):
+    """Returns the time taken to call `func`."""
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    """Runs the benchmark and writes the results as JSON lines to stdout."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=100000, help='number of records')
+    args = parser.parse_args(argv)
+    records = list(make_records(args.n))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path, write_seconds = write(records, directory, 'jsonlines')
+
+        def load_jsonlines():
+            with open(path) as f:
+                return [json.loads(line) for line in f]
+
+        def load_jsonlines_columns():
+            with open(path) as f:
+                return [(r['ContactId'], r['ModifiedOn']) for r in map(json.loads, f)]
+
+        rows = [{
+            'format': 'jsonlines',
+            'bytes': os.path.getsize(path),
+            'write_seconds': round(write_seconds, 2),
+            'load_seconds': round(timed(load_jsonlines), 2),
+            'load_2_columns_seconds': round(timed(load_jsonlines_columns), 2),
+        }]
+
+        path, write_seconds = write(records, directory, 'columnar')
+        rows.append({
+            'format': 'columnar',
+            'bytes': os.path.getsize(path),
+            'write_seconds': round(write_seconds, 2),
+            'load_seconds': round(timed(lambda: list(columnar.read(path))), 2),
+            'load_2_columns_seconds': round(timed(
+                lambda: list(columnar.read_columns(path, ['ContactId', 'ModifiedOn']))), 2),
+        })
+
+    for row in rows:
+        sys.stdout.write(json.dumps(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
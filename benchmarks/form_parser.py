@@ -0,0 +1,62 @@
+"""Compares extracting login forms by scanning tags and with PyQuery.
+
+Parses each ADFS fixture page N times with each parser, reporting the time
+per page, plus the time taken to import PyQuery (which the scanner avoids).
+
+Usage:
+
+    python -m benchmarks.form_parser [-n 1000]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from scraper import forms
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'scraper', 'tests', 'fixtures')
+PAGES = ('adfs_login.html', 'adfs_token.html')
+
+
+def time_parser(parse, source, count):
+    """Returns the mean time in microseconds to parse a page."""
+    start = time.perf_counter()
+    for _ in range(count):
+        parse(source)
+    return round((time.perf_counter() - start) / count * 1e6, 1)
+
+
+def import_seconds(module):
+    """Returns the time taken to import a module in a fresh interpreter."""
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)])
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    """Runs the benchmark and writes the results as JSON lines to stdout."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=1000, help='number of times to parse each page')
+    args = parser.parse_args(argv)
+
+    for name in PAGES:
+        with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+            source = f.read()
+        sys.stdout.write(json.dumps({
+            'page': name,
+            'bytes': len(source),
+            'scanner_us': time_parser(forms.parse_form, source, args.n),
+            'pyquery_us': time_parser(forms.parse_form_pyquery, source, args.n),
+        }) + '\n')
+
+    baseline = import_seconds('sys')
+    sys.stdout.write(json.dumps({
+        'import_pyquery_ms': round((import_seconds('pyquery') - baseline) * 1000),
+        'import_scanner_ms': round((import_seconds('scraper.forms') - baseline) * 1000),
+    }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Compares ways of decoding pages of OData entities.
+
+Builds a page of N synthetic CDMS-shaped contact records (as the service
+encodes it, with escaped slashes and a `__next` link), then reports the
+time per page taken to decode it as the spider used to (decoding the bytes
+to text, then parsing them with the standard library), to decode it with
+`scraper.decoding.loads` (using orjson, if installed, and the standard
+library otherwise), and to extract just its `__next` link.
+
+Usage:
+
+    python -m benchmarks.json_decoding [-n 5000] [-r 20]
+"""
+import argparse
+import json
+import sys
+import time
+from unittest.mock import patch
+
+from benchmarks.export_format import BASE, make_records
+from scraper import decoding
+
+
+def make_page(count):
+    """Returns the body of a page of synthetic contact records."""
+    data = {'d': {
+        'results': list(make_records(count)),
+        '__next': "{}/ContactSet?$skiptoken=5000,guid'{{00000000-0000-0000-0000-000000000000}}'".format(BASE),
+    }}
+    return json.dumps(data).replace('/', '\\/').encode('utf-8')
+
+
+def time_decoder(decode, body, repeat):
+    """Returns the mean time in milliseconds to decode a page."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        decode(body)
+    return round((time.perf_counter() - start) / repeat * 1000, 3)
+
+
+def main(argv=None):
+    """Runs the benchmark and writes the results as JSON lines to stdout."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=5000, help='number of records per page')
+    parser.add_argument('-r', type=int, default=20, help='number of times to decode the page')
+    args = parser.parse_args(argv)
+    body = make_page(args.n)
+
+    def stdlib_loads(body):
+        with patch.object(decoding, 'orjson', None):
+            return decoding.loads(body)
+
+    decoders = [
+        ('json.loads(body.decode())', lambda body: json.loads(body.decode('utf-8'))),
+        ('decoding.loads (json)', stdlib_loads),
+        ('decoding.loads ({})'.format(decoding.DECODER), decoding.loads),
+        ('decoding.next_link', decoding.next_link),
+    ]
+    for name, decode in decoders:
+        sys.stdout.write(json.dumps({
+            'decoder': name,
+            'records': args.n,
+            'bytes': len(body),
+            'ms_per_page': time_decoder(decode, body, args.r),
+        }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
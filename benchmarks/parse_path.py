@@ -0,0 +1,77 @@
+"""Measures the parse path of a crawl replayed from the cache.
+
+Packs a page of N synthetic CDMS-shaped contact records as a cache record
+(compressed as the cache compresses it by default), then reports the time
+per page taken to read the record back and to process the response with
+`OdataSpider.parse_itempage`, with and without items being emitted.  This
+is the work done for each page when replaying a crawl with `CACHE_REPLAY`,
+apart from fetching records from the cache.
+
+Usage:
+
+    python -m benchmarks.parse_path [-n 5000] [-r 20] [--compress gzip]
+"""
+import argparse
+import io
+import json
+import sys
+import time
+
+import scrapy
+from scrapy.http import TextResponse
+from scrapy.settings import Settings
+
+from benchmarks.json_decoding import make_page
+from scraper import record
+from scraper.spiders import odata
+
+URL = 'https://cdms.example.com/XRMServices/2011/OrganizationData.svc/ContactSet'
+
+
+def time_per_page(func, repeat):
+    """Returns the mean time in milliseconds taken to call `func`."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return round((time.perf_counter() - start) / repeat * 1000, 3)
+
+
+def main(argv=None):
+    """Runs the benchmark and writes the results as JSON lines to stdout."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=5000, help='number of records per page')
+    parser.add_argument('-r', type=int, default=20, help='number of times to process the page')
+    parser.add_argument('--compress', default='gzip', help='codec the record is compressed with')
+    args = parser.parse_args(argv)
+    body = make_page(args.n)
+    data = record.pack({'url': URL, 'status': 200}, {'response_body': body}, compress=args.compress)
+    request = scrapy.Request(URL, meta={'entity_set': 'ContactSet'})
+
+    def read():
+        return record.read(io.BytesIO(data))[1]['response_body']
+
+    for emit_items in (False, True):
+        spider = odata.OdataSpider()
+        spider.settings = Settings({'EMIT_ITEMS': emit_items})
+
+        def parse():
+            response = TextResponse(URL, body=read(), encoding='utf-8', request=request)
+            return list(spider.parse_itempage(response))
+
+        outputs = parse()
+        read_ms = time_per_page(read, args.r)
+        total_ms = time_per_page(parse, args.r)
+        sys.stdout.write(json.dumps({
+            'emit_items': emit_items,
+            'codec': args.compress,
+            'records': args.n,
+            'items': len(outputs) - 1,
+            'record_bytes': len(data),
+            'read_ms_per_page': read_ms,
+            'parse_ms_per_page': round(total_ms - read_ms, 3),
+            'pages_per_second': round(1000 / total_ms, 1),
+        }) + '\n')
+
+
+if __name__ == '__main__':
+    main()
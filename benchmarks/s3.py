@@ -0,0 +1,50 @@
+"""In-memory stand-in for an S3 bucket, used by the benchmarks."""
+import collections
+import time
+
+import botocore
+
+
+class FakeBucket:
+    """Mimics the parts of a boto3 `Bucket` used by the cache storage.
+
+    Every call is counted by operation name, and optionally delayed by `rtt`
+    seconds to approximate network latency.
+    """
+
+    def __init__(self, rtt=0.0):
+        """Initialises an empty bucket."""
+        self.objects = {}
+        self.calls = collections.Counter()
+        self.rtt = rtt
+
+    def _call(self, name):
+        self.calls[name] += 1
+        if self.rtt:
+            time.sleep(self.rtt)
+
+    def upload_fileobj(self, fileobj, key):
+        """Stores the contents of `fileobj` under `key`."""
+        self._call('PUT')
+        self.objects[key] = fileobj.read()
+
+    def download_fileobj(self, key, fileobj):
+        """Writes the object stored under `key` to `fileobj`."""
+        self._call('GET')
+        if key not in self.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        fileobj.write(self.objects[key])
+
+    def delete_objects(self, Delete):  # noqa: N803
+        """Deletes the given objects."""
+        self._call('DELETE')
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+
+    def reset_calls(self):
+        """Clears the call counters."""
+        self.calls.clear()
+
+    def total_calls(self):
+        """Returns the number of calls made since the last reset."""
+        return sum(self.calls.values())
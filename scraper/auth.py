@@ -1,8 +1,8 @@
 import logging
 
 import requests
-from pyquery import PyQuery
 
+from scraper.forms import parse_form
 
 logger = logging.getLogger('cmds_api')
 
@@ -36,9 +36,9 @@ def login(url, username, password, user_agent=None):
     resp = session.get(url)
     assert resp.ok
 
-    html_parser = PyQuery(resp.text)
-    username_field_name = html_parser('input[name*="Username"]').attr('name')
-    password_field_name = html_parser('input[name*="Password"]').attr('name')
+    form = parse_form(resp.text)
+    username_field_name = form.field_name('Username')
+    password_field_name = form.field_name('Password')
 
     # 2. submit the login form with username and password
     resp = _submit_form(
@@ -68,14 +68,11 @@ def _submit_form(session, source, url=None, params=None):
     validated by all of them.  For more details, check:
     https://msdn.microsoft.com/en-us/library/aa480563.aspx
     """
-    html_parser = PyQuery(source)
-    form_action = html_parser('form').attr('action')
+    form = parse_form(source)
+    form_action = form.action
 
     # get all inputs in the source + optional params passed in
-    data = {
-        field.get('name'): field.get('value')
-        for field in html_parser('input')
-    }
+    data = form.data()
     if params:
         data.update(params)
 
@@ -84,7 +81,6 @@ def _submit_form(session, source, url=None, params=None):
 
     assert resp.ok
 
-    html_parser = PyQuery(resp.content)
-    assert form_action != html_parser('form').attr('action')
+    assert form_action != parse_form(resp.content).action
 
     return resp
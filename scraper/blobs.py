@@ -0,0 +1,168 @@
+"""Content-addressed storage of response bodies in the S3 cache.
+
+Repeated crawls of unchanged pages store identical response bodies under
+different request fingerprints.  With `S3CACHE_DEDUP_BODIES` enabled, each
+distinct body is instead stored once, as a blob keyed by its SHA-256 digest
+(`BLOBS/<digest>`), and cache records hold no body, but are marked with
+`body_blob` in their metadata (alongside the body's `body_sha256`).  A blob
+is a packed record (see `scraper.record`) holding just the body, so blobs
+are compressed as records are.
+
+Blobs aren't deleted along with the records referencing them, so blobs no
+longer referenced by any record are removed by garbage collection, which
+reads the metadata of every record in the cache.  Blobs stored within the last `--min-age`
+hours are kept, as the records referencing them may not have been written
+yet.  Garbage collection should still be run between crawls, as a crawl
+doesn't upload bodies that it has already seen stored.  Records whose blobs
+have gone missing are treated as cache misses, so are fetched and stored
+again.
+
+Usage:
+
+    python -m scraper.blobs gc [--min-age 24] [--dry-run] [--threads 32]
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import logging
+import sys
+import time
+
+import botocore
+
+from scrapy.utils.project import get_project_settings
+
+from scraper import record, s3
+
+logger = logging.getLogger(__name__)
+
+blob_key_prefix = "BLOBS"
+cache_key_prefix = "CACHE"
+
+
+def blob_key(digest):
+    """Returns the key of the blob holding the body with a digest."""
+    return "{}/{}".format(blob_key_prefix, digest)
+
+
+def pack(body, compress=False, level=None):
+    """Packs a response body into a blob."""
+    return record.pack({}, {'response_body': body}, compress=compress, level=level)
+
+
+def unpack(data):
+    """Returns the response body held in a blob."""
+    return record.unpack(data)[1]['response_body']
+
+
+def referenced(metadata):
+    """Returns the digest of the blob a cache record references, or None."""
+    return metadata['body_sha256'] if metadata.get('body_blob') else None
+
+
+def split(metadata, parts):
+    """Returns a copy of a cache entry referencing its body by digest."""
+    body = parts['response_body']
+    metadata = dict(metadata, body_blob=True)
+    if 'body_sha256' not in metadata:
+        metadata['body_sha256'] = hashlib.sha256(body).hexdigest()
+    return metadata, dict(parts, response_body=b'')
+
+
+def join(metadata, parts, body):
+    """Returns a copy of a cache entry holding its (referenced) body."""
+    metadata = {key: value for key, value in metadata.items() if key != 'body_blob'}
+    return metadata, dict(parts, response_body=body)
+
+
+def get_record(bucket, key):
+    """Returns a packed record from S3, with its body in place.
+
+    Records referencing a blob that is missing are returned as they are.
+    """
+    data = s3.get_object(bucket, key)
+    if not record.is_record(data):
+        return data
+    metadata, parts = record.unpack(data)
+    digest = referenced(metadata)
+    if digest is None:
+        return data
+    try:
+        body = unpack(s3.get_object(bucket, blob_key(digest)))
+    except botocore.exceptions.ClientError as e:
+        if not s3.is_not_found(e):
+            raise
+        logger.warning('Missing response body %s for %s', digest, key)
+        return data
+    return record.pack(*join(metadata, parts, body))
+
+
+def gc(bucket, min_age=24 * 3600, dry_run=False, threads=32):
+    """Deletes blobs that aren't referenced by any cache record.
+
+    Blobs stored less than `min_age` seconds ago are kept.  Returns a dict
+    of the numbers of blobs found, referenced and deleted.
+    """
+    start = time.time()
+    cutoff = start - min_age
+    stored = {
+        obj['Key'].rsplit('/', 1)[-1]: obj['LastModified'].timestamp()
+        for obj in s3.list_objects(bucket, blob_key_prefix + '/')}
+    logger.info('Found %d blobs', len(stored))
+
+    in_use = set()
+    keys = (key for key in s3.list_keys(bucket, cache_key_prefix + '/')
+            if key.rsplit('/', 1)[-1] == record.filename)
+    num_records = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            chunk = list(itertools.islice(keys, threads * 4))
+            if not chunk:
+                break
+            for metadata in executor.map(lambda key: s3.get_metadata(bucket, key), chunk):
+                digest = referenced(metadata)
+                if digest is not None:
+                    in_use.add(digest)
+            num_records += len(chunk)
+            if num_records % 100000 < len(chunk):
+                logger.info('Read %d records, found %d referenced blobs', num_records, len(in_use))
+
+    unreferenced = [
+        digest for digest, stored_at in sorted(stored.items())
+        if digest not in in_use and stored_at < cutoff]
+    if not dry_run:
+        for i in range(0, len(unreferenced), 1000):
+            bucket.delete_objects(Delete={
+                'Objects': [{'Key': blob_key(digest)} for digest in unreferenced[i:i + 1000]]})
+    logger.info('%s %d unreferenced blobs in %.0fs', 'Found' if dry_run else 'Deleted',
+                len(unreferenced), time.time() - start)
+    return {
+        'blobs': len(stored),
+        'referenced': len(in_use & stored.keys()),
+        'deleted': 0 if dry_run else len(unreferenced),
+        'unreferenced': len(unreferenced),
+    }
+
+
+def main(argv=None):
+    """Garbage collects unreferenced blobs."""
+    parser = argparse.ArgumentParser(description='Manage deduplicated response bodies in the S3 cache.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    gc_parser = subparsers.add_parser('gc', help='delete blobs no longer referenced by the cache')
+    gc_parser.add_argument('--min-age', type=float, default=24,
+                           help='only delete blobs stored at least this many hours ago')
+    gc_parser.add_argument('--dry-run', action='store_true', help='report, but do not delete, unreferenced blobs')
+    gc_parser.add_argument('--threads', type=int, default=32, help='number of threads reading records')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    result = gc(s3.get_bucket(get_project_settings()), min_age=args.min_age * 3600,
+                dry_run=args.dry_run, threads=args.threads)
+    sys.stdout.write('{}\n'.format(json.dumps(result, sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,433 @@
+"""Exports the records held in the HTTP cache as JSON lines.
+
+One output file is written per entity type, e.g. `Contact.jsonlines`.
+With `--format columnar`, records are written in a compressed columnar
+format instead (see `scraper.columnar`), e.g. `Contact.columns`.
+
+Records are read either from a local copy of the cache, or directly from
+the S3 cache bucket (with `--s3`).  The bodies of records deduplicated into
+blobs (see `scraper.blobs`) are read from the local copy's blob directory
+(`--blob-dir`), or from S3.
+
+With `--incremental`, only cache entries stored since the previous
+incremental export of their entity set are processed.  Their records are
+written to delta files beside the full outputs, e.g.
+`Contact.delta-20170214T130000.jsonlines`, with each record (identified by
+its `__metadata.uri`) written once, from the most recently stored page.
+
+With `--status`, `--since` or `--until`, only responses with one of the
+given statuses, or cached in the given period, are processed.  These are
+selected by reading just the metadata at the start of each record, so the
+bodies of other responses aren't read (or downloaded).  Incremental exports
+with these options keep separate watermarks for each combination of them.
+
+Usage:
+
+    python -m scraper.collect [--input-dir DIR [--blob-dir DIR] | --s3] [--output-dir DIR]
+                              [--processes N] [--ordered] [--incremental]
+                              [--format {jsonlines,columnar}]
+                              [--status STATUS] [--since TIME] [--until TIME]
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
 import functools
+import io
+import itertools
 import json
+import logging
+import multiprocessing
 import os
+import threading
+import time
+import urllib.parse
+
+from scrapy.utils.project import get_project_settings
 
-# import boto3
+from scraper import blobs, columnar, decoding, record, s3
+from scraper.query import entity_set_name
 
-# import settings
-# import storage
+logger = logging.getLogger(__name__)
 
 __here__ = os.path.dirname(__file__)
 INPUT_DIR = os.path.join(__here__, "..", "cache", "CACHE", "XRMServices", "2011")
+BLOB_DIR = os.path.join(__here__, "..", "cache", blobs.blob_key_prefix)
 OUTPUT_DIR = os.path.join(__here__, "..", "output")
 
-# def get_objects(bucket):
-#     for key in bucket.objects.all():
-#         if key.key.strip("/").startswith(storage.cache_key_prefix):
-#             text = storage.get_s3_text(bucket, key.key)
-#             yield text
-
-# def get_bucket():
-#     bucket_name = settings.S3CACHE_BUCKET
-#     assert bucket_name, "No bucket configured"
-#     s3 = boto3.resource('s3')
-#     bucket = s3.Bucket(bucket_name)
-#     return bucket
-
-
-def local_cache(input_dir):
-    """Walk input dir and yield contents."""
-    for (dirpath, _, filenames) in os.walk(input_dir):
-        for filename in filenames:
-            if filename == "response_body":
-                with open(os.path.join(dirpath, filename)) as f:
-                    text = f.read()
-                    if "<title>Object moved</title>" in text:
-                        print(os.path.join(dirpath, filename))  # noqa: T003
-                        continue
-                    else:
-                        yield text
+cache_key_prefix = "CACHE"
+
+# Size of the write buffer of each output file
+BUFFER_SIZE = 1024 * 1024
+
+# File in the output directory holding the watermarks of incremental exports
+WATERMARKS_FILENAME = ".watermarks.json"
+
+# Number of response bodies sent to a parser process at a time
+_CHUNKSIZE = 16
+
+
+class JSONLinesWriter:
+    """Writes JSON encoded records to a file, one per line."""
+
+    def __init__(self, path):
+        """Opens the file for appending."""
+        self._file = open(path, "a", buffering=BUFFER_SIZE)
+
+    def write(self, line):
+        """Writes a JSON encoded record."""
+        self._file.write(line)
+        self._file.write("\n")
+
+    def close(self):
+        """Closes the file."""
+        self._file.close()
+
+
+# Output formats, as (file extension, writer class, record encoder)
+formats = {
+    'jsonlines': (".jsonlines", JSONLinesWriter, json.dumps),
+    'columnar': (".columns", columnar.ColumnarWriter, columnar.flatten),
+}
+
+
+class WriterPool:
+    """Output files, one per entity type, with a bounded number kept open.
+
+    Files are opened in append mode on first use.  Once `max_open` files are
+    open, the least recently used one is closed to make room.
+    """
+
+    def __init__(self, output_dir, max_open=64, suffix="", output_format='jsonlines'):
+        """Initialises the pool."""
+        self.output_dir = output_dir
+        self.max_open = max_open
+        self.suffix = suffix
+        self.extension, self.writer_class, _ = formats[output_format]
+        self._writers = collections.OrderedDict()
+
+    def write(self, key, values):
+        """Writes encoded records to the file for `key`."""
+        writer = self._writers.get(key)
+        if writer is None:
+            if len(self._writers) >= self.max_open:
+                _, lru = self._writers.popitem(last=False)
+                lru.close()
+            filename = os.path.join(self.output_dir, key + self.suffix + self.extension)
+            writer = self._writers[key] = self.writer_class(filename)
+        else:
+            self._writers.move_to_end(key)
+        for value in values:
+            writer.write(value)
+
+    def close(self):
+        """Flushes and closes all open files."""
+        while self._writers:
+            _, writer = self._writers.popitem()
+            writer.close()
+
+    def __enter__(self):
+        """Returns the pool."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Closes the pool."""
+        self.close()
+
+
+def local_cache(input_dir, ordered=False):
+    """Walk input dir and yield the paths of cached response bodies."""
+    for (dirpath, dirnames, filenames) in os.walk(input_dir):
+        if ordered:
+            dirnames.sort()
+        for filename in _body_filenames(filenames):
+            yield os.path.join(dirpath, filename)
+
+
+def local_cache_times(input_dir):
+    """Yields `(path, timestamp)` for each cached response body.
+
+    The timestamp is the file's modification time which, for a copy made
+    with `aws s3 sync`, is the time the object was stored in S3.
+    """
+    for path in local_cache(input_dir):
+        yield path, os.stat(path).st_mtime
+
+
+def s3_cache(bucket, prefix=cache_key_prefix):
+    """Yields the keys of cached response bodies in the S3 cache bucket."""
+    for key, _ in s3_cache_times(bucket, prefix):
+        yield key
+
+
+def s3_cache_times(bucket, prefix=cache_key_prefix):
+    """Yields `(key, timestamp)` for each cached response body in S3.
+
+    Keys are laid out as `<prefix>/<url path>/<fingerprint>/<filename>`
+    (see `scraper.storage._storage_path`), and are listed in order, so the
+    objects for each fingerprint are adjacent.  The timestamp is the time
+    the object was stored.
+    """
+    def fingerprint_dir(obj):
+        return obj['Key'].rsplit("/", 1)[0]
+
+    for dirpath, objects in itertools.groupby(s3.list_objects(bucket, prefix + "/"), key=fingerprint_dir):
+        times = {obj['Key'].rsplit("/", 1)[-1]: obj['LastModified'].timestamp() for obj in objects}
+        for filename in _body_filenames(times):
+            yield "{}/{}".format(dirpath, filename), times[filename]
+
+
+def _body_filenames(filenames):
+    """Returns the names of the files holding response bodies.
+
+    Packed records take precedence over legacy response bodies, in case a
+    fingerprint has both.
+    """
+    if record.filename in filenames:
+        return [record.filename]
+    return [filename for filename in filenames if filename == 'response_body']
+
+
+def download(bucket, keys, threads=32, select=None):
+    """Downloads objects using a pool of threads.
+
+    Yields the contents of each object in the order of `keys`, with the
+    bodies of deduplicated records in place (see `scraper.blobs`).  At most
+    twice as many objects as there are threads are held in memory.
+
+    If `select` is given, it is called with the metadata of each cached
+    response, and None is yielded instead of the responses it rejects.
+    """
+    start = time.time()
+    downloaded = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = collections.deque()
+        keys = iter(keys)
+        for key in itertools.islice(keys, threads * 2):
+            futures.append(executor.submit(_get_selected, bucket, key, select))
+        while futures:
+            data = futures.popleft().result()
+            for key in itertools.islice(keys, 1):
+                futures.append(executor.submit(_get_selected, bucket, key, select))
+            downloaded += len(data or b"")
+            yield data
+    logger.info('Downloaded %d bytes in %.0fs', downloaded, time.time() - start)
+
+
+def _get_selected(bucket, key, select):
+    if select is not None and not select(get_metadata(bucket, key)):
+        return None
+    return blobs.get_record(bucket, key)
+
+
+def get_metadata(bucket, key):
+    """Returns the metadata of the response cached under `key` in S3.
+
+    Only the start of a packed record is read; for legacy entries, the
+    metadata is read from the `meta` object beside the response body.
+    """
+    dirpath, filename = key.rsplit("/", 1)
+    if filename != record.filename:
+        return record.parse_legacy_metadata(s3.get_object(bucket, dirpath + "/meta"))
+    return s3.get_metadata(bucket, key)
+
+
+def read_metadata(path):
+    """Returns the metadata of the response cached at `path`.
+
+    Only the start of a packed record is read; for legacy entries, the
+    metadata is read from the `meta` file beside the response body.
+    """
+    if os.path.basename(path) != record.filename:
+        with open(os.path.join(os.path.dirname(path), "meta"), "rb") as f:
+            return record.parse_legacy_metadata(f.read())
+    with open(path, "rb") as f:
+        data = f.read(s3.METADATA_READ_SIZE)
+        try:
+            return record.unpack_metadata(data)
+        except record.RecordError:
+            if len(data) < s3.METADATA_READ_SIZE:
+                raise
+        f.seek(0)
+        return record.unpack_metadata(f.read())
+
+
+def read_body(path, blob_dir=None):
+    """Returns the response body cached at `path`, or None for redirects.
+
+    Bodies deduplicated into blobs are read from `blob_dir` (a local copy
+    of the cache's blobs), and are skipped if it doesn't hold them.
+    """
+    with open(path, "rb") as f:
+        return _read_body(f, path, blob_dir)
+
+
+def read_blob(blob_dir, digest):
+    """Returns the body held in a blob in `blob_dir`, or None if it's missing."""
+    try:
+        with open(os.path.join(blob_dir, digest), "rb") as f:
+            return blobs.unpack(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def extract_body(data, name):
+    """Returns the response body in cached `data`, or None for redirects.
+
+    `data` is either a packed record or a legacy response body.
+    """
+    return _read_body(io.BytesIO(data), name)
+
+
+def _read_body(fileobj, name, blob_dir=None):
+    # Records are decompressed as they are read, rather than all at once
+    if record.is_record(fileobj.read(len(record.MAGIC))):
+        fileobj.seek(0)
+        metadata, parts = record.read(fileobj)
+        if metadata['status'] == 302:
+            return None
+        data = parts['response_body']
+        digest = blobs.referenced(metadata)
+        if digest is not None:
+            data = read_blob(blob_dir, digest) if blob_dir is not None else None
+            if data is None:
+                logger.warning('Skipping response with missing body: %s', name)
+                return None
+    else:
+        fileobj.seek(0)
+        data = fileobj.read()
+    if b"<title>Object moved</title>" in data:
+        logger.warning('Skipping redirect: %s', name)
+        return None
+    return data
+
+
+class ResponseFilter:
+    """Selects cached responses by status, and by when they were cached."""
+
+    def __init__(self, statuses=None, since=None, until=None):
+        """Initialises the filter, with `since` and `until` as Unix times."""
+        self.statuses = set(statuses or ())
+        self.since = since
+        self.until = until
+
+    def __call__(self, metadata):
+        """Returns whether a response's metadata is selected."""
+        if self.statuses and metadata.get('status') not in self.statuses:
+            return False
+        timestamp = metadata.get('timestamp')
+        if self.since is not None and (timestamp is None or timestamp < self.since):
+            return False
+        if self.until is not None and (timestamp is None or timestamp >= self.until):
+            return False
+        return True
+
+    def __str__(self):
+        """Returns the filter's settings, as a query string."""
+        settings = [('status', status) for status in sorted(self.statuses)]
+        settings += [(name, value) for name, value in (('since', self.since), ('until', self.until))
+                     if value is not None]
+        return urllib.parse.urlencode(settings)
+
+
+def parse_time(value):
+    """Returns the Unix time of a UTC date, or date and time, in ISO 8601 format."""
+    for time_format in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+        try:
+            moment = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return moment.replace(tzinfo=datetime.timezone.utc).timestamp()
+    raise argparse.ArgumentTypeError('Invalid time: {}'.format(value))
+
+
+class Watermarks:
+    """The latest cache timestamp exported for each entity set.
+
+    Timestamps (such as S3's, which are to the second) can be shared by
+    entries stored after an export, so the names of the entries exported
+    at each watermark are kept too.  Watermarks are loaded from and saved
+    to a JSON file.
+
+    Exports of only some entries (selected with a `ResponseFilter`) have
+    watermarks of their own, kept under their `scope` (the filter's
+    settings), so that they don't move the watermarks of other exports past
+    the entries they left out.
+    """
+
+    def __init__(self, path, scope=''):
+        """Loads the watermarks (if the file exists)."""
+        self.path = path
+        self.scope = scope
+        self.marks = {}
+        self.names = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        for entity_set, mark in data.items():
+            # Older files hold just the timestamps
+            if isinstance(mark, dict):
+                self.names[entity_set] = set(mark['names'])
+                mark = mark['timestamp']
+            self.marks[entity_set] = mark
+
+    def select_changed(self, entries):
+        """Returns the names of entries stored since their watermark.
+
+        `entries` are `(name, timestamp)` pairs.  Entries stored at the
+        watermark are included unless they were exported at it.  The names
+        are returned newest first, and the watermarks are advanced (but not
+        saved).
+        """
+        changed = []
+        latest = {}
+        for name, timestamp in entries:
+            entity_set = self._key(entity_set_name(name))
+            mark = self.marks.get(entity_set)
+            if mark is not None and (
+                    timestamp < mark or timestamp == mark and name in self.names.get(entity_set, ())):
+                continue
+            changed.append((timestamp, name))
+            latest_timestamp, names = latest.get(entity_set, (timestamp, set()))
+            if timestamp > latest_timestamp:
+                latest_timestamp, names = timestamp, set()
+            if timestamp == latest_timestamp:
+                names.add(name)
+            latest[entity_set] = (latest_timestamp, names)
+        for entity_set, (timestamp, names) in latest.items():
+            if timestamp == self.marks.get(entity_set):
+                self.names.setdefault(entity_set, set()).update(names)
+            else:
+                self.marks[entity_set] = timestamp
+                self.names[entity_set] = names
+        changed.sort(reverse=True)
+        return [name for _, name in changed]
+
+    def _key(self, entity_set):
+        return '{}?{}'.format(entity_set, self.scope) if self.scope else entity_set
+
+    def save(self):
+        """Writes the watermarks to the file."""
+        data = {
+            entity_set: {'timestamp': mark, 'names': sorted(self.names.get(entity_set, ()))}
+            for entity_set, mark in self.marks.items()}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
 
 
 def collect_data(items):
-    """Convert to json."""
-    for text in items:
-        data = json.loads(text)
-        if 'd' in data:
+    """Convert to json.
+
+    Responses that aren't pages of entities, such as service documents and
+    `$count` responses (which are bare numbers), are skipped.
+    """
+    for body in items:
+        data = decoding.loads(body)
+        if not isinstance(data, dict) or 'd' not in data:
             continue
         if 'EntitySets' in data['d']:
             continue
@@ -52,20 +436,201 @@ def collect_data(items):
             yield item
 
 
+def output_key(item):
+    """Returns the name of the output file for an item."""
+    return item['__metadata']['type'].split(".")[-1]
+
+
+def parse_body(body, encode=json.dumps):
+    """Returns the records in a response body, grouped by output file.
+
+    Each record is returned as a `(uri, encoded record)` pair.
+    """
+    grouped = collections.defaultdict(list)
+    for item in collect_data([body]):
+        grouped[output_key(item)].append((item['__metadata']['uri'], encode(item)))
+    return grouped
+
+
+def _parse_path(path, encode=json.dumps, select=None, blob_dir=None):
+    if select is not None and not select(read_metadata(path)):
+        return {}
+    body = read_body(path, blob_dir)
+    if body is None:
+        return {}
+    return parse_body(body, encode)
+
+
+def _parse_object(obj, encode=json.dumps):
+    key, data = obj
+    if data is None:
+        return {}
+    body = extract_body(data, key)
+    if body is None:
+        return {}
+    return parse_body(body, encode)
+
+
 def write_data(data, output_dir):
     """Write data to output file."""
-    for item in collect_data(data):
-        key = item['__metadata']['type'].split(".")[-1] + ".jsonlines"
-        filename = os.path.join(output_dir, key)
-        with open(filename, "a") as f:
-            writeline = functools.partial(print, file=f)  # noqa: T101
-            writeline(json.dumps(item))
+    with WriterPool(output_dir) as writers:
+        for body in data:
+            for key, records in parse_body(body).items():
+                writers.write(key, (line for _, line in records))
+
+
+def _unseen(records, seen):
+    for uri, line in records:
+        if uri not in seen:
+            seen.add(uri)
+            yield uri, line
+
+
+def _bounded(iterable, semaphore):
+    for item in iterable:
+        semaphore.acquire()
+        yield item
+
 
+def export(paths, output_dir, processes=None, ordered=False, max_open=64, parse=_parse_path,
+           dedup=False, suffix="", output_format='jsonlines', select=None):
+    """Parses cached response bodies in parallel and writes their records.
 
-def main():
+    Each item in `paths` is passed to `parse` (by default a local path to
+    read), across a pool of `processes` worker processes (one per CPU by
+    default).  If `ordered` is set, records are written in the order of
+    `paths`; otherwise they're written as soon as they're parsed.
+
+    If `dedup` is set, only the first record written for each URI is kept.
+    `suffix` is added to the name of each output file, which are written in
+    `output_format` (one of `formats`).
+
+    If `select` is given, it is passed to `parse`, to be called with the
+    metadata of each cached response, skipping the responses it rejects.
+
+    Returns the number of response bodies processed.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    start = time.time()
+    seen = set()
+    parse = functools.partial(parse, encode=formats[output_format][2])
+    if select is not None:
+        parse = functools.partial(parse, select=select)
+    with WriterPool(output_dir, max_open=max_open, suffix=suffix, output_format=output_format) as writers:
+        if processes == 1:
+            results = map(parse, paths)
+            pool = None
+        else:
+            processes = processes or os.cpu_count()
+            pool = multiprocessing.Pool(processes)
+            imap = pool.imap if ordered else pool.imap_unordered
+            # The pool would otherwise consume (and buffer) all input at once
+            in_flight = threading.BoundedSemaphore(processes * _CHUNKSIZE * 4)
+            results = imap(parse, _bounded(paths, in_flight), chunksize=_CHUNKSIZE)
+        try:
+            for count, grouped in enumerate(results, 1):
+                if pool is not None:
+                    in_flight.release()
+                for key, records in grouped.items():
+                    if dedup:
+                        records = _unseen(records, seen)
+                    writers.write(key, (line for _, line in records))
+                if count % 10000 == 0:
+                    logger.info('Processed %d response bodies (%.0f/s)',
+                                count, count / (time.time() - start))
+        finally:
+            if pool is not None:
+                pool.terminate()
+    return count
+
+
+def export_s3(bucket, output_dir, threads=32, keys=None, select=None, **kwargs):
+    """Exports records directly from the S3 cache bucket.
+
+    Response bodies (all of them, unless `keys` is given) are downloaded by
+    a pool of `threads` threads and parsed as they arrive.  If `select` is
+    given, only the bodies of responses whose metadata it accepts are
+    downloaded.  Other arguments are as for `export()`.
+    """
+    keys, download_keys = itertools.tee(s3_cache(bucket) if keys is None else keys)
+    objects = zip(keys, download(bucket, download_keys, threads=threads, select=select))
+    return export(objects, output_dir, parse=_parse_object, **kwargs)
+
+
+def main(argv=None):
     """Do the stuff."""
-    data = local_cache(INPUT_DIR)
-    write_data(data, OUTPUT_DIR)
+    parser = argparse.ArgumentParser(description='Export cached records as JSON lines.')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--input-dir', default=INPUT_DIR)
+    source.add_argument('--s3', action='store_true',
+                        help='read directly from the S3 cache bucket')
+    parser.add_argument('--blob-dir', default=BLOB_DIR,
+                        help='directory of the local copy of deduplicated response bodies')
+    parser.add_argument('--download-threads', type=int, default=32)
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of parser processes (default: one per CPU)')
+    parser.add_argument('--ordered', action='store_true',
+                        help='write records in a deterministic order')
+    parser.add_argument('--max-open-files', type=int, default=64)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only export entries stored since the last incremental export')
+    parser.add_argument('--format', choices=sorted(formats), default='jsonlines')
+    parser.add_argument('--status', type=int, action='append',
+                        help='only export responses with this status (may be repeated)')
+    parser.add_argument('--since', type=parse_time,
+                        help='only export responses cached at or after this UTC time (e.g. 2017-02-14T13:00:00)')
+    parser.add_argument('--until', type=parse_time,
+                        help='only export responses cached before this UTC time')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    options = {
+        'processes': args.processes,
+        'ordered': args.ordered,
+        'max_open': args.max_open_files,
+        'output_format': args.format,
+    }
+    if args.status or args.since is not None or args.until is not None:
+        options['select'] = ResponseFilter(args.status, args.since, args.until)
+    if args.incremental:
+        return export_incremental(args, options)
+    if args.s3:
+        bucket = s3.get_bucket(get_project_settings())
+        count = export_s3(bucket, args.output_dir, threads=args.download_threads, **options)
+    else:
+        paths = local_cache(args.input_dir, ordered=args.ordered)
+        count = export(paths, args.output_dir, parse=_local_parser(args), **options)
+    logger.info('Exported records from %d response bodies', count)
+
+
+def _local_parser(args):
+    return functools.partial(_parse_path, blob_dir=args.blob_dir)
+
+
+def export_incremental(args, options):
+    """Exports entries stored since the last incremental export."""
+    os.makedirs(args.output_dir, exist_ok=True)
+    watermarks = Watermarks(os.path.join(args.output_dir, WATERMARKS_FILENAME), scope=str(options.get('select', '')))
+    options.update({
+        # Entries are processed newest first, so the first record seen
+        # for each URI is the most recent
+        'ordered': True,
+        'dedup': True,
+        'suffix': time.strftime(".delta-%Y%m%dT%H%M%S"),
+    })
+    if args.s3:
+        bucket = s3.get_bucket(get_project_settings())
+        keys = watermarks.select_changed(s3_cache_times(bucket))
+        logger.info('Found %d changed response bodies', len(keys))
+        count = export_s3(bucket, args.output_dir, threads=args.download_threads, keys=keys, **options)
+    else:
+        paths = watermarks.select_changed(local_cache_times(args.input_dir))
+        logger.info('Found %d changed response bodies', len(paths))
+        count = export(paths, args.output_dir, parse=_local_parser(args), **options)
+    watermarks.save()
+    logger.info('Exported records from %d response bodies', count)
 
 
 if __name__ == '__main__':
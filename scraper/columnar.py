@@ -0,0 +1,209 @@
+"""Columnar output format for exported records.
+
+Records are stored in row groups.  Each row group holds one compressed chunk
+per column, so field names are stored once per row group rather than once
+per record, and values of the same kind are compressed together.  Nested
+objects (such as `__metadata`, or CDMS entity references) are flattened into
+dotted column names, e.g. `__metadata.type`.
+
+A file looks like:
+
+    +-------+---------+-----------+-----------+-----+
+    | magic | version | row group | row group | ... |
+    +-------+---------+-----------+-----------+-----+
+
+and each row group like:
+
+    +---------------+---------------+--------------+--------------+-----+
+    | header length | header (JSON) | column chunk | column chunk | ... |
+    +---------------+---------------+--------------+--------------+-----+
+
+The header holds the number of rows, and the name, type and compressed size
+of each column chunk.  Each chunk is a zlib compressed JSON array of the
+column's values.
+
+The schema (column names and types) is inferred from the first records
+written, and widened as needed if later records add columns or hold values
+of a different type.  Files can be appended to, as each row group is self
+describing.
+"""
+import json
+import struct
+import zlib
+
+MAGIC = b'SCOL'
+VERSION = 1
+
+_header = struct.Struct('>4sB')
+_length = struct.Struct('>I')
+
+# Column types
+NULL, BOOL, INT, FLOAT, STRING, JSON = 'null', 'bool', 'int', 'float', 'string', 'json'
+
+
+def value_type(value):
+    """Returns the column type of a (flattened) value."""
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return BOOL
+    if isinstance(value, int):
+        return INT
+    if isinstance(value, float):
+        return FLOAT
+    if isinstance(value, str):
+        return STRING
+    return JSON
+
+
+def widen(type1, type2):
+    """Returns the narrowest column type that can hold both types."""
+    if type1 == type2 or type2 == NULL:
+        return type1
+    if type1 == NULL:
+        return type2
+    if {type1, type2} == {INT, FLOAT}:
+        return FLOAT
+    return JSON
+
+
+def flatten(record, prefix=''):
+    """Flattens nested objects in a record into dotted keys.
+
+    >>> flatten({'a': {'b': 1}, 'c': [2]})
+    {'a.b': 1, 'c': [2]}
+    """
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict) and value:
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def unflatten(flat):
+    """Reverses `flatten()`.
+
+    Null values never replace nested objects, and nested objects holding
+    only nulls are left out.
+
+    >>> unflatten({'a.b': 1, 'a': None, 'c': None, 'd.e': None})
+    {'a': {'b': 1}, 'c': None}
+    """
+    record = {}
+    for key, value in flat.items():
+        *parents, name = key.split('.')
+        target = record
+        for parent in parents:
+            child = target.get(parent)
+            if not isinstance(child, dict):
+                if value is None:
+                    break
+                child = target[parent] = {}
+            target = child
+        else:
+            if value is not None or name not in target:
+                target[name] = value
+    return record
+
+
+class ColumnarWriter:
+    """Writes flattened records to a columnar file in row groups."""
+
+    def __init__(self, path, row_group_size=10000, level=6):
+        """Opens the file for appending.
+
+        The schema is inferred from the records in the first row group, and
+        widened by each subsequent row group.
+        """
+        self.path = path
+        self.row_group_size = row_group_size
+        self.level = level
+        self.schema = None
+        self._rows = []
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_header.pack(MAGIC, VERSION))
+
+    def write(self, flat):
+        """Buffers a flattened record, writing a row group once full."""
+        self._rows.append(flat)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Writes buffered records as a row group."""
+        if not self._rows:
+            return
+        self.schema = infer_schema(self._rows, self.schema)
+        names = list(self.schema)
+        chunks = [
+            zlib.compress(json.dumps([row.get(name) for row in self._rows]).encode('utf-8'), self.level)
+            for name in names]
+        header = json.dumps({
+            'rows': len(self._rows),
+            'columns': [[name, self.schema[name], len(chunk)] for name, chunk in zip(names, chunks)],
+        }).encode('utf-8')
+        self._file.write(_length.pack(len(header)))
+        self._file.write(header)
+        for chunk in chunks:
+            self._file.write(chunk)
+        self._rows = []
+
+    def close(self):
+        """Flushes buffered records and closes the file."""
+        self.flush()
+        self._file.close()
+
+
+def infer_schema(rows, schema=None):
+    """Returns a schema holding every column in `rows`.
+
+    If an existing schema is given, it is widened rather than replaced.
+    """
+    schema = dict(schema or {})
+    for row in rows:
+        for name, value in row.items():
+            schema[name] = widen(schema.get(name, NULL), value_type(value))
+    return schema
+
+
+def read_columns(path, columns=None):
+    """Yields each row group in a file as a `{column: values}` dict.
+
+    If `columns` is given, only those columns are decompressed; columns
+    missing from a row group are filled with None.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _header.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not a columnar file: {}'.format(path))
+    _, version = _header.unpack_from(data)
+    if version > VERSION:
+        raise ValueError('Unsupported columnar file version: {}'.format(version))
+
+    offset = _header.size
+    view = memoryview(data)
+    while offset < len(data):
+        (size,) = _length.unpack_from(data, offset)
+        offset += _length.size
+        header = json.loads(bytes(view[offset:offset + size]).decode('utf-8'))
+        offset += size
+
+        group = {}
+        for name, _, chunk_size in header['columns']:
+            if columns is None or name in columns:
+                group[name] = json.loads(zlib.decompress(view[offset:offset + chunk_size]).decode('utf-8'))
+            offset += chunk_size
+        for name in columns or ():
+            group.setdefault(name, [None] * header['rows'])
+        yield group
+
+
+def read(path, columns=None):
+    """Yields the records in a file (see `read_columns()`)."""
+    for group in read_columns(path, columns):
+        names = list(group)
+        for values in zip(*(group[name] for name in names)):
+            yield unflatten(dict(zip(names, values)))
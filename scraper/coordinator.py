@@ -0,0 +1,207 @@
+"""Coordination of several spider processes crawling one service.
+
+Work is shared through Redis as a queue of work items.  Each item is a
+request to make (its URL, the name of the spider callback for its response,
+and its meta): the service root, an entity set's `$count`, or the first page
+of an entity set or partition.  A worker claims an item by atomically moving
+it from the queue onto its own list of claimed items, and follows the chain
+of pages from it before marking it complete.
+
+Each worker holds a lease, a key that expires unless renewed by heartbeats.
+When a worker's lease has expired, any worker may reap its claimed items,
+moving them back onto the queue to be claimed again.  Each move is atomic,
+so items are never lost or duplicated in the queue, though the pages of a
+reaped chain will be requested again (from the HTTP cache, if enabled).
+
+The first worker to find that all of a crawl's work is complete marks the
+crawl done, and clears its seeded flag, so that the next crawl is seeded
+afresh (which clears the done mark).
+
+Usage:
+
+    python -m scraper.coordinator status
+    python -m scraper.coordinator reset
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+
+from redis import StrictRedis
+from redis.exceptions import WatchError
+from scrapy.utils.project import get_project_settings
+
+logger = logging.getLogger(__name__)
+
+queue_key = 'coordinator:queue'
+seeded_key = 'coordinator:seeded'
+done_key = 'coordinator:done'
+workers_key = 'coordinator:workers'
+claimed_key_prefix = 'coordinator:claimed:'
+lease_key_prefix = 'coordinator:lease:'
+
+
+class Coordinator:
+    """A worker's view of the work shared between spider processes."""
+
+    def __init__(self, redis, worker_id=None, lease_seconds=60):
+        """Initialises the coordinator for a worker."""
+        self.redis = redis
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.claimed_key = claimed_key_prefix + self.worker_id
+        self.lease_key = lease_key_prefix + self.worker_id
+
+    def heartbeat(self):
+        """Registers the worker and renews its lease."""
+        self.redis.sadd(workers_key, self.worker_id)
+        self.redis.set(self.lease_key, 1, ex=self.lease_seconds)
+
+    def seed(self, items):
+        """Queues the first work items of a crawl.
+
+        Only the first worker to seed a crawl queues its items; returns
+        whether this worker did.
+        """
+        if not self.redis.setnx(seeded_key, self.worker_id):
+            return False
+        self.redis.delete(done_key)
+        for item in items:
+            self.put(item)
+        return True
+
+    def put(self, item):
+        """Queues a work item."""
+        self.redis.lpush(queue_key, encode_item(item))
+
+    def claim(self):
+        """Claims the next queued work item, returning None if there is none.
+
+        The returned item holds its encoded form under `'work'`, to be passed
+        to `complete()`.
+        """
+        data = self.redis.rpoplpush(queue_key, self.claimed_key)
+        if data is None:
+            return None
+        item = decode_item(data)
+        item['work'] = _decode(data)
+        return item
+
+    def complete(self, work):
+        """Marks a claimed work item as complete."""
+        self.redis.lrem(self.claimed_key, 1, work)
+
+    def leave(self):
+        """Requeues the worker's claimed items, and gives up its lease."""
+        while self.redis.rpoplpush(self.claimed_key, queue_key) is not None:
+            pass
+        self.redis.srem(workers_key, self.worker_id)
+        self.redis.delete(self.lease_key)
+
+    def reap(self):
+        """Requeues the claimed items of workers whose leases have expired.
+
+        Returns the number of items requeued.
+        """
+        num_items = 0
+        for worker_id in self.redis.smembers(workers_key):
+            worker_id = _decode(worker_id)
+            if worker_id == self.worker_id or self.redis.exists(lease_key_prefix + worker_id):
+                continue
+            claimed_key = claimed_key_prefix + worker_id
+            while self.redis.rpoplpush(claimed_key, queue_key) is not None:
+                num_items += 1
+            self.redis.srem(workers_key, worker_id)
+            logger.warning('Worker %s lease expired, requeued its claimed work', worker_id)
+        return num_items
+
+    def finished(self):
+        """Returns whether the crawl has been seeded and all work is complete.
+
+        The first time this is found, the crawl is marked done, and its
+        seeded flag cleared, so that the next crawl is seeded afresh.  The
+        check is made in a transaction watching the queue and the claimed
+        items, so that work queued while checking isn't missed.
+        """
+        if self.redis.exists(done_key):
+            return True
+        with self.redis.pipeline() as pipeline:
+            try:
+                pipeline.watch(seeded_key, queue_key, workers_key)
+                claimed_keys = [claimed_key_prefix + _decode(worker_id)
+                                for worker_id in pipeline.smembers(workers_key)]
+                if claimed_keys:
+                    pipeline.watch(*claimed_keys)
+                if not pipeline.exists(seeded_key) or pipeline.llen(queue_key):
+                    return False
+                if any(pipeline.llen(claimed_key) for claimed_key in claimed_keys):
+                    return False
+                pipeline.multi()
+                pipeline.set(done_key, self.worker_id)
+                pipeline.delete(seeded_key)
+                pipeline.execute()
+            except WatchError:
+                # Work was queued or completed while checking
+                return False
+        logger.info('All work complete')
+        return True
+
+    def status(self):
+        """Returns the number of queued items, and claimed items per worker."""
+        return {
+            'seeded': bool(self.redis.exists(seeded_key)),
+            'done': bool(self.redis.exists(done_key)),
+            'queued': self.redis.llen(queue_key),
+            'claimed': {
+                _decode(worker_id): self.redis.llen(claimed_key_prefix + _decode(worker_id))
+                for worker_id in self.redis.smembers(workers_key)},
+        }
+
+    def reset(self):
+        """Forgets all work, so that the next crawl is seeded afresh."""
+        keys = [queue_key, seeded_key, done_key, workers_key]
+        for worker_id in self.redis.smembers(workers_key):
+            worker_id = _decode(worker_id)
+            keys.extend([claimed_key_prefix + worker_id, lease_key_prefix + worker_id])
+        self.redis.delete(*keys)
+
+
+def default_worker_id():
+    """Returns an ID for this process that is unique across containers."""
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def encode_item(item):
+    """Encodes a work item (a dict of url, callback and meta)."""
+    return json.dumps({key: item[key] for key in ('url', 'callback', 'meta')}, sort_keys=True)
+
+
+def decode_item(data):
+    """Decodes a work item."""
+    return json.loads(_decode(data))
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def main(argv=None):
+    """Reports the state of the shared work, or resets it."""
+    parser = argparse.ArgumentParser(description='Manage work shared between spider processes.')
+    parser.add_argument('command', choices=['status', 'reset'])
+    args = parser.parse_args(argv)
+
+    settings = get_project_settings()
+    coordinator = Coordinator(
+        StrictRedis(host=settings['REDIS_HOST'], port=settings['REDIS_PORT'], db=settings['REDIS_DB']),
+        worker_id='admin')
+    if args.command == 'reset':
+        coordinator.reset()
+    else:
+        sys.stdout.write('{}\n'.format(json.dumps(coordinator.status(), sort_keys=True)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""Crawl performance statistics.
+
+The `CrawlStats` extension records, in the crawler's stats:
+
+- `entity_sets/<name>/pages`, `records` and `bytes`: the pages and bytes of
+  each entity set received (from CDMS or the HTTP cache), and the records
+  scraped from them (only counted when `EMIT_ITEMS` is enabled);
+- `entity_sets/<name>/latency_ms` and `download/latency_ms`: histograms of
+  the latency of responses downloaded from CDMS, per entity set and overall.
+
+Other components add their own, notably `s3cache/hit`, `s3cache/miss` and
+the `s3cache/latency_ms` histogram (from `scraper.storage`),
+`sessions/logins` and the `sessions/login_ms` histogram (from
+`scraper.sessions`) and `retry/redirects` (from the spider).
+
+Every `CRAWL_STATS_INTERVAL` seconds, and when the spider closes, all of the
+crawler's stats are written as a JSON line (to `CRAWL_STATS_FILE`, or else
+logged), along with each entity set's pages and records per second since
+the previous line (or, in the final line, since the spider opened).
+Histograms are written as their count, mean, maximum, percentiles and
+bucket counts.
+"""
+import bisect
+import datetime
+import json
+import logging
+import threading
+import time
+
+from scrapy import signals
+from twisted.internet import task
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of histogram buckets (in milliseconds, for latencies)
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+_observe_lock = threading.Lock()
+
+
+class Histogram:
+    """Counts values in fixed buckets, for approximate percentiles.
+
+    Values can be added from any thread.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        """Initialises an empty histogram."""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        """Adds a value to the histogram."""
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.total += value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding a percentile.
+
+        Values beyond the last bucket are reported as the maximum value.
+        Returns None if the histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        """Returns a summary of the histogram (for JSON encoding)."""
+        labels = ['le_{}'.format(bound) for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {label: count for label, count in zip(labels, self.counts) if count},
+        }
+
+    def __repr__(self):
+        """Returns the histogram's summary (as shown in Scrapy's stats dump)."""
+        summary = self.to_dict()
+        del summary['buckets']
+        return repr(summary)
+
+
+def observe(stats, key, value):
+    """Adds a value to the histogram in a stats collector, creating it if needed.
+
+    Does nothing if `stats` is None.
+    """
+    if stats is None:
+        return
+    histogram = stats.get_value(key)
+    if histogram is None:
+        with _observe_lock:
+            histogram = stats.get_value(key)
+            if histogram is None:
+                histogram = Histogram()
+                stats.set_value(key, histogram)
+    histogram.add(value)
+
+
+class CrawlStats:
+    """Scrapy extension recording crawl statistics, and writing them periodically."""
+
+    def __init__(self, stats, interval=60.0, path=None, clock=time.time):
+        """Initialises the extension."""
+        self.stats = stats
+        self.interval = interval
+        self.path = path
+        self._clock = clock
+        self._file = None
+        self._task = None
+        self._started = None
+        self._last = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Creates the extension, connected to the crawler's signals."""
+        extension = cls(
+            crawler.stats,
+            interval=crawler.settings.getfloat('CRAWL_STATS_INTERVAL', 60),
+            path=crawler.settings.get('CRAWL_STATS_FILE') or None)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        return extension
+
+    def spider_opened(self, spider):
+        """Starts writing stats periodically."""
+        if self.path:
+            self._file = open(self.path, 'a')
+        self._started = self._last = (self._clock(), {})
+        if self.interval:
+            self._task = task.LoopingCall(self.write)
+            self._task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        """Writes the final stats."""
+        if self._task is not None and self._task.running:
+            self._task.stop()
+        self.write(final=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def response_received(self, response, request, spider):
+        """Records a page (of an entity set) received."""
+        entity_set = request.meta.get('entity_set')
+        latency = request.meta.get('download_latency')
+        downloaded = latency is not None and 'cached' not in response.flags
+        if downloaded:
+            observe(self.stats, 'download/latency_ms', latency * 1000)
+        if entity_set is None:
+            return
+        prefix = 'entity_sets/{}/'.format(entity_set)
+        self.stats.inc_value(prefix + 'pages')
+        self.stats.inc_value(prefix + 'bytes', len(response.body))
+        if downloaded:
+            observe(self.stats, prefix + 'latency_ms', latency * 1000)
+
+    def item_scraped(self, item, spider):
+        """Records a record scraped."""
+        self.stats.inc_value('entity_sets/{}/records'.format(item.get('entity_set')))
+
+    def write(self, final=False):
+        """Writes the current stats as a JSON line."""
+        now = self._clock()
+        stats = dict(self.stats.get_stats())
+        counts = _entity_set_counts(stats)
+        since, previous = self._started if final else self._last
+        self._last = (now, counts)
+        line = json.dumps({
+            'time': now,
+            'final': final,
+            'rates': _rates(counts, previous, now - since),
+            'stats': stats,
+        }, sort_keys=True, default=_to_json)
+        if self._file is not None:
+            self._file.write(line + '\n')
+            self._file.flush()
+        else:
+            logger.info('Crawl stats: %s', line)
+
+
+def _entity_set_counts(stats):
+    counts = {}
+    for key, value in stats.items():
+        parts = key.split('/')
+        if len(parts) == 3 and parts[0] == 'entity_sets' and parts[2] in ('pages', 'records'):
+            counts.setdefault(parts[1], {})[parts[2]] = value
+    return counts
+
+
+def _rates(counts, previous, elapsed):
+    rates = {}
+    for entity_set, current in counts.items():
+        before = previous.get(entity_set, {})
+        rates[entity_set] = {
+            '{}_per_second'.format(name): round((current.get(name, 0) - before.get(name, 0)) / elapsed, 2)
+            if elapsed > 0 else None
+            for name in ('pages', 'records')}
+    return rates
+
+
+def _to_json(value):
+    if isinstance(value, Histogram):
+        return value.to_dict()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
@@ -0,0 +1,58 @@
+"""Decoding of OData JSON response bodies.
+
+Pages of entities can be several megabytes.  If orjson is installed, bodies
+are decoded with it directly from bytes, rather than first being decoded to
+text and then parsed by the standard library, which takes around half as
+long again (see `benchmarks.json_decoding`).
+
+When only the link to the next page is needed, `next_link()` finds it
+without decoding the page at all, as `__next` is the last member of the
+page's `d` object.
+"""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DECODER = 'json' if orjson is None else 'orjson'
+
+_next_key = b'"__next"'
+# The value of `__next`, followed by the ends of the `d` and outer objects
+_next_value = re.compile(rb'\s*:\s*("(?:[^"\\]|\\.)*")\s*}\s*}\s*\Z', re.DOTALL)
+
+
+def loads(body):
+    """Returns the decoded JSON of a response body (given as bytes or text)."""
+    if orjson is not None:
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError:
+            # orjson is stricter (e.g. about unpaired surrogates in strings),
+            # so anything it rejects is left to the standard library
+            pass
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return json.loads(body)
+
+
+def next_link(body):
+    """Returns the `d.__next` link of a page of entities, or None.
+
+    The link is found by scanning the end of the body, falling back to
+    decoding it if the body doesn't end as expected.  A body that doesn't
+    mention `__next` has no link, as long as it looks like a JSON object.
+    """
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    start = body.rfind(_next_key)
+    if start == -1:
+        if body[:64].lstrip().startswith(b'{') and body[-64:].rstrip().endswith(b'}'):
+            return None
+    else:
+        match = _next_value.match(body, start + len(_next_key))
+        if match:
+            return json.loads(match.group(1))
+    return loads(body)['d'].get('__next')
@@ -0,0 +1,122 @@
+import collections
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """A size-bounded, least recently used cache of files on local disk.
+
+    Values are stored as one file per key, in a subdirectory named after the
+    first two characters of the key.  Once the total size of all files
+    exceeds `max_bytes`, the least recently used files are removed.
+
+    Recency survives restarts as it is recorded in the file modification
+    times.  The cache is safe to use from multiple threads.
+    """
+
+    def __init__(self, directory, max_bytes):
+        """Initialises the cache (call `open()` before using it)."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self):
+        """Loads the index of files already on disk."""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            for _, key, size in sorted(found):
+                self._entries[key] = size
+                self.size += size
+            self._evict()
+        logger.info('Local cache %s holds %d entries (%d bytes)',
+                    self.directory, len(self._entries), self.size)
+
+    def get(self, key):
+        """Returns the value stored for `key`, or None."""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another thread (or removed by hand) in the meantime
+            with self._lock:
+                self._forget(key)
+            return None
+        return data
+
+    def put(self, key, data):
+        """Stores `data` under `key`, evicting old entries if needed."""
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = len(data)
+            self.size += len(data)
+            self._evict()
+
+    def delete(self, key):
+        """Removes `key` from the cache (if present)."""
+        with self._lock:
+            if self._forget(key):
+                _remove(self._path(key))
+
+    def __contains__(self, key):
+        """Returns whether `key` is cached."""
+        return key in self._entries
+
+    def __len__(self):
+        """Returns the number of cached entries."""
+        return len(self._entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _forget(self, key):
+        size = self._entries.pop(key, None)
+        if size is None:
+            return False
+        self.size -= size
+        return True
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            _remove(self._path(key))
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,114 @@
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Frontier:
+    """The pages of a crawl still to be processed, persisted in Redis.
+
+    Each pending page is stored with the meta needed to carry on crawling
+    from it (its entity set, partition and retry count).  A page is added
+    when its request is queued, and removed once its response has been
+    processed, so after a crash the pending pages are exactly those whose
+    chains still need following.
+
+    Chains (an entity set, or one partition of an entity set) are marked
+    done once their last page has been processed.
+
+    Updates are buffered and sent to Redis in a single transaction once
+    `batch_size` have accumulated, once the oldest has been buffered for
+    `flush_interval` seconds, or when `flush()` is called.  As the page
+    following each page is added before the page itself is removed, a crash
+    can only lose recent progress; pages are never dropped.
+
+    If a Scrapy stats collector is given, the number of flushes and updates
+    and the time spent flushing are recorded under `frontier/`.
+    """
+
+    pending_key = 'frontier:pending'
+    done_key = 'frontier:done'
+
+    def __init__(self, redis, batch_size=100, flush_interval=5.0, stats=None):
+        """Initialises the frontier."""
+        self.redis = redis
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = stats
+        self._pipeline = redis.pipeline()
+        self._num_buffered = 0
+        self._buffered_since = None
+
+    def add(self, url, meta):
+        """Records that a page is pending."""
+        self._pipeline.hset(self.pending_key, url, json.dumps(meta, sort_keys=True))
+        self._buffered()
+
+    def remove(self, url):
+        """Records that a page has been processed."""
+        self._pipeline.hdel(self.pending_key, url)
+        self._buffered()
+
+    def mark_done(self, chain):
+        """Records that all pages of a chain have been processed."""
+        self._pipeline.sadd(self.done_key, chain)
+        self._buffered()
+
+    def pending(self):
+        """Returns a dict of the meta of each pending page, keyed by URL."""
+        self.flush()
+        return {
+            _decode(url): json.loads(_decode(meta))
+            for url, meta in self.redis.hgetall(self.pending_key).items()}
+
+    def done(self):
+        """Returns the set of chains that are done."""
+        self.flush()
+        return {_decode(chain) for chain in self.redis.smembers(self.done_key)}
+
+    def flush(self):
+        """Sends buffered updates to Redis."""
+        if not self._num_buffered:
+            return
+        start = time.monotonic()
+        self._pipeline.execute()
+        elapsed = time.monotonic() - start
+        logger.debug('Flushed %d frontier updates in %.1fms', self._num_buffered, elapsed * 1000)
+        if self.stats is not None:
+            self.stats.inc_value('frontier/flushes')
+            self.stats.inc_value('frontier/updates', self._num_buffered)
+            self.stats.inc_value('frontier/flush_seconds', elapsed)
+            self.stats.max_value('frontier/flush_seconds_max', elapsed)
+        self._num_buffered = 0
+        self._buffered_since = None
+
+    def reset(self):
+        """Forgets all pending pages and done chains."""
+        self._pipeline.reset()
+        self._num_buffered = 0
+        self._buffered_since = None
+        self.redis.delete(self.pending_key, self.done_key)
+
+    def _buffered(self):
+        now = time.monotonic()
+        if self._buffered_since is None:
+            self._buffered_since = now
+        self._num_buffered += 1
+        if self._num_buffered >= self.batch_size or now - self._buffered_since >= self.flush_interval:
+            self.flush()
+
+
+def chain_id(meta):
+    """Returns the ID of the chain of pages a request belongs to.
+
+    This is the entity set name, followed by `#` and the partition number
+    for partitioned entity sets.
+    """
+    if meta.get('partition') is None:
+        return meta['entity_set']
+    return '{}#{}'.format(meta['entity_set'], meta['partition'])
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
@@ -0,0 +1,231 @@
+"""Index of the request fingerprints held in the S3 cache.
+
+The index lets the cache storage answer misses in memory, rather than with
+S3 requests that return 404s.  It is held in memory as a Bloom filter, so
+false positives (which just cost an S3 request) are possible but false
+negatives are not.
+
+The index is persisted in S3 as a base object listing every fingerprint,
+plus delta objects holding the fingerprints stored by each crawl since the
+base was written.  A crawl writes a delta for every `flush_size`
+fingerprints it stores, and one for the rest when it closes.  If a crawl
+dies, the fingerprints it stored since its last delta are missing from the
+index (so those responses would be fetched again) until it is rebuilt.
+The base is built by listing the whole cache prefix, which is also done
+automatically if no index exists yet.
+
+Usage:
+
+    python -m scraper.index rebuild
+    python -m scraper.index footprint [-n 1000000]
+"""
+import argparse
+import binascii
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import zlib
+
+import botocore
+
+from scrapy.utils.project import get_project_settings
+
+from scraper import s3
+
+logger = logging.getLogger(__name__)
+
+index_key_prefix = "INDEX"
+base_key = "{}/fingerprints".format(index_key_prefix)
+delta_key_prefix = "{}/delta/".format(index_key_prefix)
+
+# Objects whose presence means that a fingerprint is cached
+marker_filenames = ('record', 'pickled_meta')
+
+_digest_size = 20
+
+
+class BloomFilter:
+    """A Bloom filter of SHA1 digests.
+
+    As the items are already uniformly distributed hashes, bit positions are
+    derived from the digest itself rather than by re-hashing it.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """Initialises an empty filter sized for `capacity` items."""
+        capacity = max(capacity, 1)
+        self.num_bits = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest):
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:16], 'big') | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, digest):
+        """Adds a digest to the filter."""
+        for position in self._positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        """Returns whether the digest may have been added to the filter."""
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(digest))
+
+
+class FingerprintIndex:
+    """In-memory index of cached fingerprints, backed by objects in S3.
+
+    Fingerprints can be added and saved from any thread.
+    """
+
+    def __init__(self, bucket, capacity=2000000, error_rate=0.001, flush_size=1000):
+        """Initialises an empty index for a bucket."""
+        self.bucket = bucket
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.flush_size = flush_size
+        self.filter = BloomFilter(capacity, error_rate)
+        self.added = []
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Loads the index from S3, building it first if it doesn't exist."""
+        start = time.time()
+        try:
+            digests = _unpack_digests(s3.get_object(self.bucket, base_key))
+        except botocore.exceptions.ClientError as e:
+            if not s3.is_not_found(e):
+                raise
+            logger.info('No cache index found, building one')
+            digests = rebuild(self.bucket)
+        for key in s3.list_keys(self.bucket, delta_key_prefix):
+            digests.extend(_unpack_digests(s3.get_object(self.bucket, key)))
+
+        self.filter = BloomFilter(max(self.capacity, 2 * len(digests)), self.error_rate)
+        for digest in digests:
+            self.filter.add(digest)
+        logger.info('Loaded cache index of %d fingerprints (%d bytes) in %.1fs',
+                    len(digests), len(self.filter.bits), time.time() - start)
+
+    def add(self, fingerprint):
+        """Records that a fingerprint has been stored in the cache."""
+        digest = binascii.unhexlify(fingerprint)
+        with self._lock:
+            self.filter.add(digest)
+            self.added.append(digest)
+
+    def __contains__(self, fingerprint):
+        """Returns whether a fingerprint may be in the cache."""
+        return binascii.unhexlify(fingerprint) in self.filter
+
+    def flush(self):
+        """Saves the fingerprints added, once there are `flush_size` of them."""
+        if len(self.added) >= self.flush_size:
+            self.save()
+
+    def save(self):
+        """Writes fingerprints added since the last save to a delta object."""
+        with self._lock:
+            added, self.added = self.added, []
+        if not added:
+            return
+        key = '{}{:.0f}-{}'.format(delta_key_prefix, time.time(), uuid.uuid4().hex)
+        try:
+            s3.put_object(self.bucket, key, _pack_digests(added))
+        except Exception:
+            with self._lock:
+                self.added[:0] = added
+            raise
+        logger.info('Saved %d new fingerprints to the cache index', len(added))
+
+
+def rebuild(bucket, prefix='CACHE/'):
+    """Rebuilds the base index by listing the cache, and removes deltas.
+
+    Returns the list of fingerprint digests found.
+    """
+    deltas = list(s3.list_keys(bucket, delta_key_prefix))
+    digests = set()
+    for num_keys, key in enumerate(s3.list_keys(bucket, prefix), 1):
+        parts = key.rsplit('/', 2)
+        if len(parts) == 3 and parts[2] in marker_filenames:
+            try:
+                digests.add(binascii.unhexlify(parts[1]))
+            except (binascii.Error, ValueError):
+                logger.warning('Ignoring unexpected cache key: %s', key)
+        if num_keys % 100000 == 0:
+            logger.info('Listed %d keys, found %d fingerprints', num_keys, len(digests))
+
+    digests = sorted(digests)
+    s3.put_object(bucket, base_key, _pack_digests(digests))
+    if deltas:
+        bucket.delete_objects(Delete={'Objects': [{'Key': key} for key in deltas]})
+    logger.info('Rebuilt cache index of %d fingerprints', len(digests))
+    return digests
+
+
+def footprint(count, error_rate=0.001):
+    """Measures the memory used to index `count` fingerprints.
+
+    Returns a dict of sizes in bytes for the Bloom filter, compared to a
+    set holding the digests themselves.
+    """
+    tracemalloc.start()
+    digests = {os.urandom(_digest_size) for _ in range(count)}
+    set_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = time.time()
+    bloom = BloomFilter(count, error_rate)
+    for digest in digests:
+        bloom.add(digest)
+
+    return {
+        'fingerprints': count,
+        'bloom_filter_bytes': sys.getsizeof(bloom.bits),
+        'bloom_filter_hashes': bloom.num_hashes,
+        'bloom_filter_load_seconds': round(time.time() - start, 1),
+        'set_of_digests_bytes': set_bytes,
+        'persisted_bytes': len(_pack_digests(sorted(digests))),
+    }
+
+
+def _pack_digests(digests):
+    return zlib.compress(b''.join(digests))
+
+
+def _unpack_digests(data):
+    data = zlib.decompress(data)
+    return [data[i:i + _digest_size] for i in range(0, len(data), _digest_size)]
+
+
+def main(argv=None):
+    """Rebuilds the index, or reports its memory footprint."""
+    parser = argparse.ArgumentParser(description='Manage the S3 cache index.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('rebuild', help='rebuild the index by listing the cache')
+    footprint_parser = subparsers.add_parser('footprint', help='report the memory used by the index')
+    footprint_parser.add_argument('-n', type=int, default=1000000, help='number of fingerprints')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'rebuild':
+        rebuild(s3.get_bucket(get_project_settings()))
+    else:
+        for name, value in footprint(args.n).items():
+            sys.stdout.write('{}: {}\n'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,13 @@ import scrapy
 
 
 class ScraperItem(scrapy.Item):
-    """Placeholder model for a scraper item."""
+    """A record from an OData entity collection."""
 
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+    # name of the entity set the record was read from, e.g. ContactSet
+    entity_set = scrapy.Field()
+    # short name of the record's type, e.g. Contact
+    entity_type = scrapy.Field()
+    # the record's URI (from __metadata.uri)
+    uri = scrapy.Field()
+    # the record itself, as decoded from the response
+    data = scrapy.Field()
@@ -0,0 +1,291 @@
+import logging
+from email.utils import formatdate
+
+from redis import StrictRedis
+from scrapy import signals
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+
+from twisted.internet import defer
+
+from scraper.sessions import FileSessionStore, RedisSessionStore, SessionManager
+from scraper.throttle import AimdController, ERROR, OK, REDIRECT
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredHttpCacheMiddleware(HttpCacheMiddleware):
+    """HTTP cache middleware for storages that return Deferreds.
+
+    Scrapy's `HttpCacheMiddleware` expects `retrieve_response` to return a
+    response synchronously.  This variant also accepts a Deferred, letting
+    the storage do its I/O without blocking the reactor (see
+    `scraper.storage.AsyncS3CacheStorage`).  Deferreds returned by
+    `store_response` are waited on too, which lets the storage apply
+    back-pressure when too many writes are pending.
+    """
+
+    def spider_closed(self, spider):
+        """Closes the storage, waiting for it to finish if necessary."""
+        return self.storage.close_spider(spider)
+
+    def process_request(self, request, spider):
+        """Looks up a request in the cache."""
+        if request.meta.get('dont_cache', False):
+            return None
+
+        # Skip uncacheable requests
+        if not self.policy.should_cache_request(request):
+            request.meta['_dont_cache'] = True  # flag as uncacheable
+            return None
+
+        d = defer.maybeDeferred(self.storage.retrieve_response, spider, request)
+        d.addCallback(self._process_cached_response, request, spider)
+        return d
+
+    def _process_cached_response(self, cachedresponse, request, spider):
+        if cachedresponse is None:
+            self.stats.inc_value('httpcache/miss', spider=spider)
+            if self.ignore_missing:
+                self.stats.inc_value('httpcache/ignore', spider=spider)
+                raise IgnoreRequest('Ignored request not in cache: {}'.format(request))
+            return None  # first time request
+
+        # Return cached response only if not expired
+        cachedresponse.flags.append('cached')
+        if self.policy.is_cached_response_fresh(cachedresponse, request):
+            self.stats.inc_value('httpcache/hit', spider=spider)
+            return cachedresponse
+
+        # Keep a reference to cached response to avoid a second cache lookup on
+        # process_response hook
+        request.meta['cached_response'] = cachedresponse
+        return None
+
+    def process_response(self, request, response, spider):
+        """Stores a response in the cache, waiting for the storage if asked.
+
+        This follows `HttpCacheMiddleware.process_response`, but returns the
+        Deferred returned by the storage's `store_response` (if any), firing
+        with the response once the storage is ready for more.
+        """
+        if request.meta.get('dont_cache', False):
+            return response
+
+        # Skip cached responses and uncacheable requests
+        if 'cached' in response.flags or '_dont_cache' in request.meta:
+            request.meta.pop('_dont_cache', None)
+            return response
+
+        # RFC2616 requires origin server to set Date header
+        if 'Date' not in response.headers:
+            response.headers['Date'] = formatdate(usegmt=True)
+
+        # Do not validate first-hand responses
+        cachedresponse = request.meta.pop('cached_response', None)
+        if cachedresponse is None:
+            self.stats.inc_value('httpcache/firsthand', spider=spider)
+        elif self.policy.is_cached_response_valid(cachedresponse, response, request):
+            self.stats.inc_value('httpcache/revalidate', spider=spider)
+            return cachedresponse
+        else:
+            self.stats.inc_value('httpcache/invalidate', spider=spider)
+
+        if not self.policy.should_cache_response(response, request):
+            self.stats.inc_value('httpcache/uncacheable', spider=spider)
+            return response
+        self.stats.inc_value('httpcache/store', spider=spider)
+        d = self.storage.store_response(spider, request, response)
+        if isinstance(d, defer.Deferred):
+            d.addCallback(lambda _: response)
+            return d
+        return response
+
+
+class ReplayMiddleware:
+    """Stops requests not answered from the HTTP cache from being downloaded.
+
+    With `CACHE_REPLAY` enabled, a crawl is replayed entirely from the HTTP
+    cache, without logging in to or making requests of CDMS.  This takes the
+    place of the session middleware (after the HTTP cache middleware), so
+    only cache misses reach it.  They are counted (as `replay/miss`) and
+    ignored, and if `CACHE_REPLAY_FAIL_FAST` is enabled, the first one
+    closes the spider.
+    """
+
+    def __init__(self, crawler):
+        """Initialises the middleware."""
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.fail_fast = crawler.settings.getbool('CACHE_REPLAY_FAIL_FAST')
+        self._closing = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Creates the middleware, if enabled."""
+        if not crawler.settings.getbool('CACHE_REPLAY'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        """Ignores a request that wasn't found in the cache."""
+        self.stats.inc_value('replay/miss', spider=spider)
+        if self.fail_fast:
+            if not self._closing:
+                self._closing = True
+                logger.error('Closing spider on cache miss for URL: %s', request.url)
+                self.crawler.engine.close_spider(spider, 'cache_miss')
+        else:
+            logger.warning('Cache miss for URL: %s', request.url)
+        raise IgnoreRequest('Not in cache: {}'.format(request.url))
+
+
+class SessionMiddleware:
+    """Adds the cookies of an authenticated session to each request.
+
+    Sessions are created by calling the spider's `login()` method, which
+    returns a dict of cookies, and are shared between requests by a
+    `scraper.sessions.SessionManager`.  A 302 response means the session was
+    not accepted (CDMS redirects to the login page), so the session is
+    invalidated, and the spider's retry of the request gets a new one.
+
+    Sessions are saved to the store given by `SESSION_STORE` (`file` or
+    `redis`), and reused if the spider's `check_session()` method accepts
+    them.  Sessions saved to Redis are encrypted with `SESSION_STORE_KEY`,
+    without which the Redis store can't be used.
+
+    This should come after the HTTP cache middleware, so that no session is
+    needed for responses served from the cache.
+    """
+
+    def __init__(self, settings, stats):
+        """Initialises the middleware."""
+        self.settings = settings
+        self.stats = stats
+        self.manager = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Creates the middleware."""
+        if crawler.settings.get('SESSION_STORE') == 'redis' and not crawler.settings.get('SESSION_STORE_KEY'):
+            raise ValueError('SESSION_STORE=redis needs SESSION_STORE_KEY to be set')
+        middleware = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        return middleware
+
+    def spider_opened(self, spider):
+        """Creates the pool of sessions for the spider (if it can log in)."""
+        if hasattr(spider, 'login'):
+            self.manager = SessionManager(
+                spider.login,
+                pool_size=self.settings.getint('SESSION_POOL_SIZE', 1),
+                max_age=self.settings.getfloat('SESSION_MAX_AGE') or None,
+                stats=self.stats,
+                store=self._make_store(),
+                probe=getattr(spider, 'check_session', None))
+
+    def process_request(self, request, spider):
+        """Adds a session's cookies to a request, logging in if necessary."""
+        if self.manager is None:
+            return None
+        d = self.manager.get()
+        d.addCallback(self._add_session, request)
+        return d
+
+    def process_response(self, request, response, spider):
+        """Invalidates the request's session if it was not accepted."""
+        session = request.meta.get('session')
+        if session is not None and response.status == 302:
+            self.manager.invalidate(session)
+        return response
+
+    def _make_store(self):
+        store = self.settings.get('SESSION_STORE')
+        if store == 'file':
+            return FileSessionStore(self.settings['SESSION_STORE_PATH'])
+        if store == 'redis':
+            return RedisSessionStore(StrictRedis(
+                host=self.settings['REDIS_HOST'],
+                port=self.settings['REDIS_PORT'],
+                db=self.settings['REDIS_DB']), self.settings['SESSION_STORE_KEY'])
+        return None
+
+    def _add_session(self, session, request):
+        request.meta['session'] = session
+        request.headers['Cookie'] = session.cookie_header()
+        return None
+
+
+class AdaptiveConcurrencyMiddleware:
+    """Adjusts the concurrency of each download slot to the server's health.
+
+    Each download slot (i.e. server) has an `scraper.throttle.AimdController`
+    fed with the latency and status of its responses, and with download
+    errors, which sets the slot's concurrency.  Responses from the HTTP
+    cache are ignored.
+
+    This should come after the session middleware, so that it sees the 302s
+    from expired sessions.
+    """
+
+    def __init__(self, settings, stats, downloader):
+        """Initialises the middleware."""
+        self.settings = settings
+        self.stats = stats
+        self.downloader = downloader
+        self.controllers = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Creates the middleware, if enabled."""
+        if not crawler.settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.settings, crawler.stats, lambda: crawler.engine.downloader)
+
+    def process_response(self, request, response, spider):
+        """Records the outcome of a download."""
+        latency = request.meta.get('download_latency')
+        if 'cached' in response.flags or latency is None:
+            return response
+        if response.status == 302:
+            outcome = REDIRECT
+        elif response.status == 403 or response.status >= 500:
+            outcome = ERROR
+        else:
+            outcome = OK
+        self._record(request, outcome, latency)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        """Records a failed download."""
+        if not isinstance(exception, IgnoreRequest):
+            self._record(request, ERROR, None)
+
+    def _record(self, request, outcome, latency):
+        key = request.meta.get('download_slot')
+        slot = self.downloader().slots.get(key)
+        if slot is None:
+            return
+        controller = self.controllers.get(key)
+        if controller is None:
+            controller = self.controllers[key] = AimdController(
+                minimum=self.settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1),
+                maximum=self.settings.getint('ADAPTIVE_CONCURRENCY_MAX', 64),
+                start=slot.concurrency,
+                decrease_factor=self.settings.getfloat('ADAPTIVE_CONCURRENCY_DECREASE_FACTOR', 0.5),
+                target_latency=self.settings.getfloat('ADAPTIVE_CONCURRENCY_TARGET_LATENCY') or None,
+                latency_factor=self.settings.getfloat('ADAPTIVE_CONCURRENCY_LATENCY_FACTOR', 2.0))
+
+        reason = controller.record(outcome, latency)
+        if reason is not None:
+            self.stats.inc_value('adaptive_concurrency/decreases/{}'.format(reason))
+        if controller.slots != slot.concurrency:
+            logger.info('Concurrency for %s: %d -> %d (latency %.2fs%s)', key, slot.concurrency,
+                        controller.slots, controller.latency or 0,
+                        ', {}'.format(reason) if reason else '')
+            slot.concurrency = controller.slots
+        self.stats.inc_value('adaptive_concurrency/{}'.format(outcome))
+        self.stats.set_value('adaptive_concurrency/concurrency/{}'.format(key), controller.slots)
+        self.stats.max_value('adaptive_concurrency/concurrency_max', controller.slots)
+        if controller.latency is not None:
+            self.stats.set_value('adaptive_concurrency/latency_ms/{}'.format(key), round(controller.latency * 1000))
@@ -2,11 +2,80 @@
 #
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
+import collections
+import logging
+import os
+import time
 
+from scraper import collect
+from scraper.coordinator import default_worker_id
 
-class ScraperPipeline:
-    """Example scraper pipeline class."""
+logger = logging.getLogger(__name__)
+
+
+class ExportPipeline:
+    """Writes scraped records to one file per entity type.
+
+    Records are buffered per entity type and written `EXPORT_BATCH_SIZE` at
+    a time, in the same formats as `scraper.collect` (set by
+    `EXPORT_FORMAT`), to files in `EXPORT_DIR`.
+
+    Each run of each worker writes its own files, named for the time the
+    spider opened and the worker, e.g.
+    `Contact.20170214T130000-worker1.jsonlines`, so that workers sharing a
+    crawl never write to the same file, and re-runs don't append to earlier
+    exports.  The files are written in a hidden directory, and moved into
+    `EXPORT_DIR` when the spider closes.
+    """
+
+    def __init__(self, output_dir, output_format='jsonlines', batch_size=1000, max_open=64, worker_id=None):
+        """Initialises the pipeline."""
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.batch_size = batch_size
+        self.max_open = max_open
+        self.worker_id = worker_id or default_worker_id()
+        self.encode = collect.formats[output_format][2]
+        self.writers = None
+        self.run_dir = None
+        self._batches = collections.defaultdict(list)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Creates the pipeline from the crawler settings."""
+        settings = crawler.settings
+        return cls(
+            settings['EXPORT_DIR'],
+            output_format=settings.get('EXPORT_FORMAT', 'jsonlines'),
+            batch_size=settings.getint('EXPORT_BATCH_SIZE', 1000),
+            worker_id=settings.get('WORKER_ID'))
+
+    def open_spider(self, spider):
+        """Opens the output files."""
+        run_id = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), self.worker_id)
+        self.run_dir = os.path.join(self.output_dir, '.' + run_id)
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.writers = collect.WriterPool(
+            self.run_dir, max_open=self.max_open, suffix='.' + run_id, output_format=self.output_format)
+
+    def close_spider(self, spider):
+        """Writes any buffered records, and moves the output files into place."""
+        for entity_type in list(self._batches):
+            self._flush(entity_type)
+        self.writers.close()
+        for filename in sorted(os.listdir(self.run_dir)):
+            os.replace(os.path.join(self.run_dir, filename), os.path.join(self.output_dir, filename))
+        os.rmdir(self.run_dir)
 
     def process_item(self, item, spider):
-        """Callback method to process an item."""
+        """Buffers a record, writing the buffer once it is full."""
+        batch = self._batches[item['entity_type']]
+        batch.append(self.encode(item['data']))
+        if len(batch) >= self.batch_size:
+            self._flush(item['entity_type'])
         return item
+
+    def _flush(self, entity_type):
+        batch = self._batches.pop(entity_type)
+        self.writers.write(entity_type, batch)
+        logger.debug('Wrote %d %s records', len(batch), entity_type)
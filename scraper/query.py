@@ -0,0 +1,93 @@
+"""Helpers for building OData request URLs."""
+import fnmatch
+import urllib.parse
+
+# Characters left unescaped in query options, for readable URLs (and cache
+# keys) such as `ContactSet?$skip=100&$top=50`
+_safe = "$',()"
+
+
+def with_query(url, **options):
+    """Returns `url` with OData query options added (or replaced).
+
+    Option names are given without the `$` prefix, and options set to None
+    are removed.
+
+    >>> with_query('http://x/ContactSet?$top=5', skip=10, top=None)
+    'http://x/ContactSet?$skip=10'
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = dict(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+    for name, value in options.items():
+        if value is None:
+            query.pop('$' + name, None)
+        else:
+            query['$' + name] = str(value)
+    query = urllib.parse.urlencode(query, safe=_safe, quote_via=urllib.parse.quote)
+    return urllib.parse.urlunsplit(parts._replace(query=query))
+
+
+def count_url(url):
+    """Returns the URL giving the number of entities in an entity set."""
+    parts = urllib.parse.urlsplit(url)
+    return urllib.parse.urlunsplit(parts._replace(path=parts.path.rstrip('/') + '/$count'))
+
+
+def counted_url(url):
+    """Returns the entity set URL a `$count` URL counts, without its query options.
+
+    >>> counted_url("http://x/ContactSet/$count?$filter=Name eq 'a'")
+    'http://x/ContactSet'
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path.rstrip('/')
+    if path.endswith('/$count'):
+        path = path[:-len('/$count')]
+    return urllib.parse.urlunsplit(parts._replace(path=path, query=''))
+
+
+def entity_set_name(path):
+    """Returns the name of the entity set a URL (or cache key) refers to.
+
+    >>> entity_set_name('http://x/OrganizationData.svc/ContactSet?$skiptoken=1')
+    'ContactSet'
+    """
+    _, _, rest = path.partition(".svc/")
+    for separator in ("?", "(", "/"):
+        rest = rest.split(separator, 1)[0]
+    return rest
+
+
+def is_included(name, include=(), exclude=()):
+    """Returns whether an entity set is to be crawled.
+
+    `include` and `exclude` are lists of names, which may contain shell
+    style wildcards.  If `include` is empty, all sets not excluded are
+    crawled.
+
+    >>> is_included('ContactSet', include=['Contact*'], exclude=['*BaseSet'])
+    True
+    """
+    if include and not any(fnmatch.fnmatchcase(name, pattern) for pattern in include):
+        return False
+    return not any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude)
+
+
+def with_entity_set_options(url, options):
+    """Returns an entity set URL with its configured query options.
+
+    `options` may hold `select` (a list of property names), `filter` (an
+    OData filter expression) and `top` (the maximum number of entities to
+    crawl).  Options that aren't configured are left as they are in the
+    URL, and only the filter applies to `$count` URLs.
+
+    >>> with_entity_set_options('http://x/ContactSet', {'select': ['FirstName', 'LastName']})
+    'http://x/ContactSet?$select=FirstName,LastName'
+    """
+    names = ('filter',) if urllib.parse.urlsplit(url).path.endswith('/$count') else ('select', 'filter', 'top')
+    options = {name: options[name] for name in names if options.get(name) is not None}
+    if not options:
+        return url
+    if not isinstance(options.get('select', ''), str):
+        options['select'] = ','.join(options['select'])
+    return with_query(url, **options)
@@ -0,0 +1,277 @@
+"""Packed cache record format.
+
+A record holds everything the HTTP cache knows about one request in a single
+object, so that it can be stored and retrieved with one S3 call:
+
+    +-------+---------+-------+-------------+----------+--------------------------------------+
+    | magic | version | flags | meta length | metadata | sections (4 byte length + data, ...) |
+    +-------+---------+-------+-------------+----------+--------------------------------------+
+
+The metadata is JSON encoded (see below), and is never compressed, so that
+it can be read from just the start of a record (e.g. with an S3 range
+request) without reading the rest.  The other sections always appear in the
+order given by `sections`.  The flags say how they are compressed: with
+zlib (`FLAG_ZLIB`), gzip (`FLAG_GZIP`) or Zstandard (`FLAG_ZSTD`), or not at
+all if no flag is set.  Zstandard needs the `compression.zstd` module
+(Python 3.14 onwards, or the `backports.zstd` package).
+
+Version 1 records, in which the metadata was stored (and compressed) as the
+first section, are still read.
+
+The metadata of a response holds:
+
+- `version`: the version of this schema (`METADATA_VERSION`);
+- `url` and `method`: the request's URL and method;
+- `status`, `response_url` and `timestamp`: the response's status, URL and
+  the time it was cached;
+- `body_sha256`, `body_length` and `encoding`: the SHA-256 digest, length
+  and character encoding of the response body.
+
+Metadata written before versioning (which has no `version`) only holds the
+request and response fields.
+
+Records can be unpacked from bytes, or read from a file object, which
+reads and decompresses them a chunk at a time straight into their sections,
+so neither the whole compressed record nor a decompressed copy of it is
+held alongside the sections (see `benchmarks.cache_compression`).
+"""
+import ast
+import io
+import json
+import struct
+import zlib
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+MAGIC = b'SCR'
+VERSION = 2
+METADATA_VERSION = 2
+
+# Name of the object holding the record, under a request's storage path
+filename = 'record'
+
+FLAG_ZLIB = 0x01
+FLAG_GZIP = 0x02
+FLAG_ZSTD = 0x04
+
+# Compression codecs, as (flag, default level)
+codecs = {
+    'zlib': (FLAG_ZLIB, 6),
+    'gzip': (FLAG_GZIP, 6),
+    'zstd': (FLAG_ZSTD, 3),
+}
+
+sections = [
+    'meta',
+    'request_headers',
+    'request_body',
+    'response_headers',
+    'response_body']
+
+_header = struct.Struct('>3sBB')
+_length = struct.Struct('>I')
+
+# Size of the chunks records are read in
+_chunk_size = 256 * 1024
+
+
+class RecordError(ValueError):
+    """Raised when data cannot be decoded as a cache record."""
+
+
+def is_record(data):
+    """Returns whether `data` starts with a record header."""
+    return data[:len(MAGIC)] == MAGIC
+
+
+def codec_name(compress):
+    """Returns the name of the codec selected by a `compress` argument.
+
+    `compress` is a codec name, True for zlib, or False, None or `'none'`
+    for no compression.  Raises ValueError for unknown or unavailable
+    codecs.
+    """
+    if compress is True:
+        return 'zlib'
+    if not compress or compress == 'none':
+        return None
+    if compress not in codecs:
+        raise ValueError('Unknown compression codec: {}'.format(compress))
+    if compress == 'zstd' and zstd is None:
+        raise ValueError('Zstandard compression needs the backports.zstd package')
+    return compress
+
+
+def pack(metadata, parts, compress=False, level=None):
+    """Packs metadata and raw request/response parts into a record.
+
+    `parts` maps each of the non-metadata section names to bytes; missing
+    parts are stored as empty sections.  The sections are compressed as
+    given by `compress` (see `codec_name()`), at `level` (or the codec's
+    default level).
+    """
+    meta = json.dumps(metadata, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    payload = b''.join(
+        _length.pack(len(value)) + value for value in (parts.get(name) or b'' for name in sections[1:]))
+    codec = codec_name(compress)
+    flags = 0
+    if codec is not None:
+        flags, default_level = codecs[codec]
+        payload = _compress(codec, payload, default_level if level is None else level)
+    return _header.pack(MAGIC, VERSION, flags) + _length.pack(len(meta)) + meta + payload
+
+
+def unpack(data):
+    """Unpacks a record into a `(metadata, parts)` tuple."""
+    version, flags = _check_header(data)
+    view = memoryview(data)
+    values, offset = [], _header.size
+    if version > 1:
+        values, offset = _split(view, offset, 1)
+
+    payload = view[offset:]
+    if flags:
+        payload = memoryview(_decompressor(flags).decompress(payload))
+    values.extend(_split(payload, 0, len(sections) - len(values))[0])
+    return _entry(values)
+
+
+def unpack_metadata(data):
+    """Returns the metadata of a record, given the record or just its start.
+
+    Raises RecordError if `data` doesn't hold all of the metadata.
+    """
+    version, flags = _check_header(data)
+    payload = memoryview(data)[_header.size:]
+    if version == 1 and flags:
+        # Decompress as much of the record as is given
+        payload = memoryview(_decompressor(flags).decompress(payload))
+    [meta], _ = _split(payload, 0, 1)
+    return json.loads(meta.decode('utf-8'))
+
+
+def read(fileobj):
+    """Reads a record from a file object into a `(metadata, parts)` tuple.
+
+    The record is read and decompressed a chunk at a time.
+    """
+    version, flags = _check_header(fileobj.read(_header.size))
+    values = []
+    if version > 1:
+        values.append(_SectionReader(fileobj, 0).read_section())
+    reader = _SectionReader(fileobj, flags)
+    while len(values) < len(sections):
+        values.append(reader.read_section())
+    return _entry(values)
+
+
+def parse_legacy_metadata(data):
+    """Returns the metadata of an entry cached with the legacy layout.
+
+    This is read from the `repr()` of the metadata, as a Python literal,
+    rather than unpickled, as unpickling data could run arbitrary code.
+    """
+    try:
+        return ast.literal_eval(data.decode('utf-8'))
+    except (ValueError, SyntaxError):
+        raise RecordError('Invalid legacy metadata')
+
+
+class _SectionReader:
+    def __init__(self, fileobj, flags):
+        self._fileobj = fileobj
+        self._decompressor = _decompressor(flags) if flags else None
+        self._buffer = b''
+
+    def read_section(self):
+        (size,) = _length.unpack(self.read(_length.size))
+        return self.read(size)
+
+    def read(self, size):
+        if self._decompressor is None and not self._buffer:
+            value = self._fileobj.read(size)
+            if len(value) < size:
+                raise RecordError('Truncated cache record')
+            return value
+        if len(self._buffer) >= size:
+            value, self._buffer = self._buffer[:size], self._buffer[size:]
+            return value
+        # BytesIO returns its buffer without copying it
+        value = io.BytesIO()
+        value.write(self._buffer)
+        needed = size - len(self._buffer)
+        self._buffer = b''
+        while needed > 0:
+            chunk = self._read_chunk(needed)
+            if not chunk:
+                raise RecordError('Truncated cache record')
+            if len(chunk) > needed:
+                chunk, self._buffer = chunk[:needed], chunk[needed:]
+            value.write(chunk)
+            needed -= len(chunk)
+        return value.getvalue()
+
+    def _read_chunk(self, needed):
+        if self._decompressor is None:
+            return self._fileobj.read(needed)
+        chunk = b''
+        while not chunk:
+            data = self._fileobj.read(_chunk_size)
+            if not data:
+                return b''
+            chunk = self._decompressor.decompress(data)
+        return chunk
+
+
+def _check_header(data):
+    if len(data) < _header.size or not is_record(data):
+        raise RecordError('Not a cache record')
+    _, version, flags = _header.unpack_from(data)
+    if version > VERSION:
+        raise RecordError('Unsupported record version: {}'.format(version))
+    if flags not in (0, FLAG_ZLIB, FLAG_GZIP, FLAG_ZSTD):
+        raise RecordError('Unsupported record flags: {:#x}'.format(flags))
+    return version, flags
+
+
+def _split(payload, offset, count):
+    # Returns `count` sections from `payload`, and the offset after them
+    values = []
+    for _ in range(count):
+        if offset + _length.size > len(payload):
+            raise RecordError('Truncated cache record')
+        (size,) = _length.unpack_from(payload, offset)
+        offset += _length.size
+        if offset + size > len(payload):
+            raise RecordError('Truncated cache record')
+        values.append(bytes(payload[offset:offset + size]))
+        offset += size
+    return values, offset
+
+
+def _entry(values):
+    metadata = json.loads(values[0].decode('utf-8'))
+    parts = dict(zip(sections[1:], values[1:]))
+    return metadata, parts
+
+
+def _compress(codec, payload, level):
+    if codec == 'zstd':
+        return zstd.compress(payload, level=level)
+    # zlib streams have a zlib header, and gzip streams a gzip one
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if codec == 'gzip' else 15)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def _decompressor(flags):
+    if flags == FLAG_ZSTD:
+        if zstd is None:
+            raise RecordError('Reading Zstandard compressed records needs the backports.zstd package')
+        return zstd.ZstdDecompressor()
+    return zlib.decompressobj(31 if flags == FLAG_GZIP else 15)
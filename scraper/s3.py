@@ -0,0 +1,71 @@
+"""Helpers for working with the S3 cache bucket outside of a crawl."""
+import io
+
+import boto3
+
+from scraper import record
+
+# Number of bytes read from the start of a cache record for its metadata
+METADATA_READ_SIZE = 4096
+
+
+def get_bucket(settings):
+    """Returns the S3 cache bucket."""
+    bucket_name = settings['S3CACHE_BUCKET']
+    assert bucket_name, "No bucket configured"
+    s3 = boto3.resource('s3', region_name=settings['AWS_REGION'])
+    return s3.Bucket(bucket_name)
+
+
+def is_not_found(error):
+    """Returns whether a botocore `ClientError` is for a missing object."""
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey')
+
+
+def list_objects(bucket, prefix):
+    """Yields the summary of every object under `prefix`.
+
+    Each summary is a dict with (at least) `Key`, `Size` and `LastModified`
+    entries.  Objects are listed a page (of up to 1000) at a time, in key
+    order.
+    """
+    paginator = bucket.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket.name, Prefix=prefix):
+        yield from page.get('Contents', ())
+
+
+def list_keys(bucket, prefix):
+    """Yields the key of every object under `prefix`."""
+    for obj in list_objects(bucket, prefix):
+        yield obj['Key']
+
+
+def get_object(bucket, key, size=None):
+    """Returns the contents of an object, or its first `size` bytes.
+
+    This uses the (thread safe) S3 client, so can be called from any thread.
+    """
+    if size is None:
+        return bucket.meta.client.get_object(Bucket=bucket.name, Key=key)['Body'].read()
+    return bucket.meta.client.get_object(
+        Bucket=bucket.name, Key=key, Range='bytes=0-{}'.format(size - 1))['Body'].read()
+
+
+def get_metadata(bucket, key):
+    """Returns the metadata of a cache record, without reading its body.
+
+    Only the start of the record is read, unless its metadata is larger (or
+    the record is an old one, with compressed metadata).
+    """
+    data = get_object(bucket, key, size=METADATA_READ_SIZE)
+    try:
+        return record.unpack_metadata(data)
+    except record.RecordError:
+        if len(data) < METADATA_READ_SIZE:
+            raise
+    return record.unpack_metadata(get_object(bucket, key))
+
+
+def put_object(bucket, key, data):
+    """Uploads an object."""
+    bucket.upload_fileobj(io.BytesIO(data), key)
@@ -0,0 +1,226 @@
+"""Management of authenticated sessions with the OData service.
+
+Logging in to CDMS takes several round trips through ADFS, so sessions are
+shared between requests, and logins are run in a thread rather than on the
+reactor.  Logins are single-flighted: however many requests find a session
+has expired at once, it is only replaced by one login.
+
+Sessions can also be saved to a store (a file, or Redis), so that they are
+reused by later runs and by other workers rather than logging in again.
+Session files are only readable by their owner, and sessions saved to
+Redis are encrypted.
+"""
+import json
+import logging
+import os
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from twisted.internet import defer, threads
+
+from scraper import crawlstats
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """The cookies of a logged in session, and when it was created."""
+
+    def __init__(self, cookies, slot, created):
+        """Initialises the session."""
+        self.cookies = cookies
+        self.slot = slot
+        self.created = created
+
+    def cookie_header(self):
+        """Returns the value of the Cookie header for the session."""
+        return '; '.join('{}={}'.format(name, value) for name, value in sorted(self.cookies.items()))
+
+
+class SessionManager:
+    """A pool of sessions, handed out to requests in turn.
+
+    `login` is called (in a thread) to create each session, and returns a
+    dict of its cookies.  Sessions are created when first needed, and
+    replaced once invalidated.  If `max_age` is given, sessions older than
+    that are refreshed in the background, while still being handed out until
+    their replacement is ready.
+
+    If a `store` is given, new sessions are saved to it, and a saved session
+    is used instead of logging in if it is younger than `max_age` and passes
+    `probe` (called with its cookies, in a thread, returning whether the
+    service accepts them).
+    """
+
+    def __init__(self, login, pool_size=1, max_age=None, stats=None, store=None, probe=None,
+                 clock=time.monotonic):
+        """Initialises an empty pool."""
+        self.login = login
+        self.pool_size = max(pool_size, 1)
+        self.max_age = max_age
+        self.stats = stats
+        self.store = store
+        self.probe = probe
+        self._clock = clock
+        self._sessions = [None] * self.pool_size
+        self._waiters = {}
+        self._next_slot = 0
+
+    def get(self):
+        """Returns a Deferred firing with the next session in the pool."""
+        slot = self._next_slot
+        self._next_slot = (slot + 1) % self.pool_size
+        session = self._sessions[slot]
+        if session is None:
+            return self._refresh(slot)
+        if self.max_age and slot not in self._waiters and self._clock() - session.created >= self.max_age:
+            # Failures are logged, and the old session is still handed out
+            self._refresh(slot).addErrback(lambda failure: None)
+        return defer.succeed(session)
+
+    def invalidate(self, session):
+        """Discards a session that the service no longer accepts.
+
+        This does nothing if the session has already been replaced.
+        """
+        if self._sessions[session.slot] is not session:
+            return
+        logger.info('Session %d expired after %.0fs', session.slot, self._clock() - session.created)
+        self._sessions[session.slot] = None
+        self._inc_stat('sessions/invalidated')
+        self._refresh(session.slot, rejected=session.cookies)
+
+    def _refresh(self, slot, rejected=None):
+        """Logs in to replace a session, unless a login is already running.
+
+        Returns a Deferred firing with the new session.
+        """
+        waiter = defer.Deferred()
+        if slot in self._waiters:
+            self._waiters[slot].append(waiter)
+            return waiter
+
+        self._waiters[slot] = [waiter]
+        logger.info('Logging in session %d', slot)
+        d = threads.deferToThread(self._create, slot, rejected)
+        d.addCallbacks(self._logged_in, self._login_failed, callbackArgs=(slot,), errbackArgs=(slot,))
+        return waiter
+
+    def _create(self, slot, rejected):
+        """Returns the cookies and age of a saved session, or of a new one.
+
+        The time taken to log in is returned too (or None for a saved session).
+
+        (This is run in a thread.)
+        """
+        if self.store is not None:
+            saved = self.store.load(slot)
+            if saved is not None:
+                cookies, created = saved
+                age = time.time() - created
+                if cookies != rejected and (not self.max_age or age < self.max_age) and \
+                        (self.probe is None or self.probe(cookies)):
+                    return cookies, age, None
+        start = time.perf_counter()
+        cookies = self.login()
+        login_seconds = time.perf_counter() - start
+        if self.store is not None:
+            self.store.save(slot, cookies, self.max_age)
+        return cookies, 0, login_seconds
+
+    def _logged_in(self, result, slot):
+        cookies, age, login_seconds = result
+        session = Session(cookies, slot, self._clock() - age)
+        self._sessions[slot] = session
+        if login_seconds is None:
+            logger.info('Reusing saved session %d (%.0fs old)', slot, age)
+            self._inc_stat('sessions/reused')
+        else:
+            logger.info('Logged in session %d in %.1fs', slot, login_seconds)
+            self._inc_stat('sessions/logins')
+            crawlstats.observe(self.stats, 'sessions/login_ms', login_seconds * 1000)
+        for waiter in self._waiters.pop(slot):
+            waiter.callback(session)
+
+    def _login_failed(self, failure, slot):
+        logger.error('Login failed for session %d: %s', slot, failure.getErrorMessage())
+        self._inc_stat('sessions/login_failures')
+        for waiter in self._waiters.pop(slot):
+            waiter.errback(failure)
+
+    def _inc_stat(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
+
+
+class FileSessionStore:
+    """Saves sessions to files readable only by the current user."""
+
+    def __init__(self, path):
+        """Initialises the store, saving session N to `path` + `.N`."""
+        self.path = path
+
+    def load(self, slot):
+        """Returns the cookies of a saved session and when it was created."""
+        try:
+            with open('{}.{}'.format(self.path, slot)) as f:
+                return _decode_session(f.read())
+        except FileNotFoundError:
+            return None
+
+    def save(self, slot, cookies, max_age=None):
+        """Saves a new session."""
+        path = '{}.{}'.format(self.path, slot)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(_encode_session(cookies))
+        os.replace(tmp_path, path)
+
+
+class RedisSessionStore:
+    """Saves sessions to Redis, so that they are shared between workers.
+
+    Sessions are encrypted with `key` (a Fernet key, as made by
+    `cryptography.fernet.Fernet.generate_key()`), so that they can't be
+    used by others with access to Redis.
+    """
+
+    key_prefix = 'sessions:'
+
+    def __init__(self, redis, key):
+        """Initialises the store."""
+        self.redis = redis
+        self.fernet = Fernet(key)
+
+    def load(self, slot):
+        """Returns the cookies of a saved session and when it was created."""
+        data = self.redis.get(self.key_prefix + str(slot))
+        if data is None:
+            return None
+        try:
+            return _decode_session(self.fernet.decrypt(data))
+        except InvalidToken:
+            logger.warning('Ignoring saved session encrypted with another key')
+            return None
+
+    def save(self, slot, cookies, max_age=None):
+        """Saves a new session, expiring it once it is `max_age` seconds old."""
+        data = self.fernet.encrypt(_encode_session(cookies).encode('utf-8'))
+        self.redis.set(self.key_prefix + str(slot), data, ex=int(max_age) if max_age else None)
+
+
+def _encode_session(cookies):
+    return json.dumps({'cookies': cookies, 'created': time.time()}, sort_keys=True)
+
+
+def _decode_session(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    try:
+        session = json.loads(data)
+        return session['cookies'], session['created']
+    except (ValueError, KeyError):
+        logger.warning('Ignoring invalid saved session')
+        return None
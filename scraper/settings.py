@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import urllib
@@ -33,8 +34,9 @@ ROBOTSTXT_OBEY = True
 # CONCURRENT_REQUESTS_PER_DOMAIN = 16
 # CONCURRENT_REQUESTS_PER_IP = 16
 
-# Disable cookies (enabled by default)
-# COOKIES_ENABLED = False
+# Disable cookies (enabled by default), as session cookies are added by
+# scraper.middleware.SessionMiddleware
+COOKIES_ENABLED = False
 
 # Disable Telnet Console (enabled by default)
 # TELNETCONSOLE_ENABLED = False
@@ -47,15 +49,29 @@ DEFAULT_REQUEST_HEADERS = {
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-# }
+EXTENSIONS = {
+    'scraper.crawlstats.CrawlStats': 500,
+}
+
+# Write the crawl's stats (see scraper.crawlstats) as a JSON line every
+# CRAWL_STATS_INTERVAL seconds (0 for only when the crawl finishes), to
+# CRAWL_STATS_FILE, or to the log if no file is given
+CRAWL_STATS_INTERVAL = float(os.environ.get('CRAWL_STATS_INTERVAL', 60))
+CRAWL_STATS_FILE = os.environ.get('CRAWL_STATS_FILE', '')
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#    'scraper.pipelines.ScraperPipeline': 300,
-# }
+ITEM_PIPELINES = {
+    'scraper.pipelines.ExportPipeline': 300,
+}
+
+# Yield an item for every record crawled, to be written by the
+# ExportPipeline to one file per entity type in EXPORT_DIR (per run and
+# WORKER_ID, moved into place when the crawl finishes)
+EMIT_ITEMS = os.environ.get('EMIT_ITEMS', 'true').lower() == 'true'
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'output')
+EXPORT_FORMAT = os.environ.get('EXPORT_FORMAT', 'jsonlines')
+EXPORT_BATCH_SIZE = 1000
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -80,6 +96,84 @@ HTTPCACHE_STORAGE = 'scraper.storage.S3CacheStorage'
 HTTPCACHE_GZIP = False
 COMPRESSION_ENABLED = False
 
+# Do S3 cache I/O on a thread pool instead of blocking the reactor.  The
+# number of cache lookups in flight is bounded by CONCURRENT_REQUESTS.
+S3CACHE_ASYNC = os.environ.get('S3CACHE_ASYNC', 'false').lower() == 'true'
+S3CACHE_THREADS = 32
+S3CACHE_MAX_PENDING_WRITES = 256
+
+# Compress cached responses with 'gzip', 'zlib' or 'zstd' (which needs the
+# backports.zstd package), or 'none'.  The level defaults to the codec's
+# default (6 for gzip and zlib, 3 for zstd).  Responses already cached are
+# read however they were compressed.
+S3CACHE_COMPRESS = os.environ.get('S3CACHE_COMPRESS', 'gzip')
+S3CACHE_COMPRESS_LEVEL = int(os.environ['S3CACHE_COMPRESS_LEVEL']) if 'S3CACHE_COMPRESS_LEVEL' in os.environ else None
+
+# Answer cache misses from an in-memory index of cached fingerprints.
+# Rebuild the index with `python -m scraper.index rebuild`, e.g. after a
+# crawl has died.  New fingerprints are saved every S3CACHE_INDEX_FLUSH_SIZE.
+S3CACHE_INDEX_ENABLED = os.environ.get('S3CACHE_INDEX_ENABLED', 'false').lower() == 'true'
+S3CACHE_INDEX_CAPACITY = 2000000
+S3CACHE_INDEX_FLUSH_SIZE = 1000
+
+# Store each distinct response body once, keyed by its digest, rather than
+# once per request.  Remove bodies no longer referenced by any cached
+# response with `python -m scraper.blobs gc`.
+S3CACHE_DEDUP_BODIES = os.environ.get('S3CACHE_DEDUP_BODIES', 'false').lower() == 'true'
+
+# Keep a copy of cached responses on local disk (under HTTPCACHE_DIR), so
+# that repeated runs on the same machine don't re-download them from S3.
+HTTPCACHE_LOCAL_ENABLED = os.environ.get('HTTPCACHE_LOCAL_ENABLED', 'false').lower() == 'true'
+HTTPCACHE_LOCAL_MAX_BYTES = int(os.environ.get('HTTPCACHE_LOCAL_MAX_BYTES', 5 * 1024 ** 3))
+
+if HTTPCACHE_LOCAL_ENABLED:
+    HTTPCACHE_STORAGE = 'scraper.storage.TieredCacheStorage'
+
+# Log in with this many sessions, handed out to requests in turn, and
+# replace each session once it is SESSION_MAX_AGE seconds old (0 to only
+# replace sessions once CDMS stops accepting them)
+SESSION_POOL_SIZE = int(os.environ.get('SESSION_POOL_SIZE', 1))
+SESSION_MAX_AGE = int(os.environ.get('SESSION_MAX_AGE', 50 * 60))
+# Save sessions for reuse by later runs ('file'), or by other workers too
+# ('redis'), rather than logging in each time.  Saved files are only
+# readable by the current user.  Sessions saved to Redis are encrypted with
+# SESSION_STORE_KEY, which must be set to use it (generate one with
+# `python -c 'from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())'`)
+SESSION_STORE = os.environ.get('SESSION_STORE', 'file')
+SESSION_STORE_PATH = os.environ.get('SESSION_STORE_PATH', '.scrapy/session')
+SESSION_STORE_KEY = os.environ.get('SESSION_STORE_KEY', '')
+
+DOWNLOADER_MIDDLEWARES = {
+    'scraper.middleware.SessionMiddleware': 950,
+}
+
+if S3CACHE_ASYNC:
+    CONCURRENT_REQUESTS = 32
+    if HTTPCACHE_LOCAL_ENABLED:
+        HTTPCACHE_STORAGE = 'scraper.storage.AsyncTieredCacheStorage'
+    else:
+        HTTPCACHE_STORAGE = 'scraper.storage.AsyncS3CacheStorage'
+    DOWNLOADER_MIDDLEWARES.update({
+        'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+        'scraper.middleware.DeferredHttpCacheMiddleware': 900,
+    })
+
+# Adjust the concurrency of requests to CDMS to its latency and error rates
+# (see scraper.throttle), between the minimum and maximum given.  Requests
+# start at CONCURRENT_REQUESTS_PER_DOMAIN, and the overall limit is raised to
+# the maximum.
+ADAPTIVE_CONCURRENCY_ENABLED = os.environ.get('ADAPTIVE_CONCURRENCY_ENABLED', 'false').lower() == 'true'
+ADAPTIVE_CONCURRENCY_MIN = int(os.environ.get('ADAPTIVE_CONCURRENCY_MIN', 1))
+ADAPTIVE_CONCURRENCY_MAX = int(os.environ.get('ADAPTIVE_CONCURRENCY_MAX', 64))
+ADAPTIVE_CONCURRENCY_DECREASE_FACTOR = 0.5
+# Latency above which to back off; by default, this is
+# ADAPTIVE_CONCURRENCY_LATENCY_FACTOR times the lowest latency seen
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = float(os.environ.get('ADAPTIVE_CONCURRENCY_TARGET_LATENCY', 0))
+ADAPTIVE_CONCURRENCY_LATENCY_FACTOR = 2.0
+if ADAPTIVE_CONCURRENCY_ENABLED:
+    CONCURRENT_REQUESTS = ADAPTIVE_CONCURRENCY_MAX
+    DOWNLOADER_MIDDLEWARES['scraper.middleware.AdaptiveConcurrencyMiddleware'] = 960
+
 LOG_LEVEL = logging.INFO
 LOG_ENABLED = True
 S3CACHE_BUCKET = os.environ['S3CACHE_BUCKET']
@@ -90,12 +184,71 @@ CDMS_ADFS_URL = os.environ['CDMS_ADFS_URL']
 CDMS_USERNAME = os.environ['CDMS_USERNAME']
 CDMS_PASSWORD = os.environ['CDMS_PASSWORD']
 
-REDIS_ENABLED = False
+# Record the crawl frontier in Redis, so an interrupted crawl can be resumed
+REDIS_ENABLED = os.environ.get('REDIS_ENABLED', 'false').lower() == 'true'
 REDIS_HOST = os.environ['REDIS_HOST']
 REDIS_PORT = os.environ['REDIS_PORT']
 REDIS_DB = os.environ['REDIS_DB']
+REDIS_MAX_CONNECTIONS = 4
+REDIS_SOCKET_TIMEOUT = 10
+# Frontier updates are sent to Redis in transactions of up to this many
+# updates, at least every FRONTIER_FLUSH_INTERVAL seconds
+FRONTIER_BATCH_SIZE = 100
+FRONTIER_FLUSH_INTERVAL = 5
+
+# Share the crawl between several spider processes through Redis (instead of
+# recording a frontier).  Each worker claims up to COORDINATOR_CLAIMS work
+# items at a time, and its claimed work is reclaimed by other workers if it
+# misses heartbeats for COORDINATOR_LEASE_SECONDS.
+COORDINATOR_ENABLED = os.environ.get('COORDINATOR_ENABLED', 'false').lower() == 'true'
+COORDINATOR_CLAIMS = int(os.environ.get('COORDINATOR_CLAIMS', 4))
+COORDINATOR_LEASE_SECONDS = 60
+WORKER_ID = os.environ.get('WORKER_ID')
 
 RETRY_ENABLED = True
 
+# Crawl each entity set as this many independent partitions (using $skip
+# and $top), rather than as one chain of pages.  Override per entity set
+# with CRAWL_PARTITIONS_PER_SET, e.g. {'ContactSet': 16}.
+CRAWL_PARTITIONS = int(os.environ.get('CRAWL_PARTITIONS', 1))
+CRAWL_PARTITIONS_PER_SET = {}
+
+# Only crawl entities modified since the previous crawl (see
+# scraper.watermarks).  This needs EMIT_ITEMS, as the pages of incremental
+# crawls aren't cached.
+CRAWL_INCREMENTAL = os.environ.get('CRAWL_INCREMENTAL', 'false').lower() == 'true'
+# Watermarks are kept this many seconds before the start of the crawl, in
+# case CDMS's clock is behind ours
+CRAWL_INCREMENTAL_OVERLAP = 300
+
+# Entity sets to crawl (all if empty), and not to crawl, as comma separated
+# names which may contain wildcards, e.g. 'Contact*,AccountSet'
+ENTITY_SET_INCLUDE = [name for name in os.environ.get('ENTITY_SET_INCLUDE', '').split(',') if name]
+ENTITY_SET_EXCLUDE = [name for name in os.environ.get('ENTITY_SET_EXCLUDE', '').split(',') if name]
+# Query options for entity sets, as JSON, e.g.
+# {"ContactSet": {"select": ["ContactId", "FullName"], "filter": "StateCode/Value eq 0", "top": 1000}}
+# (see scraper.query.with_entity_set_options), added to the first page of
+# each entity set (or partition); later pages follow the service's links
+ENTITY_SET_OPTIONS = json.loads(os.environ.get('ENTITY_SET_OPTIONS', '{}'))
+
 START_URLS = ["{}/XRMServices/2011/OrganizationData.svc/".format(CDMS_BASE_URL)]
 ALLOWED_DOMAINS = [urllib.parse.urlparse(CDMS_BASE_URL).netloc]
+
+# Replay a crawl entirely from the HTTP cache (e.g. to re-derive items after
+# changing the parser), without logging in to or making requests of CDMS.
+# Requests that aren't cached are counted and skipped, or with
+# CACHE_REPLAY_FAIL_FAST, stop the replay.  A replay doesn't touch the
+# frontier, work queue or watermarks of live crawls, and isn't incremental,
+# as incremental queries aren't cached.
+CACHE_REPLAY = os.environ.get('CACHE_REPLAY', 'false').lower() == 'true'
+CACHE_REPLAY_FAIL_FAST = os.environ.get('CACHE_REPLAY_FAIL_FAST', 'false').lower() == 'true'
+if CACHE_REPLAY:
+    REDIS_ENABLED = False
+    COORDINATOR_ENABLED = False
+    CRAWL_INCREMENTAL = False
+    ADAPTIVE_CONCURRENCY_ENABLED = False
+    DOWNLOADER_MIDDLEWARES.pop('scraper.middleware.AdaptiveConcurrencyMiddleware', None)
+    DOWNLOADER_MIDDLEWARES.update({
+        'scraper.middleware.SessionMiddleware': None,
+        'scraper.middleware.ReplayMiddleware': 950,
+    })
@@ -1,11 +1,22 @@
-import json
 import logging
+import math
+import time
 import urllib.parse
 
+import requests
 import scrapy
-from redis import StrictRedis
-
-from scraper import auth
+from redis import ConnectionPool, StrictRedis
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from twisted.internet import task
+
+from scraper import auth, decoding, s3
+from scraper.collect import output_key
+from scraper.coordinator import Coordinator
+from scraper.frontier import chain_id, Frontier
+from scraper.items import ScraperItem
+from scraper.query import count_url, counted_url, is_included, with_entity_set_options, with_query
+from scraper.watermarks import modified_since, ModifiedWatermarks, parse_date
 
 logger = logging.getLogger(__name__)
 
@@ -20,8 +31,14 @@ class OdataSpider(scrapy.Spider):
         super().__init__(*args, **kwargs)
 
         self.allowed_domains = None
-        self._cache = None
-        self._cookies = None
+        self._frontier = None
+        self._coordinator = None
+        self._watermarks = None
+        self._new_watermarks = {}
+        self._watermark_limit = None
+        self._resumed_sets = set()
+        self._frontier_flusher = None
+        self._heartbeat = None
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -34,6 +51,13 @@ class OdataSpider(scrapy.Spider):
         """
         spider = super().from_crawler(crawler, *args, **kwargs)
         spider.setup()
+        if spider._frontier:
+            spider._frontier.stats = crawler.stats
+            crawler.signals.connect(spider._start_frontier_flusher, signal=signals.spider_opened)
+        if spider._coordinator:
+            crawler.signals.connect(spider._start_heartbeat, signal=signals.spider_opened)
+            crawler.signals.connect(spider._claim_when_idle, signal=signals.spider_idle)
+            crawler.signals.connect(spider._complete_on_error, signal=signals.spider_error)
         return spider
 
     def setup(self):
@@ -41,20 +65,51 @@ class OdataSpider(scrapy.Spider):
         self.allowed_domains = self.settings['ALLOWED_DOMAINS']
         self.start_urls = self.settings['START_URLS']
 
-        if self.settings['REDIS_ENABLED']:
-            self._cache = StrictRedis(
-                host=self.settings['REDIS_HOST'],
-                port=self.settings['REDIS_PORT'],
-                db=self.settings['REDIS_DB'])
+        if self.settings.getbool('COORDINATOR_ENABLED'):
+            self._coordinator = Coordinator(
+                self._make_redis(),
+                worker_id=self.settings.get('WORKER_ID'),
+                lease_seconds=self.settings.getint('COORDINATOR_LEASE_SECONDS', 60))
+        elif self.settings.getbool('REDIS_ENABLED'):
+            self._frontier = Frontier(
+                self._make_redis(),
+                batch_size=self.settings.getint('FRONTIER_BATCH_SIZE', 100),
+                flush_interval=self.settings.getfloat('FRONTIER_FLUSH_INTERVAL', 5))
+
+        if self.settings.getbool('CRAWL_INCREMENTAL'):
+            if not self.settings.getbool('EMIT_ITEMS'):
+                # Incremental pages aren't cached, so unless their records
+                # are exported they would be lost once the watermark moves on
+                raise ValueError('CRAWL_INCREMENTAL needs EMIT_ITEMS to be enabled')
+            self._watermarks = ModifiedWatermarks(s3.get_bucket(self.settings))
 
     def start_requests(self):
         """Queues the initial request(s) in the scraping job.
 
         Typically this queues a request for the service root URL that
-        returns a list of entity types.
+        returns a list of entity types.  If a previous run was interrupted,
+        its pending pages are queued first, and entity sets it had started
+        are skipped when the service root is processed.
+
+        When coordinating with other workers, the initial request(s) are
+        instead shared as work items, and the spider starts on whatever work
+        it can claim.
         """
-        self._refresh_cookies()
-        self._queue_previous_urls()
+        if self._watermarks:
+            self._watermarks.load()
+            # Entities modified while the crawl runs may be on pages already
+            # crawled, so watermarks never move past the start of the crawl
+            # (less an allowance for the service's clock being behind)
+            overlap = self.settings.getfloat('CRAWL_INCREMENTAL_OVERLAP', 300)
+            self._watermark_limit = int((time.time() - overlap) * 1000)
+        if self._coordinator:
+            self._coordinator.heartbeat()
+            self._coordinator.seed(
+                {'url': url, 'callback': 'parse_homepage', 'meta': {}}
+                for url in self.settings['START_URLS'])
+            yield from self._claim_requests(self.settings.getint('COORDINATOR_CLAIMS', 4))
+            return
+        yield from self._queue_previous_urls()
 
         for url in self.settings['START_URLS']:
             logger.info('Queuing initial URL: %s', url)
@@ -66,9 +121,10 @@ class OdataSpider(scrapy.Spider):
         This includes parsing the response, and queuing requests
         for each entity collection specified in the response.
         """
+        requests = []
         if response.url.strip("/").endswith(".svc"):
             try:
-                data = json.loads(response.body.decode("utf-8"))
+                data = decoding.loads(response.body)
             except Exception:
                 logger.exception('Error parsing response as '
                                  'JSON.\nResponse body: \n%s',
@@ -77,70 +133,387 @@ class OdataSpider(scrapy.Spider):
             # yield data
             items = data['d']['EntitySets']
             for item in items:
+                if item in self._resumed_sets:
+                    logger.info('Skipping entity set from previous run: %s', item)
+                    continue
+                if not is_included(item, self.settings.getlist('ENTITY_SET_INCLUDE'),
+                                   self.settings.getlist('ENTITY_SET_EXCLUDE')):
+                    logger.debug('Skipping excluded entity set: %s', item)
+                    continue
                 url = response.urljoin(item)
-                logger.info('Queuing entity URL: %s', url)
-                yield self._make_request(url, callback=self.parse_itempage)
+                meta = self._entity_set_meta(item)
+                if self._partitions(item) > 1:
+                    url = self._entity_set_url(count_url(url), meta)
+                    logger.info('Queuing count URL: %s', url)
+                    requests.append(self._make_request(url, callback=self.parse_count, meta=meta))
+                else:
+                    url = self._entity_set_url(url, meta)
+                    logger.info('Queuing entity URL: %s', url)
+                    request = self._make_request(url, callback=self.parse_itempage, meta=meta)
+                    self._add_url_to_frontier(request.url, meta)
+                    requests.append(request)
+        return self._share(response, requests)
+
+    def parse_count(self, response):
+        """Processes a response giving the number of entities in a set.
+
+        This queues a request for each partition of the entity set.  Each
+        partition is crawled independently, following `__next` links until
+        it has received its share of the entities.  The last partition is
+        left open-ended, so that entities added since counting are still
+        crawled.
+        """
+        entity_set = response.meta['entity_set']
+        count = int(response.text.strip())
+        partitions = self._partitions(entity_set)
+        size = max(math.ceil(count / partitions), 1)
+        url = counted_url(response.url)
+        num_partitions = min(partitions, max(math.ceil(count / size), 1))
+
+        logger.info('Queuing %d partitions of %d entities for %s',
+                    num_partitions, count, entity_set)
+        requests = []
+        for partition in range(num_partitions):
+            last = partition == num_partitions - 1
+            meta = {
+                'entity_set': entity_set,
+                'partition': partition,
+                'remaining': None if last else size,
+            }
+            partition_url = self._entity_set_url(
+                with_query(url, skip=partition * size or None, top=None if last else size), meta)
+            request = self._make_request(partition_url, callback=self.parse_itempage, meta=meta)
+            self._add_url_to_frontier(request.url, meta)
+            requests.append(request)
+
+        # All partitions are recorded together, so that a resumed crawl
+        # never skips an entity set having only recorded some of them.
+        if self._frontier:
+            self._frontier.flush()
+        return self._share(response, requests)
 
     def parse_itempage(self, response):
         """Processes a response for an entity collection endpoint.
 
-        This includes parsing the response, and queuing a request for the
-        next page (if there is one).
+        This includes parsing the response, yielding an item for each record
+        (if `EMIT_ITEMS` is enabled) and queuing a request for the next page
+        (if there is one).  For incremental crawls, the entity set's new
+        watermark is recorded once its last page has been processed, to be
+        saved when the spider is closed.
+
+        Pages are only decoded in full if their records are needed; otherwise
+        just the link to the next page is extracted.  Chains limited to a
+        number of entities (partitions, and entity sets with a `top`) are
+        stopped once they have received them, as `__next` links needn't keep
+        the `$top` of the first page.
+        """
+        logger.debug('%d response received for URL: %s', response.status,
+                     response.request.url)
+        entity_set = response.meta.get('entity_set')
+        emit_items = self.settings.getbool('EMIT_ITEMS')
+        if emit_items or response.meta.get('remaining') is not None or 'modified_max' in response.meta:
+            data = decoding.loads(response.body)
+            results = data['d'].get('results', ())
+            next_url = data['d'].get('__next')
+            if response.meta.get('remaining') is not None:
+                results = results[:response.meta['remaining']]
+        else:
+            # Only the link to the next page is needed
+            results = ()
+            next_url = decoding.next_link(response.body)
+
+        if emit_items:
+            exported = self._exported_at_watermark(response.meta)
+            for record in results:
+                if exported and record['__metadata']['uri'] in exported and \
+                        parse_date(record.get('ModifiedOn')) == response.meta['modified_since']:
+                    # Exported by the previous crawl
+                    continue
+                yield ScraperItem(
+                    entity_set=entity_set,
+                    entity_type=output_key(record),
+                    uri=record['__metadata']['uri'],
+                    data=record)
+
+        meta = _next_page_meta(response.meta, len(results))
+        if 'modified_max' in meta:
+            meta['modified_max'], meta['modified_uris'] = _latest_modified(
+                meta['modified_max'], meta.get('modified_uris', ()), results)
+        if next_url and meta.get('remaining') != 0:
+            request = self._make_request(next_url, callback=self.parse_itempage, meta=meta)
+            # The next page is added before this one is removed, so the
+            # chain is never left without a pending page.
+            self._add_url_to_frontier(request.url, meta)
+            self._remove_url_from_frontier(response.request.url)
+            logger.debug('Queuing next URL: %s', request.url)
+            yield request
+        else:
+            self._remove_url_from_frontier(response.request.url)
+            if self._frontier and 'entity_set' in meta:
+                self._frontier.mark_done(chain_id(meta))
+            if self._watermarks and meta.get('modified_max') is not None:
+                self._record_watermark(
+                    entity_set, meta['modified_max'], meta.get('modified_uris', ()), meta.get('modified_since'))
+            yield from self._share(response, [])
+
+    def closed(self, reason):
+        """Saves the frontier when the spider is closed.
+
+        Once a crawl has finished with no pages left pending, the frontier
+        is reset so that the next run starts afresh.  When coordinating with
+        other workers, any claimed work is handed back.
+
+        The new watermarks of entity sets crawled incrementally are saved
+        here, as Scrapy closes the item pipelines (so the records have been
+        exported) before closing the spider.  If the crawl dies first, the
+        watermarks are left as they were, and the records are crawled again.
+        """
+        for entity_set, (modified_on, uris) in sorted(self._new_watermarks.items()):
+            self._watermarks.save(entity_set, modified_on, uris)
+        self._new_watermarks = {}
+        if self._coordinator:
+            if self._heartbeat and self._heartbeat.running:
+                self._heartbeat.stop()
+            self._coordinator.leave()
+        if not self._frontier:
+            return
+        if self._frontier_flusher and self._frontier_flusher.running:
+            self._frontier_flusher.stop()
+        self._frontier.flush()
+        if reason == 'finished' and not self._frontier.pending():
+            logger.info('Crawl complete, resetting frontier')
+            self._frontier.reset()
+
+    def _record_watermark(self, entity_set, modified_max, uris, modified_since):
+        """Records an entity set's new watermark, to be saved when the spider is closed.
+
+        The watermark is the latest `ModifiedOn` time crawled, but no later
+        than the start of the crawl, and never earlier than the previous
+        watermark.  It is saved with the URIs of the entities crawled that
+        were modified at that time (`uris`), unless it was limited to the
+        start of the crawl.
+        """
+        modified_on = modified_max
+        if self._watermark_limit is not None and modified_on > self._watermark_limit:
+            modified_on, uris = self._watermark_limit, ()
+        if modified_since is not None:
+            modified_on = max(modified_on, modified_since)
+        if modified_on != modified_since:
+            self._new_watermarks[entity_set] = (modified_on, sorted(uris))
+
+    def _exported_at_watermark(self, meta):
+        """Returns the URIs of the entities the previous crawl exported at the watermark.
+
+        As entities modified at the watermark are crawled again (in case
+        others were modified in the same millisecond), these are skipped.
+        """
+        if not self._watermarks or meta.get('modified_since') is None:
+            return frozenset()
+        return self._watermarks.uris(meta['entity_set'])
+
+    def _partitions(self, entity_set):
+        """Returns the number of partitions to crawl an entity set in.
+
+        Entity sets limited to their first `top` entities aren't partitioned,
+        and nor are incremental crawls, as only one chain of pages can track
+        an entity set's watermark.
         """
-        logger.info('%d response received for URL: %s', response.status,
-                    response.request.url)
-        self._remove_url_from_cache(response.url)
-        data = json.loads(response.body.decode("utf-8"))
+        if self._watermarks or 'top' in self._entity_set_options(entity_set):
+            return 1
+        per_set = self.settings.getdict('CRAWL_PARTITIONS_PER_SET')
+        return int(per_set.get(entity_set, self.settings.getint('CRAWL_PARTITIONS', 1)))
 
-        # yield data
-        if '__next' in data['d']:
-            url = data['d']['__next']
-            self._add_url_to_cache(url)
-            logger.info('Queuing next URL: %s', url)
-            yield self._make_request(url, callback=self.parse_itempage)
+    def _entity_set_options(self, entity_set):
+        """Returns the configured query options for an entity set."""
+        return self.settings.getdict('ENTITY_SET_OPTIONS').get(entity_set, {})
 
-    def _queue_previous_urls(self):
-        """Queues incomplete URLs from previous runs.
+    def login(self):
+        """Logs in to the OData service, returning the session cookies.
 
-        (Does nothing if the cache server is disabled.)
+        This is called by `scraper.middleware.SessionMiddleware` (in a
+        thread) whenever a new session is needed.
+        """
+        return _get_cookies(self.settings)
+
+    def check_session(self, cookies):
+        """Returns whether the OData service accepts saved session cookies.
+
+        This requests the service root, which CDMS redirects to the login
+        page if the session has expired.
+        """
+        try:
+            response = requests.get(
+                self.settings['START_URLS'][0], cookies=cookies, allow_redirects=False, timeout=30,
+                headers={'User-Agent': self.settings['USER_AGENT']})
+        except requests.RequestException:
+            logger.exception('Error checking saved session')
+            return False
+        return response.status_code == 200
+
+    def _share(self, response, requests):
+        """Shares requests with other workers (if coordinating).
+
+        The requests are queued as work items, and the work item that led
+        to the response (or failed request) is marked complete.  Returns the
+        requests to make: those given when not coordinating, or else the
+        next claimed item.
+        """
+        if not self._coordinator or 'work' not in response.meta:
+            return requests
+        for request in requests:
+            self._coordinator.put({
+                'url': request.url,
+                'callback': request.callback.__name__,
+                'meta': {key: value for key, value in request.meta.items() if key != 'dont_redirect'},
+            })
+        self._coordinator.complete(response.meta['work'])
+        return list(self._claim_requests(1))
+
+    def _claim_requests(self, num_items):
+        """Claims up to a number of work items, yielding their requests."""
+        for _ in range(num_items):
+            item = self._coordinator.claim()
+            if item is None:
+                return
+            logger.debug('Claimed work: %s', item['url'])
+            yield self._make_request(
+                item['url'], callback=getattr(self, item['callback']),
+                meta=dict(item['meta'], work=item['work']))
+
+    def _reclaim(self):
+        """Reaps work from dead workers, and returns requests for claimed work."""
+        self._coordinator.reap()
+        return list(self._claim_requests(self.settings.getint('COORDINATOR_CLAIMS', 4)))
+
+    def _complete_on_error(self, failure, response, spider):
+        """Marks the work item of a response whose callback failed as complete.
+
+        Otherwise the item would stay claimed, and the crawl never finish.
         """
-        for url in self._previous_urls():
-            url = url.decode("utf-8")
-            logger.info('Queuing URL from redis: %s', url)
-            yield self._make_request(url, callback=self.parse_itempage)
+        if 'work' in response.meta:
+            logger.error('Abandoning work after error: %s', response.request.url)
+            self._coordinator.complete(response.meta['work'])
 
-    def _previous_urls(self):
-        """Returns incomplete URLs from the cache server (if enabled)."""
-        return self._cache.sscan_iter('urls') if self._cache else ()
+    def _claim_when_idle(self, spider):
+        """Claims more work when idle, keeping the spider open until all work is done.
 
-    def _add_url_to_cache(self, url):
-        """Stores a URL in the cache server (if enabled)."""
-        if self._cache:
-            self._cache.sadd('urls', url)
+        Workers wait while others still hold work, so that it can be
+        reclaimed if they die.
+        """
+        requests = self._reclaim()
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        if requests or not self._coordinator.finished():
+            raise DontCloseSpider
+
+    def _start_heartbeat(self, spider):
+        """Periodically renews the worker's lease."""
+        self._heartbeat = task.LoopingCall(self._coordinator.heartbeat)
+        self._heartbeat.start(self._coordinator.lease_seconds / 3, now=False)
+
+    def _start_frontier_flusher(self, spider):
+        """Periodically flushes the frontier, so updates aren't held while idle."""
+        self._frontier_flusher = task.LoopingCall(self._frontier.flush)
+        self._frontier_flusher.start(self._frontier.flush_interval, now=False)
 
-    def _remove_url_from_cache(self, url):
-        """Removes a URL from the cache server (if enabled)."""
-        if self._cache:
-            self._cache.srem('urls', url)
+    def _queue_previous_urls(self):
+        """Queues pending pages from previous runs.
 
-    def _refresh_cookies(self):
-        """Creates a new session with the OData service."""
-        self._cookies = _get_cookies(self.settings)
+        Entity sets with pending pages or completed chains are recorded so
+        that they aren't queued again from the service root.
 
-    def _make_request(self, url, callback):
+        (Does nothing if the cache server is disabled.)
+        """
+        if not self._frontier:
+            return
+        pending = self._frontier.pending()
+        chains = self._frontier.done() | {chain_id(meta) for meta in pending.values()}
+        self._resumed_sets = {chain.split('#')[0] for chain in chains}
+        for url, meta in sorted(pending.items()):
+            logger.debug('Queuing URL from redis: %s', url)
+            request = self._make_request(url, callback=self.parse_itempage, meta=meta)
+            if request.url != url:
+                # Keep the page under the URL its response will arrive with
+                self._remove_url_from_frontier(url)
+                self._add_url_to_frontier(request.url, meta)
+            yield request
+
+    def _add_url_to_frontier(self, url, meta):
+        """Records a pending page in the cache server (if enabled).
+
+        Pages are recorded under the URL of their request, as normalised by
+        Scrapy (which e.g. percent-encodes braces in skiptokens), and are
+        removed under the URL of the request their response is for.
+        """
+        if self._frontier:
+            self._frontier.add(url, _frontier_meta(meta))
+
+    def _remove_url_from_frontier(self, url):
+        """Records a processed page in the cache server (if enabled)."""
+        if self._frontier:
+            self._frontier.remove(url)
+
+    def _make_redis(self):
+        """Creates a Redis client, using a pool of connections."""
+        pool = ConnectionPool(
+            host=self.settings['REDIS_HOST'],
+            port=self.settings['REDIS_PORT'],
+            db=self.settings['REDIS_DB'],
+            max_connections=self.settings.getint('REDIS_MAX_CONNECTIONS', 4),
+            socket_timeout=self.settings.getfloat('REDIS_SOCKET_TIMEOUT', 10))
+        return StrictRedis(connection_pool=pool)
+
+    def _entity_set_meta(self, entity_set):
+        """Returns the meta of the first request for an entity set.
+
+        This limits the entities crawled to the set's `top` (if any), and
+        for incremental crawls, holds the entity set's watermark.
+        """
+        meta = {'entity_set': entity_set}
+        top = self._entity_set_options(entity_set).get('top')
+        if top is not None:
+            meta['remaining'] = int(top)
+        if self._watermarks:
+            since = self._watermarks.get(entity_set)
+            meta['modified_max'] = since
+            meta['modified_uris'] = []
+            if since is not None:
+                meta['modified_since'] = since
+        return meta
+
+    def _entity_set_url(self, url, meta):
+        """Returns the URL of the first page (or count) of an entity set.
+
+        The query options configured for the entity set (if any) are added
+        to the URL.  For incremental crawls, entities modified since the
+        entity set's watermark are filtered for.  Later pages are requested
+        with the `__next` links returned by the service, as they are.
+        """
+        options = self._entity_set_options(meta['entity_set'])
+        if 'modified_max' in meta and options.get('select'):
+            options = dict(options, select=_with_modified_on(options['select']))
+        if meta.get('modified_since') is not None:
+            options = dict(options, filter=modified_since(meta['modified_since'], options.get('filter')))
+        return with_entity_set_options(url, options)
+
+    def _make_request(self, url, callback, meta=None):
         """Creates a Scrapy request object.
 
-        The request object is created using the cookies for the current
-        session, with redirects disabled and an error callback specified.
+        The request object is created with redirects disabled and an error
+        callback specified.  Any `meta` given is added to the request's meta.
+        For incremental crawls, the HTTP cache is bypassed, as the results of
+        queries for recently modified entities change.
+        (Session cookies are added by `scraper.middleware.SessionMiddleware`.)
 
         Note that this does not actually queue the request.
         """
+        meta = dict(meta or {}, dont_redirect=True)
+        if meta.get('modified_since') is not None:
+            meta['dont_cache'] = True
         return scrapy.Request(
-            url, callback=callback, cookies=self._cookies,
+            url, callback=callback,
             errback=self._handle_error,
-            meta={
-                'dont_redirect': True
-            })
+            meta=meta)
 
     def _retry(self, response):
         """Retries a failed request (up to a configured number of attempts)."""
@@ -148,32 +521,97 @@ class OdataSpider(scrapy.Spider):
         if num_retries >= 5:
             logger.error('Max attempts exceeded for URL: %s',
                          response.request.url)
+            self._inc_stat('retry/max_reached')
             return
 
         logger.info('Queuing retry for URL: %s', response.request.url)
-        self._refresh_cookies()
-
-        new_request = response.request.replace(cookies=self._cookies,
-                                               dont_filter=True)
+        self._inc_stat('retry/redirects')
+        new_request = response.request.replace(dont_filter=True)
         new_request.meta['retry_times'] = num_retries
+        self._add_url_to_frontier(new_request.url, new_request.meta)
         return new_request
 
+    def _inc_stat(self, key):
+        """Increments a value in the crawler's stats (if crawling)."""
+        crawler = getattr(self, 'crawler', None)
+        if crawler is not None:
+            crawler.stats.inc_value(key)
+
     def _handle_error(self, failure):
         """Handles Scrapy request errors.
 
         This function is passed as the error callback when making Scrapy
         requests.
         """
-        response = getattr(failure.value, 'response')
+        response = getattr(failure.value, 'response', None)
         if response and response.status == 302:
-            # This is typically due to session expiry.
-            yield self._retry(response)
+            # This is typically due to session expiry, in which case the
+            # session middleware gives the retry a new session.
+            request = self._retry(response)
+            if request is not None:
+                yield request
+                return
+        elif response is None and failure.check(IgnoreRequest):
+            # Cache misses when replaying a crawl, which have been logged by
+            # scraper.middleware.ReplayMiddleware
+            pass
         else:
             # Log the response status code, URL and traceback, and then
             # carries on.
             # Often these are 403s.
             logger.error('Scrapy error\nResponse\n%s:Traceback:\n%s',
                          response, failure.getTraceback())
+        # The request has failed for good, so its work item (if any) is
+        # complete, as far as it can be
+        request = getattr(failure, 'request', None)
+        if request is not None:
+            yield from self._share(request, [])
+
+
+def _next_page_meta(meta, num_results):
+    """Returns the meta for the request of the page following a response.
+
+    This carries over which entity set (and partition) is being crawled,
+    the work item it was claimed as (if coordinating) and its watermarks (if
+    crawling incrementally), counting down the entities remaining in the
+    partition.
+    """
+    keys = ('entity_set', 'partition', 'remaining', 'work', 'modified_since', 'modified_max', 'modified_uris')
+    next_meta = {key: meta[key] for key in keys if key in meta}
+    if next_meta.get('remaining') is not None:
+        next_meta['remaining'] = max(next_meta['remaining'] - num_results, 0)
+    return next_meta
+
+
+def _frontier_meta(meta):
+    """Returns the meta needed to resume crawling from a page."""
+    keys = ('entity_set', 'partition', 'remaining', 'retry_times', 'modified_since', 'modified_max',
+            'modified_uris')
+    return {key: meta[key] for key in keys if key in meta}
+
+
+def _latest_modified(latest, uris, records):
+    """Returns the latest `ModifiedOn` time of some records, or `latest` if later.
+
+    Also returns the URIs of the records modified at that time, including
+    `uris` (those seen at `latest` so far).
+    """
+    uris = list(uris)
+    for record in records:
+        modified_on = parse_date(record.get('ModifiedOn'))
+        if modified_on is None:
+            continue
+        if latest is None or modified_on > latest:
+            latest, uris = modified_on, [record['__metadata']['uri']]
+        elif modified_on == latest:
+            uris.append(record['__metadata']['uri'])
+    return latest, uris
+
+
+def _with_modified_on(select):
+    """Returns `$select` columns, adding `ModifiedOn` if necessary."""
+    columns = select.split(',') if isinstance(select, str) else list(select)
+    return columns if 'ModifiedOn' in columns else columns + ['ModifiedOn']
 
 
 def _get_cookie_domain(url):
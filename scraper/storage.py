@@ -1,22 +1,36 @@
 import functools
+import hashlib
 import io
 import logging
-import pickle
-from time import time
+import threading
+from time import perf_counter, time
 
 import boto3
 import botocore
 
 from scrapy.http import Headers
 from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
 from scrapy.utils.request import request_fingerprint
 
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
 from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
 
+from scraper import blobs, crawlstats, record, s3
+from scraper.diskcache import DiskCache
+from scraper.index import FingerprintIndex
+
 logger = logging.getLogger(__name__)
 
 cache_key_prefix = "CACHE"
 
+record_filename = record.filename
+
+# Layout used before records were packed into a single object.  These are
+# still read (and cleaned up) so that existing caches remain usable.
 filenames = [
     'meta',
     'pickled_meta',
@@ -27,7 +41,8 @@ filenames = [
 
 
 def _make_delete_objects(path_func):
-    return {'Objects': [{'Key': path_func(k)} for k in filenames]}
+    keys = [record_filename] + filenames
+    return {'Objects': [{'Key': path_func(k)} for k in keys]}
 
 
 def _listify(*args):
@@ -49,6 +64,16 @@ def _get_s3_text(bucket, key):
     return text
 
 
+def _exists(bucket, key):
+    try:
+        bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if s3.is_not_found(e):
+            return False
+        raise
+    return True
+
+
 def _send_s3_text(bucket, key, body):
     body = io.BytesIO(body)
     bucket.upload_fileobj(body, key)
@@ -56,7 +81,22 @@ def _send_s3_text(bucket, key, body):
 
 
 class S3CacheStorage:
-    """Scrapy HTTP cache class that caches responses in S3."""
+    """Scrapy HTTP cache class that caches responses in S3.
+
+    Each response is stored as a single packed record (see `scraper.record`),
+    compressed with the `S3CACHE_COMPRESS` codec (if any) at
+    `S3CACHE_COMPRESS_LEVEL`.  Records are read whichever way they were
+    compressed.  Responses cached with the older one-object-per-part layout
+    are still read if `S3CACHE_LEGACY_FALLBACK` is enabled.
+
+    If `S3CACHE_DEDUP_BODIES` is enabled, response bodies are stored once
+    per distinct body (see `scraper.blobs`).  Blobs known to be stored,
+    having been stored, read or found by this process, aren't uploaded
+    again.
+
+    Cache hits and misses, and the time taken to look up each response, are
+    recorded in the crawler's stats (see `scraper.crawlstats`).
+    """
 
     def __init__(self, settings):
         """Initialises the S3 scraper."""
@@ -64,67 +104,366 @@ class S3CacheStorage:
         assert self.bucket_name, "No bucket configured"
         self.region = settings['AWS_REGION']
         assert self.region, "No AWS region configured"
-        s3 = boto3.resource('s3', region_name=self.region)
-        self.bucket = s3.Bucket(self.bucket_name)
+        self.compress = record.codec_name(settings.get('S3CACHE_COMPRESS', False))
+        self.compress_level = settings.get('S3CACHE_COMPRESS_LEVEL')
+        self.legacy_fallback = settings.get('S3CACHE_LEGACY_FALLBACK', True)
+        self.dedup_bodies = settings.get('S3CACHE_DEDUP_BODIES', False)
+        self.blobs_uploaded = 0
+        self.blobs_skipped = 0
+        self._known_blobs = set()
+        self._blobs_lock = threading.Lock()
+        self.bucket = self._make_bucket()
+        self.stats = None
+        self.index = None
+        if settings.get('S3CACHE_INDEX_ENABLED', False):
+            self.index = FingerprintIndex(
+                self.bucket, capacity=settings.get('S3CACHE_INDEX_CAPACITY', 2000000),
+                flush_size=settings.get('S3CACHE_INDEX_FLUSH_SIZE', 1000))
+
+    def _make_bucket(self):
+        resource = boto3.resource('s3', region_name=self.region)
+        return resource.Bucket(self.bucket_name)
 
     def open_spider(self, spider):
         """Called by Scrapy when the spider is opened."""
-        pass
+        crawler = getattr(spider, 'crawler', None)
+        if crawler is not None:
+            self.stats = crawler.stats
+        if self.index is not None:
+            self.index.load()
 
     def close_spider(self, spider):
         """Called by Scrapy when the spider is closed."""
-        pass
+        if self.dedup_bodies:
+            logger.info('Uploaded %d response bodies, skipped %d already stored',
+                        self.blobs_uploaded, self.blobs_skipped)
+        if self.index is not None:
+            self.index.save()
 
     def retrieve_response(self, spider, request):
         """Retrieves a response from S3 (if previously cached)."""
+        entry = self._record_lookup(*_timed(self._load_entry, request))
+        return self._response_from_entry(request, entry)
+
+    def store_response(self, spider, request, response):
+        """Stores a response in S3."""
+        if response.status == 302:
+            return
+        metadata, parts = _make_entry(request, response)
+        self._save_entry(request, metadata, parts)
+        self._add_to_index(request)
+        self._flush_index()
+
+    def _response_from_entry(self, request, entry):
+        """Builds the response for a cache entry, discarding redirects."""
+        if entry is None:
+            return None
+
+        logger.debug('Retrieved response from cache for URL: %s', request.url)
+
+        response = _make_response(*entry)
+        if response.status == 302:
+            self._delete_entry(request)
+            return None
+        return response
+
+    def _record_lookup(self, entry, seconds):
+        """Records a cache lookup in the stats, returning its entry."""
+        if self.stats is not None:
+            self.stats.inc_value('s3cache/miss' if entry is None else 's3cache/hit')
+            crawlstats.observe(self.stats, 's3cache/latency_ms', seconds * 1000)
+        return entry
+
+    def _delete_entry(self, request):
+        """Deletes all objects cached for a request."""
         path = functools.partial(_storage_path, request)
+        self.bucket.delete_objects(Delete=_make_delete_objects(path))
+
+    def _add_to_index(self, request):
+        if self.index is not None:
+            self.index.add(request_fingerprint(request))
+
+    def _flush_index(self):
+        if self.index is not None:
+            self.index.flush()
+
+    def _load_entry(self, request):
+        """Returns the cached `(metadata, parts)` for a request, or None."""
+        if self.index is not None and request_fingerprint(request) not in self.index:
+            return None
+        path = functools.partial(_storage_path, request)
+        try:
+            return self._with_body(record.unpack(_get_s3_text(self.bucket, path(record_filename))))
+        except botocore.exceptions.ClientError as e:
+            if not s3.is_not_found(e):
+                raise
+        if self.legacy_fallback:
+            return self._load_legacy_entry(path)
+        return None
+
+    def _load_legacy_entry(self, path):
+        """Reads an entry stored using the legacy one-object-per-part layout."""
         try:
-            _metadata = _get_s3_text(self.bucket, path('pickled_meta'))
+            _metadata = _get_s3_text(self.bucket, path('meta'))
             body = _get_s3_text(self.bucket, path('response_body'))
             rawheaders = _get_s3_text(self.bucket, path('response_headers'))
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
+            if s3.is_not_found(e):
                 return None
-            else:
-                raise
-
-        logging.info('Retrieved response from cache for URL: %s', request.url)
+            raise
+        parts = {'response_headers': rawheaders, 'response_body': body}
+        return record.parse_legacy_metadata(_metadata), parts
 
-        metadata = pickle.loads(_metadata)
+    def _save_entry(self, request, metadata, parts):
+        """Packs and stores a cache entry for a request."""
+        if self.dedup_bodies and parts.get('response_body'):
+            body = parts['response_body']
+            metadata, parts = blobs.split(metadata, parts)
+            digest = metadata['body_sha256']
+            if not self._blob_known(digest):
+                self._save_blob(digest, blobs.pack(body, compress=self.compress, level=self.compress_level))
+        self._save_record(request, record.pack(metadata, parts, compress=self.compress, level=self.compress_level))
 
-        url = metadata.get('response_url')
-        status = metadata['status']
-        headers = Headers(headers_raw_to_dict(rawheaders))
-        respcls = responsetypes.from_args(headers=headers, url=url)
-        response = respcls(url=url, headers=headers, status=status, body=body)
-        if response.status == 302:
-            self.bucket.delete_objects(Delete=_make_delete_objects(path))
+    def _with_body(self, entry):
+        """Returns a cache entry with its body in place, or None if missing."""
+        metadata, parts = entry
+        digest = blobs.referenced(metadata)
+        if digest is None:
+            return entry
+        body = self._load_blob(digest)
+        if body is None:
+            logger.warning('Missing response body %s for URL: %s', digest, metadata.get('url'))
             return None
-        return response
+        return blobs.join(metadata, parts, body)
+
+    def _load_blob(self, digest):
+        """Returns the response body with a digest, or None if missing."""
+        try:
+            body = blobs.unpack(_get_s3_text(self.bucket, blobs.blob_key(digest)))
+        except botocore.exceptions.ClientError as e:
+            if s3.is_not_found(e):
+                return None
+            raise
+        self._add_known_blob(digest)
+        return body
+
+    def _save_blob(self, digest, data):
+        """Uploads a blob, unless S3 already holds it."""
+        key = blobs.blob_key(digest)
+        if _exists(self.bucket, key):
+            with self._blobs_lock:
+                self.blobs_skipped += 1
+        else:
+            _send_s3_text(self.bucket, key, data)
+            with self._blobs_lock:
+                self.blobs_uploaded += 1
+        self._add_known_blob(digest)
+
+    def _blob_known(self, digest):
+        with self._blobs_lock:
+            if digest in self._known_blobs:
+                self.blobs_skipped += 1
+                return True
+            return False
+
+    def _add_known_blob(self, digest):
+        with self._blobs_lock:
+            self._known_blobs.add(digest)
+
+    def _save_record(self, request, data):
+        """Uploads a packed record for a request."""
+        _send_s3_text(self.bucket, _storage_path(request, record_filename), data)
+
+
+class AsyncS3CacheStorage(S3CacheStorage):
+    """S3 cache storage that does its S3 I/O on a thread pool.
+
+    `retrieve_response` returns a Deferred, and stores are buffered and
+    written behind, so the reactor never waits on S3.  This has to be used
+    with `scraper.middleware.DeferredHttpCacheMiddleware`, as Scrapy's own
+    cache middleware expects responses to be returned synchronously.
+
+    At most `S3CACHE_MAX_PENDING_WRITES` stores are buffered; beyond that
+    `store_response` returns a Deferred so that the middleware waits for
+    the write to complete.
+    """
+
+    def __init__(self, settings):
+        """Initialises the storage and its (not yet started) thread pool."""
+        # boto3 resources are not thread safe, so each thread gets its own
+        self._local = threading.local()
+        super().__init__(settings)
+        self.max_pending_writes = settings.get('S3CACHE_MAX_PENDING_WRITES', 256)
+        self._pool = ThreadPool(maxthreads=settings.get('S3CACHE_THREADS', 32), name='s3cache')
+        self._pending_writes = set()
+
+    @property
+    def bucket(self):
+        """The S3 bucket for the current thread."""
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            bucket = self._local.bucket = self._make_bucket()
+        return bucket
+
+    @bucket.setter
+    def bucket(self, value):
+        self._local.bucket = value
+
+    def open_spider(self, spider):
+        """Starts the thread pool."""
+        super().open_spider(spider)
+        self._pool.start()
+
+    def close_spider(self, spider):
+        """Flushes buffered writes, then stops the thread pool.
+
+        Returns a Deferred that fires once all writes have completed.
+        """
+        logger.info('Flushing %d pending cache writes', len(self._pending_writes))
+        d = defer.DeferredList(list(self._pending_writes))
+        d.addBoth(lambda _: super(AsyncS3CacheStorage, self).close_spider(spider))
+        d.addBoth(lambda _: self._pool.stop())
+        return d
+
+    def retrieve_response(self, spider, request):
+        """Returns a Deferred firing with the cached response (or None)."""
+        # Timed in the thread, but recorded back in the reactor
+        d = self._defer(_timed, self._load_entry, request)
+        d.addCallback(lambda result: self._record_lookup(*result))
+        d.addCallback(lambda entry: self._response_from_entry(request, entry))
+        return d
 
     def store_response(self, spider, request, response):
-        """Stores a response in S3."""
+        """Queues a response to be stored in S3."""
         if response.status == 302:
-            return
-        path = functools.partial(_storage_path, request)
-        metadata = {
-            'url': request.url,
-            'method': request.method,
-            'status': response.status,
-            'response_url': response.url,
-            'timestamp': time(),
-        }
-
-        pairs = (
-            ('meta', repr(metadata).encode('utf8')),
-            ('pickled_meta', pickle.dumps(metadata, protocol=2)),
-            ('request_headers', headers_dict_to_raw(request.headers)),
-            ('request_body', request.body),
-            ('response_headers', headers_dict_to_raw(response.headers)),
-            ('response_body', response.body),
-        )
-        for key, body in pairs:
-            _send_s3_text(self.bucket, path(key), body)
+            return None
+        metadata, parts = _make_entry(request, response)
+        self._add_to_index(request)
+        d = self._defer(self._store_entry, request, metadata, parts)
+        self._pending_writes.add(d)
+        d.addBoth(self._write_done, d, request)
+        if len(self._pending_writes) > self.max_pending_writes:
+            return d
+        return None
+
+    def _store_entry(self, request, metadata, parts):
+        self._save_entry(request, metadata, parts)
+        self._flush_index()
+
+    def _delete_entry(self, request):
+        d = self._defer(super()._delete_entry, request)
+        d.addErrback(lambda failure: logger.error(
+            'Error deleting cache entry for URL: %s\n%s', request.url, failure.getTraceback()))
+
+    def _write_done(self, result, d, request):
+        self._pending_writes.discard(d)
+        if isinstance(result, Failure):
+            logger.error('Error storing response in cache for URL: %s\n%s',
+                         request.url, result.getTraceback())
+
+    def _defer(self, func, *args):
+        return threads.deferToThreadPool(reactor, self._pool, func, *args)
+
+
+class TieredCacheStorage(S3CacheStorage):
+    """S3 cache storage with a local disk cache in front of it.
+
+    Records are read through and written through the local cache, which is
+    kept under `HTTPCACHE_DIR` and limited to `HTTPCACHE_LOCAL_MAX_BYTES`
+    (least recently used records are evicted first).  Legacy entries read
+    from S3 are stored locally as packed records.  Blobs of deduplicated
+    response bodies are kept in the local cache too, keyed by digest.
+    """
+
+    def __init__(self, settings):
+        """Initialises the storage."""
+        super().__init__(settings)
+        self.local = DiskCache(
+            data_path(settings['HTTPCACHE_DIR'], createdir=True),
+            settings.get('HTTPCACHE_LOCAL_MAX_BYTES', 5 * 1024 ** 3))
+
+    def open_spider(self, spider):
+        """Loads the index of the local cache."""
+        self.local.open()
+        return super().open_spider(spider)
+
+    def _load_entry(self, request):
+        key = request_fingerprint(request)
+        data = self.local.get(key)
+        if data is not None:
+            return self._with_body(record.unpack(data))
+
+        entry = super()._load_entry(request)
+        if entry is not None:
+            self.local.put(key, record.pack(*entry, compress=self.compress, level=self.compress_level))
+        return entry
+
+    def _save_record(self, request, data):
+        super()._save_record(request, data)
+        self.local.put(request_fingerprint(request), data)
+
+    def _delete_entry(self, request):
+        self.local.delete(request_fingerprint(request))
+        return super()._delete_entry(request)
+
+    def _load_blob(self, digest):
+        data = self.local.get(digest)
+        if data is not None:
+            return blobs.unpack(data)
+
+        body = super()._load_blob(digest)
+        if body is not None:
+            self.local.put(digest, blobs.pack(body, compress=self.compress, level=self.compress_level))
+        return body
+
+    def _save_blob(self, digest, data):
+        super()._save_blob(digest, data)
+        self.local.put(digest, data)
+
+
+class AsyncTieredCacheStorage(TieredCacheStorage, AsyncS3CacheStorage):
+    """Tiered cache storage that does its I/O on a thread pool."""
+
+
+def _timed(func, *args):
+    """Calls a function, returning its result and the time it took (in seconds)."""
+    start = perf_counter()
+    result = func(*args)
+    return result, perf_counter() - start
+
+
+def _make_entry(request, response):
+    """Returns the `(metadata, parts)` to cache for a request/response pair.
+
+    The metadata is as described in `scraper.record`.
+    """
+    metadata = {
+        'version': record.METADATA_VERSION,
+        'url': request.url,
+        'method': request.method,
+        'status': response.status,
+        'response_url': response.url,
+        'timestamp': time(),
+        'body_sha256': hashlib.sha256(response.body).hexdigest(),
+        'body_length': len(response.body),
+        'encoding': getattr(response, 'encoding', None),
+    }
+    parts = {
+        'request_headers': headers_dict_to_raw(request.headers),
+        'request_body': request.body,
+        'response_headers': headers_dict_to_raw(response.headers),
+        'response_body': response.body,
+    }
+    return metadata, parts
+
+
+def _make_response(metadata, parts):
+    """Builds a Scrapy response from cached metadata and parts."""
+    url = metadata.get('response_url')
+    status = metadata['status']
+    headers = Headers(headers_raw_to_dict(parts['response_headers']))
+    respcls = responsetypes.from_args(headers=headers, url=url)
+    return respcls(url=url, headers=headers, status=status, body=parts['response_body'])
 
 
 def _storage_path(request, *args):
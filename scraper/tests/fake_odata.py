@@ -0,0 +1,130 @@
+"""A fake OData service for testing the spider without a network."""
+import calendar
+import collections
+import json
+import operator
+import re
+import time
+import urllib.parse
+
+import scrapy
+from scrapy.http import TextResponse
+
+from scraper.query import with_query
+from scraper.watermarks import parse_date
+
+ENTITY_TYPE = "Microsoft.Crm.Sdk.Data.Services.{}"
+
+_operators = {'eq': operator.eq, 'gt': operator.gt, 'ge': operator.ge, 'lt': operator.lt, 'le': operator.le}
+_condition = re.compile(r"^(\w+) (eq|gt|ge|lt|le) datetime'([^'.]+)(?:\.(\d+))?'$")
+
+
+class FakeODataService:
+    """Serves in-memory entity sets as a fake `OrganizationData.svc`.
+
+    Entity sets are collections of records keyed by the name of the set,
+    e.g. `{'ContactSet': [{'Name': 'a'}, ...]}`.  Responses support `$count`,
+    `$skip`, `$top`, `$select`, and server driven paging with `$skiptoken`.
+    `__next` links keep the other query options (including `$top`), unless
+    `next_options` names the only ones to keep.
+
+    `$filter` supports comparisons of dates (in `/Date(...)/` form) with
+    datetime literals, joined with `and`, e.g.
+    `ModifiedOn ge datetime'2016-05-04T10:00:00.123'`.
+    """
+
+    def __init__(self, root_url, entity_sets, page_size=50, next_options=None):
+        """Initialises the service."""
+        self.root_url = root_url.rstrip('/')
+        self.entity_sets = entity_sets
+        self.page_size = page_size
+        self.next_options = next_options
+        self.requested = []
+
+    def respond(self, request):
+        """Returns the response to a Scrapy request."""
+        self.requested.append(request.url)
+        parts = urllib.parse.urlsplit(request.url)
+        path = parts.path[len(urllib.parse.urlsplit(self.root_url).path):].strip('/')
+        query = dict(urllib.parse.parse_qsl(parts.query))
+
+        if not path:
+            return self._json(request, {'d': {'EntitySets': sorted(self.entity_sets)}})
+        name, _, rest = path.partition('/')
+        if rest == '$count':
+            return self._text(request, str(len(self._filter(name, query))))
+        return self._json(request, self._page(request.url, name, query))
+
+    def _page(self, url, name, query):
+        records = self._filter(name, query)
+        start = int(query.get('$skiptoken', query.get('$skip', 0)))
+        end = len(records)
+        if '$top' in query:
+            end = min(end, int(query.get('$skip', 0)) + int(query['$top']))
+        stop = min(end, start + self.page_size)
+
+        results = [self._record(name, *records[i]) for i in range(start, stop)]
+        if '$select' in query:
+            columns = ['__metadata'] + query['$select'].split(',')
+            results = [{key: result[key] for key in columns if key in result} for result in results]
+        data = {'d': {'results': results}}
+        if stop < end:
+            if self.next_options is not None:
+                parts = urllib.parse.urlsplit(url)
+                kept = [(name, value) for name, value in urllib.parse.parse_qsl(parts.query)
+                        if name in self.next_options]
+                url = urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(kept)))
+            data['d']['__next'] = with_query(url, skiptoken=stop)
+        return data
+
+    def _filter(self, name, query):
+        """Returns the `(index, record)` pairs of an entity set matching `$filter`."""
+        records = list(enumerate(self.entity_sets[name]))
+        if query.get('$filter'):
+            for condition in query['$filter'].split(' and '):
+                prop, op, value, fraction = _condition.match(condition.strip('()')).groups()
+                milliseconds = int((fraction or '').ljust(3, '0')[:3])
+                value = calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S')) * 1000 + milliseconds
+                records = [(i, record) for i, record in records
+                           if _operators[op](parse_date(record.get(prop)) or 0, value)]
+        return records
+
+    def _record(self, name, index, record):
+        entity_type = ENTITY_TYPE.format(name[:-len('Set')])
+        uri = "{}/{}({})".format(self.root_url, name, index)
+        return collections.OrderedDict([('__metadata', {'uri': uri, 'type': entity_type})], **record)
+
+    def _json(self, request, data):
+        return TextResponse(request.url, body=json.dumps(data).encode('utf-8'), request=request,
+                            headers={'Content-Type': 'application/json'})
+
+    def _text(self, request, text):
+        return TextResponse(request.url, body=text.encode('utf-8'), request=request,
+                            headers={'Content-Type': 'text/plain'})
+
+
+def crawl(service, requests, max_requests=None):
+    """Runs a crawl against the service, one request at a time.
+
+    If `max_requests` is given, the crawl is stopped abruptly (as if killed)
+    after that many requests.
+
+    Returns the items yielded by the spider callbacks.
+    """
+    items = []
+    queue = collections.deque(requests)
+    num_requests = 0
+    while queue and num_requests != max_requests:
+        num_requests += 1
+        requests, new_items = fetch(service, queue.popleft())
+        queue.extend(requests)
+        items.extend(new_items)
+    return items
+
+
+def fetch(service, request):
+    """Makes a request, returning the requests and items from its callback."""
+    requests, items = [], []
+    for result in request.callback(service.respond(request)) or ():
+        (requests if isinstance(result, scrapy.Request) else items).append(result)
+    return requests, items
@@ -0,0 +1,174 @@
+"""A fake Redis client for testing without a Redis server."""
+import collections
+
+from redis.exceptions import WatchError
+
+
+class FakeRedis:
+    """Holds strings, hashes, lists and sets in memory.
+
+    Only the commands we use are supported.  As with `StrictRedis`, values
+    are returned as bytes.  Keys never expire; delete them to simulate
+    expiry.  Writes to each key are counted, for pipelines to detect
+    changes to the keys they watch.
+    """
+
+    def __init__(self):
+        """Initialises an empty database."""
+        self.data = {}
+        self.versions = collections.Counter()
+
+    def pipeline(self):
+        """Returns a pipeline that applies commands when executed."""
+        return FakePipeline(self)
+
+    def set(self, key, value, ex=None):
+        """Sets a string."""
+        self.data[key] = _encode(str(value) if isinstance(value, int) else value)
+        self.versions[key] += 1
+
+    def get(self, key):
+        """Returns a string, or None if it doesn't exist."""
+        return self.data.get(key)
+
+    def setnx(self, key, value):
+        """Sets a string if the key doesn't exist, returning whether it was set."""
+        if key in self.data:
+            return False
+        self.set(key, value)
+        return True
+
+    def exists(self, key):
+        """Returns whether a key exists."""
+        return int(key in self.data)
+
+    def hset(self, key, field, value):
+        """Sets a field of a hash."""
+        self.data.setdefault(key, {})[_encode(field)] = _encode(value)
+        self.versions[key] += 1
+
+    def hdel(self, key, field):
+        """Deletes a field of a hash."""
+        self.data.get(key, {}).pop(_encode(field), None)
+        self.versions[key] += 1
+        self._remove_if_empty(key)
+
+    def hgetall(self, key):
+        """Returns a hash as a dict."""
+        return dict(self.data.get(key, {}))
+
+    def sadd(self, key, member):
+        """Adds a member to a set."""
+        self.data.setdefault(key, set()).add(_encode(member))
+        self.versions[key] += 1
+
+    def smembers(self, key):
+        """Returns the members of a set."""
+        return set(self.data.get(key, set()))
+
+    def srem(self, key, member):
+        """Removes a member from a set."""
+        self.data.get(key, set()).discard(_encode(member))
+        self.versions[key] += 1
+        self._remove_if_empty(key)
+
+    def lpush(self, key, value):
+        """Pushes a value onto the head of a list."""
+        self.data.setdefault(key, []).insert(0, _encode(value))
+        self.versions[key] += 1
+
+    def rpoplpush(self, source, destination):
+        """Moves the tail of a list onto the head of another, returning it."""
+        if not self.data.get(source):
+            return None
+        value = self.data[source].pop()
+        self.versions[source] += 1
+        self._remove_if_empty(source)
+        self.lpush(destination, value)
+        return value
+
+    def lrem(self, key, count, value):
+        """Removes up to `count` occurrences of a value from a list."""
+        values = self.data.get(key, [])
+        for _ in range(count):
+            if _encode(value) not in values:
+                break
+            values.remove(_encode(value))
+            self.versions[key] += 1
+        self._remove_if_empty(key)
+
+    def llen(self, key):
+        """Returns the length of a list."""
+        return len(self.data.get(key, []))
+
+    def delete(self, *keys):
+        """Deletes keys."""
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                self.versions[key] += 1
+
+    def _remove_if_empty(self, key):
+        if key in self.data and not self.data[key]:
+            del self.data[key]
+
+
+class FakePipeline:
+    """Buffers commands for a `FakeRedis` until executed.
+
+    As with redis-py, once keys are watched commands are run immediately,
+    until `multi()` starts buffering them for a transaction, which fails
+    with `WatchError` if a watched key has been written to since.
+    """
+
+    def __init__(self, redis):
+        """Initialises an empty pipeline."""
+        self.redis = redis
+        self.commands = []
+        self.watched = None
+        self.buffering = True
+
+    def __enter__(self):
+        """Returns the pipeline."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Resets the pipeline."""
+        self.reset()
+
+    def __getattr__(self, name):
+        """Returns a function that buffers (or runs) a call to the named command."""
+        method = getattr(self.redis, name)
+        if not self.buffering:
+            return method
+        return lambda *args: self.commands.append((method, args))
+
+    def watch(self, *keys):
+        """Watches keys for changes, running commands immediately until `multi()`."""
+        if self.watched is None:
+            self.watched = {}
+        for key in keys:
+            self.watched.setdefault(key, self.redis.versions[key])
+        self.buffering = False
+
+    def multi(self):
+        """Starts buffering commands for a transaction."""
+        self.buffering = True
+
+    def execute(self):
+        """Applies the buffered commands, unless a watched key has changed."""
+        changed = any(self.redis.versions[key] != version for key, version in (self.watched or {}).items())
+        commands = self.commands
+        self.reset()
+        if changed:
+            raise WatchError('Watched variable changed.')
+        return [method(*args) for method, args in commands]
+
+    def reset(self):
+        """Discards the buffered commands, and stops watching keys."""
+        self.commands = []
+        self.watched = None
+        self.buffering = True
+
+
+def _encode(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
@@ -0,0 +1,81 @@
+import datetime
+import hashlib
+from unittest import mock
+
+import botocore
+
+from scraper import blobs, record
+
+
+def _digest(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def _record(body):
+    """Returns a deduplicated record for a response body."""
+    return record.pack(*blobs.split({'status': 200}, {'response_body': body}))
+
+
+def _get_object(objects):
+    def get_object(bucket, key, size=None):
+        if key not in objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return objects[key][:size]
+    return get_object
+
+
+def test_split_and_join():
+    """Tests that entries are split into a body-less entry and body, and joined back."""
+    metadata, parts = blobs.split({'status': 200}, {'response_headers': b"X: y", 'response_body': b"body"})
+    assert metadata == {'status': 200, 'body_sha256': _digest(b"body"), 'body_blob': True}
+    assert parts == {'response_headers': b"X: y", 'response_body': b""}
+    assert blobs.referenced(metadata) == _digest(b"body")
+    assert blobs.join(metadata, parts, b"body") == (
+        {'status': 200, 'body_sha256': _digest(b"body")}, {'response_headers': b"X: y", 'response_body': b"body"})
+    assert blobs.referenced(blobs.join(metadata, parts, b"body")[0]) is None
+
+
+def test_get_record():
+    """Tests that records are downloaded with their bodies in place."""
+    objects = {
+        "CACHE/a/1/record": _record(b"body"),
+        "CACHE/b/2/record": record.pack({'status': 200}, {'response_body': b"inline"}),
+        "CACHE/c/3/record": _record(b"missing"),
+        blobs.blob_key(_digest(b"body")): blobs.pack(b"body", compress=True),
+    }
+    with mock.patch("scraper.blobs.s3.get_object", _get_object(objects)):
+        metadata, parts = record.unpack(blobs.get_record(None, "CACHE/a/1/record"))
+        assert metadata == {'status': 200, 'body_sha256': _digest(b"body")}
+        assert parts['response_body'] == b"body"
+        assert blobs.get_record(None, "CACHE/b/2/record") == objects["CACHE/b/2/record"]
+        assert blobs.get_record(None, "CACHE/c/3/record") == objects["CACHE/c/3/record"]
+
+
+def test_gc_deletes_old_unreferenced_blobs():
+    """Tests that only blobs that are unreferenced and old are deleted."""
+    old = datetime.datetime(2017, 1, 1, tzinfo=datetime.timezone.utc)
+    new = datetime.datetime.now(datetime.timezone.utc)
+    listing = {
+        "BLOBS/": [
+            {'Key': blobs.blob_key(_digest(b"referenced")), 'LastModified': old},
+            {'Key': blobs.blob_key(_digest(b"unreferenced")), 'LastModified': old},
+            {'Key': blobs.blob_key(_digest(b"recent")), 'LastModified': new}],
+        "CACHE/": [
+            {'Key': "CACHE/a/1/record"},
+            {'Key': "CACHE/b/2/pickled_meta"},
+            {'Key': "CACHE/c/3/record"}],
+    }
+    objects = {
+        "CACHE/a/1/record": _record(b"referenced"),
+        "CACHE/c/3/record": record.pack({'status': 200}, {'response_body': b"inline"}),
+    }
+    bucket = mock.Mock()
+    with mock.patch("scraper.blobs.s3.list_objects", lambda bucket, prefix: listing[prefix]), \
+            mock.patch("scraper.blobs.s3.get_object", _get_object(objects)):
+        assert blobs.gc(bucket, dry_run=True)['unreferenced'] == 1
+        assert not bucket.delete_objects.called
+        result = blobs.gc(bucket, threads=2)
+
+    assert result == {'blobs': 3, 'referenced': 1, 'deleted': 1, 'unreferenced': 1}
+    bucket.delete_objects.assert_called_once_with(
+        Delete={'Objects': [{'Key': blobs.blob_key(_digest(b"unreferenced"))}]})
@@ -0,0 +1,257 @@
+import datetime
+import functools
+import json
+import os
+import tempfile
+from unittest import mock
+
+from scraper import blobs, collect, record
+
+
+def _page(*uris, entity_type="Microsoft.Crm.Sdk.Data.Services.Contact", page=""):
+    """Returns a response body containing records with the given URIs."""
+    results = [{'__metadata': {'uri': uri, 'type': entity_type}, 'Name': uri, 'Page': page} for uri in uris]
+    return json.dumps({'d': {'results': results}}).encode('utf-8')
+
+
+def _write(path, data):
+    """Writes a file, creating its directory."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _summaries(objects, stored=datetime.datetime(2017, 2, 14, tzinfo=datetime.timezone.utc)):
+    """Returns S3 object summaries for a dict of objects."""
+    return [{'Key': key, 'LastModified': stored, 'Size': len(objects[key])} for key in sorted(objects)]
+
+
+def test_collect_data_yields_results():
+    """Tests that records are yielded, and service documents and counts are skipped."""
+    items = [
+        _page("a", "b"),
+        json.dumps({'d': {'EntitySets': ["ContactSet"]}}),
+        json.dumps({'error': {}}),
+        b'1234',
+    ]
+    assert [item['Name'] for item in collect.collect_data(items)] == ["a", "b"]
+
+
+def test_writer_pool_limits_open_files():
+    """Tests that the least recently used file is closed when full."""
+    with tempfile.TemporaryDirectory() as directory:
+        with collect.WriterPool(directory, max_open=2) as writers:
+            writers.write("A", ["1"])
+            writers.write("B", ["2"])
+            writers.write("A", ["3"])
+            writers.write("C", ["4"])
+            assert list(writers._writers) == ["A", "C"]
+            writers.write("B", ["5"])
+
+        with open(os.path.join(directory, "A.jsonlines")) as f:
+            assert f.read() == "1\n3\n"
+        with open(os.path.join(directory, "B.jsonlines")) as f:
+            assert f.read() == "2\n5\n"
+
+
+def test_export_reads_records_and_legacy_bodies():
+    """Tests exporting from a local copy of the cache."""
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, "cache")
+        output_dir = os.path.join(directory, "output")
+        _write(os.path.join(input_dir, "ContactSet", "1", "response_body"), _page("a"))
+        _write(os.path.join(input_dir, "ContactSet", "1", "pickled_meta"), b"")
+        _write(os.path.join(input_dir, "ContactSet", "2", "record"), record.pack(
+            {'status': 200}, {'response_body': _page("b")}, compress=True))
+        _write(os.path.join(input_dir, "ContactSet", "3", "record"), record.pack(
+            {'status': 302}, {'response_body': b"<title>Object moved</title>"}))
+        _write(os.path.join(input_dir, "AccountSet", "4", "response_body"), _page(
+            "c", entity_type="Microsoft.Crm.Sdk.Data.Services.Account"))
+
+        paths = collect.local_cache(input_dir, ordered=True)
+        assert collect.export(paths, output_dir, processes=1, ordered=True) == 4
+
+        with open(os.path.join(output_dir, "Contact.jsonlines")) as f:
+            assert [json.loads(line)['Name'] for line in f] == ["a", "b"]
+        with open(os.path.join(output_dir, "Account.jsonlines")) as f:
+            assert [json.loads(line)['Name'] for line in f] == ["c"]
+
+
+def test_export_reads_deduplicated_bodies_from_blobs():
+    """Tests exporting records whose bodies were deduplicated into blobs."""
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, "cache", "CACHE")
+        blob_dir = os.path.join(directory, "cache", "BLOBS")
+        output_dir = os.path.join(directory, "output")
+        body = _page("a")
+        metadata, parts = blobs.split({'status': 200}, {'response_body': body})
+        for fingerprint in ("1", "2"):
+            _write(os.path.join(input_dir, "ContactSet", fingerprint, "record"), record.pack(metadata, parts))
+        _write(os.path.join(blob_dir, metadata['body_sha256']), blobs.pack(body, compress=True))
+        missing, parts = blobs.split({'status': 200}, {'response_body': _page("b")})
+        _write(os.path.join(input_dir, "ContactSet", "3", "record"), record.pack(missing, parts))
+
+        paths = collect.local_cache(input_dir, ordered=True)
+        parse = functools.partial(collect._parse_path, blob_dir=blob_dir)
+        assert collect.export(paths, output_dir, processes=1, ordered=True, parse=parse) == 3
+
+        with open(os.path.join(output_dir, "Contact.jsonlines")) as f:
+            assert [json.loads(line)['Name'] for line in f] == ["a", "a"]
+
+
+def test_export_s3():
+    """Tests exporting directly from the S3 cache bucket."""
+    objects = {
+        "CACHE/ContactSet/1/pickled_meta": b"",
+        "CACHE/ContactSet/1/response_body": _page("a"),
+        "CACHE/ContactSet/2/record": record.pack({'status': 200}, {'response_body': _page("b")}),
+        "CACHE/ContactSet/2/response_body": _page("b"),
+        "CACHE/ContactSet/3/request_body": b"",
+    }
+    bucket = object()
+    with tempfile.TemporaryDirectory() as directory, \
+            mock.patch("scraper.collect.s3.list_objects", return_value=_summaries(objects)), \
+            mock.patch("scraper.collect.s3.get_object", lambda bucket, key: objects[key]):
+        assert list(collect.s3_cache(bucket)) == [
+            "CACHE/ContactSet/1/response_body",
+            "CACHE/ContactSet/2/record"]
+        assert collect.export_s3(bucket, directory, threads=2, processes=1) == 2
+
+        with open(os.path.join(directory, "Contact.jsonlines")) as f:
+            assert [json.loads(line)['Name'] for line in f] == ["a", "b"]
+
+
+def test_entity_set_name():
+    """Tests that the entity set is extracted from cache paths."""
+    path = "CACHE/XRMServices/2011/OrganizationData.svc/ContactSet?$skiptoken=1/abc/record"
+    assert collect.entity_set_name(path) == "ContactSet"
+    assert collect.entity_set_name("cache/OrganizationData.svc/AccountSet/abc/response_body") == "AccountSet"
+
+
+def test_incremental_export():
+    """Tests that only entries stored since the last export are exported."""
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, "OrganizationData.svc")
+        output_dir = os.path.join(directory, "output")
+        args = mock.Mock(input_dir=input_dir, output_dir=output_dir, s3=False)
+        options = {'processes': 1, 'max_open': 64}
+
+        def add(name, timestamp, *uris):
+            path = os.path.join(input_dir, "ContactSet?$skiptoken=" + name, "response_body")
+            _write(path, _page(*uris, page=name))
+            os.utime(path, (timestamp, timestamp))
+
+        add("1", 1000, "a", "b")
+        with mock.patch("time.strftime", return_value=".delta-1"):
+            collect.export_incremental(args, dict(options))
+
+        add("2", 2000, "b", "c")
+        add("3", 3000, "c", "d")
+        with mock.patch("time.strftime", return_value=".delta-2"):
+            collect.export_incremental(args, dict(options))
+
+        def read(name):
+            with open(os.path.join(output_dir, name)) as f:
+                return [(record['Name'], record['Page']) for record in map(json.loads, f)]
+
+        # Stored in the same second as the previous export's watermark
+        add("4", 3000, "e")
+        with mock.patch("time.strftime", return_value=".delta-3"):
+            collect.export_incremental(args, dict(options))
+
+        assert [name for name, _ in read("Contact.delta-1.jsonlines")] == ["a", "b"]
+        assert read("Contact.delta-2.jsonlines") == [("c", "3"), ("d", "3"), ("b", "2")]
+        assert read("Contact.delta-3.jsonlines") == [("e", "4")]
+        with open(os.path.join(output_dir, collect.WATERMARKS_FILENAME)) as f:
+            marks = json.load(f)
+        assert marks["ContactSet"]["timestamp"] == 3000
+        assert [os.path.basename(os.path.dirname(name)) for name in marks["ContactSet"]["names"]] == [
+            "ContactSet?$skiptoken=3", "ContactSet?$skiptoken=4"]
+
+
+def test_filtered_incremental_export_keeps_its_own_watermarks():
+    """Tests that entries left out of a filtered export are exported by an unfiltered one."""
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, "OrganizationData.svc")
+        output_dir = os.path.join(directory, "output")
+        args = mock.Mock(input_dir=input_dir, output_dir=output_dir, s3=False)
+        for name, status in [("1", 200), ("2", 500)]:
+            path = os.path.join(input_dir, "ContactSet?$skiptoken=" + name, "record")
+            _write(path, record.pack({'status': status}, {'response_body': _page(name, page=name)}))
+            os.utime(path, (1000, 1000))
+
+        select = collect.ResponseFilter([200])
+        with mock.patch("time.strftime", return_value=".delta-1"):
+            collect.export_incremental(args, {'processes': 1, 'max_open': 64, 'select': select})
+        with mock.patch("time.strftime", return_value=".delta-2"):
+            collect.export_incremental(args, {'processes': 1, 'max_open': 64})
+        with mock.patch("time.strftime", return_value=".delta-3"):
+            collect.export_incremental(args, {'processes': 1, 'max_open': 64, 'select': select})
+
+        def read(name):
+            path = os.path.join(output_dir, name)
+            if not os.path.exists(path):
+                return []
+            with open(path) as f:
+                return sorted(record['Name'] for record in map(json.loads, f))
+
+        assert read("Contact.delta-1.jsonlines") == ["1"]
+        assert read("Contact.delta-2.jsonlines") == ["1", "2"]
+        assert read("Contact.delta-3.jsonlines") == []
+        with open(os.path.join(output_dir, collect.WATERMARKS_FILENAME)) as f:
+            assert sorted(json.load(f)) == ["ContactSet", "ContactSet?status=200"]
+
+
+def test_watermarks_of_older_exports_are_loaded():
+    """Tests that watermarks saved as bare timestamps are still read."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, collect.WATERMARKS_FILENAME)
+        with open(path, "w") as f:
+            json.dump({"ContactSet": 3000}, f)
+
+        watermarks = collect.Watermarks(path)
+        names = ["CACHE/OrganizationData.svc/ContactSet/{}/record".format(i) for i in range(3)]
+        entries = list(zip(names, [2000, 3000, 3000]))
+        assert watermarks.select_changed(entries) == [names[2], names[1]]
+        assert watermarks.select_changed(entries) == []
+        assert watermarks.names == {"ContactSet": set(names[1:])}
+
+
+def test_export_selects_by_metadata():
+    """Tests that responses are selected by status and time without reading other bodies."""
+    def cached(name, status, timestamp):
+        return record.pack({'status': status, 'timestamp': timestamp}, {'response_body': _page(name)}, compress=True)
+
+    objects = {
+        "CACHE/ContactSet/1/record": cached("a", 200, 1000),
+        "CACHE/ContactSet/2/record": cached("b", 200, 3000),
+        "CACHE/ContactSet/3/record": cached("c", 500, 2000),
+        "CACHE/ContactSet/4/meta": repr({'status': 200, 'timestamp': 2000.0}).encode('utf8'),
+        "CACHE/ContactSet/4/response_body": _page("d"),
+    }
+    select = collect.ResponseFilter([200], since=collect.parse_time("1970-01-01T00:25:00"))
+    assert select.since == 1500
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_dir = os.path.join(directory, "cache")
+        for key, data in objects.items():
+            _write(os.path.join(input_dir, key), data)
+        paths = collect.local_cache(input_dir, ordered=True)
+        assert collect.export(paths, os.path.join(directory, "local"), processes=1, ordered=True, select=select) == 4
+        with open(os.path.join(directory, "local", "Contact.jsonlines")) as f:
+            assert [json.loads(line)['Name'] for line in f] == ["b", "d"]
+
+        requested = []
+
+        def get_object(bucket, key, size=None):
+            requested.append((key, size))
+            return objects[key][:size]
+
+        with mock.patch("scraper.collect.s3.list_objects", return_value=_summaries(objects)), \
+                mock.patch("scraper.collect.s3.get_object", get_object):
+            assert collect.export_s3(object(), os.path.join(directory, "s3"), threads=2, processes=1,
+                                     select=select) == 4
+        with open(os.path.join(directory, "s3", "Contact.jsonlines")) as f:
+            assert sorted(json.loads(line)['Name'] for line in f) == ["b", "d"]
+        assert sorted(key for key, size in requested if size is None) == [
+            "CACHE/ContactSet/2/record", "CACHE/ContactSet/4/meta", "CACHE/ContactSet/4/response_body"]
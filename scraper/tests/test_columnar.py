@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+from scraper import columnar
+
+
+def test_round_trip_with_schema_drift():
+    """Tests that records are read back, with the schema widened as needed."""
+    records = [
+        {'__metadata': {'uri': "a", 'type': "Contact"}, 'Age': 1, 'Name': "A"},
+        {'__metadata': {'uri': "b", 'type': "Contact"}, 'Age': 2.5, 'Name': None},
+        {'__metadata': {'uri': "c", 'type': "Contact"}, 'Age': "old", 'Email': "c@example.com"},
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "Contact.columns")
+        writer = columnar.ColumnarWriter(path, row_group_size=2)
+        for record in records:
+            writer.write(columnar.flatten(record))
+        writer.close()
+
+        assert writer.schema == {
+            '__metadata.uri': 'string',
+            '__metadata.type': 'string',
+            'Age': 'json',
+            'Name': 'string',
+            'Email': 'string',
+        }
+        read = list(columnar.read(path))
+        assert read[:2] == records[:2]
+        assert read[2] == dict(records[2], Name=None)
+
+        groups = list(columnar.read_columns(path, columns=['Age', 'Email']))
+        assert groups == [
+            {'Age': [1, 2.5], 'Email': [None, None]},
+            {'Age': ["old"], 'Email': ["c@example.com"]},
+        ]
+
+
+def test_append():
+    """Tests that row groups can be appended to an existing file."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "Contact.columns")
+        for i in range(2):
+            writer = columnar.ColumnarWriter(path)
+            writer.write({'Id': i})
+            writer.close()
+        assert list(columnar.read(path)) == [{'Id': 0}, {'Id': 1}]
@@ -0,0 +1,100 @@
+from scraper.coordinator import claimed_key_prefix, Coordinator, lease_key_prefix
+from scraper.tests.fake_redis import FakeRedis
+
+
+def _item(name):
+    """Returns a work item for the first page of an entity set."""
+    return {'url': 'http://example.com/' + name, 'callback': 'parse_itempage', 'meta': {'entity_set': name}}
+
+
+def test_crawl_is_seeded_once():
+    """Tests that only the first worker seeds the crawl."""
+    redis = FakeRedis()
+    assert Coordinator(redis, 'a').seed([_item('ASet')])
+    assert not Coordinator(redis, 'b').seed([_item('ASet')])
+    assert Coordinator(redis, 'b').status()['queued'] == 1
+
+
+def test_claim_and_complete():
+    """Tests that claimed items are held by the worker until complete."""
+    redis = FakeRedis()
+    worker = Coordinator(redis, 'a')
+    worker.heartbeat()
+    worker.seed([_item('ASet'), _item('BSet')])
+
+    first = worker.claim()
+    assert first['url'] == 'http://example.com/ASet'
+    assert first['meta'] == {'entity_set': 'ASet'}
+    second = worker.claim()
+    assert worker.claim() is None
+    worker.complete(first['work'])
+    assert worker.status() == {'seeded': True, 'done': False, 'queued': 0, 'claimed': {'a': 1}}
+    assert not worker.finished()
+
+    worker.complete(second['work'])
+    assert worker.finished()
+
+
+def test_finished_crawl_lets_the_next_crawl_be_seeded():
+    """Tests that once a crawl is finished, the next crawl is seeded afresh."""
+    redis = FakeRedis()
+    first, second = Coordinator(redis, 'a'), Coordinator(redis, 'b')
+    first.heartbeat()
+    first.seed([_item('ASet')])
+    first.complete(first.claim()['work'])
+    assert first.finished()
+    assert second.finished()
+
+    assert second.seed([_item('ASet')])
+    assert not first.finished()
+    assert first.status()['queued'] == 1
+
+
+def test_work_queued_while_checking_is_not_missed():
+    """Tests that a crawl isn't finished by work moving between the queue and a worker."""
+    class RacingRedis(FakeRedis):
+        def llen(self, key):
+            if key == claimed_key_prefix + 'b' and other_work:
+                # The other worker queues a follow-up, then completes its item
+                other.put(_item('BSet'))
+                other.complete(other_work.pop())
+            return super().llen(key)
+
+    redis = RacingRedis()
+    worker, other = Coordinator(redis, 'a'), Coordinator(redis, 'b')
+    worker.heartbeat()
+    other.heartbeat()
+    worker.seed([_item('ASet')])
+    other_work = [other.claim()['work']]
+
+    assert not worker.finished()
+    assert worker.status() == {'seeded': True, 'done': False, 'queued': 1, 'claimed': {'a': 0, 'b': 0}}
+    other.complete(other.claim()['work'])
+    assert worker.finished()
+
+
+def test_reap_requeues_work_of_expired_workers():
+    """Tests that a dead worker's claimed items are claimed by another."""
+    redis = FakeRedis()
+    dead, alive = Coordinator(redis, 'dead'), Coordinator(redis, 'alive')
+    dead.heartbeat()
+    alive.heartbeat()
+    dead.seed([_item('ASet')])
+    dead.claim()
+
+    assert alive.reap() == 0
+    redis.delete(lease_key_prefix + 'dead')
+    assert alive.reap() == 1
+    assert alive.claim()['url'] == 'http://example.com/ASet'
+    assert alive.status()['claimed'] == {'alive': 1}
+
+
+def test_leave_requeues_claimed_work():
+    """Tests that a worker leaving hands back its claimed items."""
+    redis = FakeRedis()
+    worker = Coordinator(redis, 'a')
+    worker.heartbeat()
+    worker.seed([_item('ASet')])
+    worker.claim()
+    worker.leave()
+    assert worker.status() == {'seeded': True, 'done': False, 'queued': 1, 'claimed': {}}
@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+import scrapy
+from scrapy.http import Response
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+
+from scraper import crawlstats
+from scraper.items import ScraperItem
+
+
+def _make_stats():
+    """Returns an empty stats collector."""
+    return MemoryStatsCollector(mock.Mock(settings=Settings()))
+
+
+def test_histogram_percentiles():
+    """Tests that percentiles are reported as bucket bounds."""
+    histogram = crawlstats.Histogram(buckets=(10, 100, 1000))
+    assert histogram.percentile(50) is None
+    for value in [5] * 50 + [50] * 40 + [500] * 9 + [5000]:
+        histogram.add(value)
+
+    summary = histogram.to_dict()
+    assert (summary['p50'], summary['p90'], summary['p99']) == (10, 100, 1000)
+    assert summary['buckets'] == {'le_10': 50, 'le_100': 40, 'le_1000': 9, 'inf': 1}
+    assert summary['max'] == 5000
+    assert histogram.percentile(100) == 5000
+
+
+def test_observe_creates_histograms():
+    """Tests that values are added to a histogram held in the stats."""
+    stats = _make_stats()
+    crawlstats.observe(stats, 'download/latency_ms', 3)
+    crawlstats.observe(stats, 'download/latency_ms', 7)
+    crawlstats.observe(None, 'download/latency_ms', 7)
+    assert stats.get_value('download/latency_ms').count == 2
+
+
+def test_extension_writes_entity_set_rates():
+    """Tests that per entity set counts and rates are written as JSON lines."""
+    stats = _make_stats()
+    clock = mock.Mock(return_value=100.0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'stats.jsonl')
+        extension = crawlstats.CrawlStats(stats, interval=0, path=path, clock=clock)
+        extension.spider_opened(None)
+
+        url = 'http://cdms.example.com/ContactSet'
+        request = scrapy.Request(url, meta={'entity_set': 'ContactSet', 'download_latency': 0.25})
+        extension.response_received(Response(url, body=b'{}', request=request), request, None)
+        cached = Response(url, body=b'{}', request=request, flags=['cached'])
+        extension.response_received(cached, request, None)
+        for _ in range(4):
+            extension.item_scraped(ScraperItem(entity_set='ContactSet'), None)
+        clock.return_value = 102.0
+        extension.write()
+        clock.return_value = 104.0
+        extension.spider_closed(None, 'finished')
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+
+    assert [line['final'] for line in lines] == [False, True]
+    assert lines[0]['rates'] == {'ContactSet': {'pages_per_second': 1.0, 'records_per_second': 2.0}}
+    assert lines[1]['rates'] == {'ContactSet': {'pages_per_second': 0.5, 'records_per_second': 1.0}}
+    stats = lines[1]['stats']
+    assert stats['entity_sets/ContactSet/bytes'] == 4
+    assert stats['entity_sets/ContactSet/latency_ms']['count'] == 1
+    assert stats['download/latency_ms']['p50'] == 500
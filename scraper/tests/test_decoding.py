@@ -0,0 +1,71 @@
+import json
+from unittest.mock import patch
+
+from scraper import decoding
+
+
+def _page(next_url=None, **extra):
+    """Returns the body of a page of entities, as the service encodes it."""
+    data = {'d': {'results': [
+        {'__metadata': {'uri': "http://example.com/ContactSet('a')", 'type': "Microsoft.Crm.Sdk.Data.Services.Contact"},
+         'Name': "a", 'Children': {'results': [], '__next': "http://example.com/Nested"}},
+    ]}}
+    data['d'].update(extra)
+    if next_url:
+        data['d']['__next'] = next_url
+    return json.dumps(data).replace('/', '\\/').encode('utf-8')
+
+
+def test_loads():
+    """Tests that bodies are decoded from bytes and text."""
+    body = _page("http://example.com/ContactSet?$skiptoken=1")
+    assert decoding.loads(body) == json.loads(body.decode('utf-8'))
+    assert decoding.loads(body.decode('utf-8')) == json.loads(body.decode('utf-8'))
+
+
+def test_loads_without_orjson():
+    """Tests that bodies are decoded by the standard library if orjson isn't installed."""
+    body = _page()
+    with patch.object(decoding, 'orjson', None):
+        assert decoding.loads(body) == json.loads(body.decode('utf-8'))
+
+
+def test_loads_unpaired_surrogates():
+    """Tests that strings orjson rejects are still decoded."""
+    assert decoding.loads(b'{"a": "\\ud800"}') == {'a': '\ud800'}
+
+
+def test_next_link():
+    """Tests that the next page link is found without decoding the page."""
+    body = _page("http://example.com/ContactSet?$skiptoken=1,'a'")
+    with patch.object(decoding, 'loads') as loads:
+        assert decoding.next_link(body) == "http://example.com/ContactSet?$skiptoken=1,'a'"
+        assert decoding.next_link(body + b'\n') == "http://example.com/ContactSet?$skiptoken=1,'a'"
+    assert not loads.called
+
+
+def test_next_link_last_page():
+    """Tests that a page not mentioning `__next` has no next page link."""
+    assert decoding.next_link(json.dumps({'d': {'results': []}})) is None
+
+
+def test_next_link_nested():
+    """Tests that `__next` links of nested collections are ignored."""
+    assert decoding.next_link(_page()) is None
+    assert decoding.next_link(_page(__count="1")) is None
+
+
+def test_next_link_unexpected_order():
+    """Tests that the page is decoded if `__next` isn't its last member."""
+    body = b'{"d": {"__next": "http://example.com/ContactSet?$skiptoken=1", "results": []}}'
+    assert decoding.next_link(body) == "http://example.com/ContactSet?$skiptoken=1"
+
+
+def test_next_link_invalid():
+    """Tests that bodies that aren't JSON are rejected."""
+    try:
+        decoding.next_link(b'<html><title>Object moved</title></html>')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected ValueError')
@@ -0,0 +1,47 @@
+import os
+import tempfile
+
+from scraper.diskcache import DiskCache
+
+
+def test_get_and_put():
+    """Tests that stored values are returned."""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(directory, max_bytes=100)
+        cache.open()
+        assert cache.get("aaaa") is None
+        cache.put("aaaa", b"value")
+        assert cache.get("aaaa") == b"value"
+        assert os.path.exists(os.path.join(directory, "aa", "aaaa"))
+
+
+def test_least_recently_used_entries_are_evicted():
+    """Tests that the total size is kept under the limit."""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(directory, max_bytes=25)
+        cache.open()
+        cache.put("aaaa", b"x" * 10)
+        cache.put("bbbb", b"x" * 10)
+        cache.get("aaaa")
+        cache.put("cccc", b"x" * 10)
+
+        assert cache.size == 20
+        assert "aaaa" in cache
+        assert "bbbb" not in cache
+        assert cache.get("bbbb") is None
+        assert not os.path.exists(os.path.join(directory, "bb", "bbbb"))
+
+
+def test_open_loads_existing_entries():
+    """Tests that entries stored by a previous run are found again."""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = DiskCache(directory, max_bytes=100)
+        cache.open()
+        cache.put("aaaa", b"value")
+        cache.put("bbbb", b"other value")
+
+        reopened = DiskCache(directory, max_bytes=100)
+        reopened.open()
+        assert len(reopened) == 2
+        assert reopened.size == 16
+        assert reopened.get("bbbb") == b"other value"
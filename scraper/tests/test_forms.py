@@ -0,0 +1,72 @@
+import os
+from unittest import mock
+
+from scraper import auth
+from scraper.forms import parse_form, parse_form_pyquery
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def _fixture(name):
+    """Returns the contents of a fixture page."""
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def test_login_page():
+    """Tests that the login form's action and input names are extracted."""
+    form = parse_form(_fixture('adfs_login.html'))
+    assert form.action.startswith('FormsSignIn.aspx?wa=wsignin1.0&wtrealm=')
+    assert form.field_name('Username') == 'ctl00$ContentPlaceHolder1$UsernameTextBox'
+    assert form.field_name('Password') == 'ctl00$ContentPlaceHolder1$PasswordTextBox'
+    assert form.field_name('Missing') is None
+    assert form.data()['__VIEWSTATE'] == '/wEPDwUKMTM4NjQwNTQ2NWRkR3m0B4R5XK&Pp+9qvJ0HgYHw='
+    assert form.data()['ctl00$ContentPlaceHolder1$UsernameTextBox'] is None
+
+
+def test_token_page():
+    """Tests that escaped token values are unescaped."""
+    form = parse_form(_fixture('adfs_token.html'))
+    assert form.action == 'https://sts.example.com/adfs/ls/'
+    data = form.data()
+    assert data['wresult'].startswith('<t:RequestSecurityTokenResponse xmlns:t="http://')
+    assert data['wctx'] == 'rm=0&id=passive&ru=%2f'
+    assert data[None] == 'Submit'
+
+
+def test_matches_pyquery():
+    """Tests that forms are extracted as they were with PyQuery."""
+    for name in ('adfs_login.html', 'adfs_token.html'):
+        source = _fixture(name)
+        fast, slow = parse_form(source), parse_form_pyquery(source)
+        assert (fast.action, fast.fields) == (slow.action, slow.fields), name
+
+
+def test_submit_form():
+    """Tests that a form is submitted with its inputs and the given params."""
+    session = mock.Mock()
+    session.post.return_value = mock.Mock(ok=True, content=_fixture('adfs_token.html'))
+    auth._submit_form(session, _fixture('adfs_login.html'), url='https://adfs.example.com/',
+                      params={'ctl00$ContentPlaceHolder1$UsernameTextBox': 'mr_flibble'})
+
+    url, data = session.post.call_args[0]
+    assert url == 'https://adfs.example.com/'
+    assert data['ctl00$ContentPlaceHolder1$UsernameTextBox'] == 'mr_flibble'
+    assert '__EVENTVALIDATION' in data
+
+
+def test_skips_comments_and_scripts():
+    """Tests that tags in comments and scripts are ignored."""
+    form = parse_form(
+        '<!-- <form action="commented"> --><script>var s = "<input name=\'script\'>";</script>'
+        '<FORM ACTION=real><INPUT NAME=a VALUE=1><input name="b" value=\'2\' disabled></form>')
+    assert (form.action, form.fields) == ('real', [('a', '1'), ('b', '2')])
+
+
+def test_falls_back_to_pyquery():
+    """Tests that PyQuery parses forms the scanner can't."""
+    source = '<form action="broken><input name="a" value="1"></form>'
+    with mock.patch('scraper.forms.parse_form_pyquery', wraps=parse_form_pyquery) as fallback:
+        form = parse_form(source)
+    fallback.assert_called_once_with(source)
+    assert form.action == parse_form_pyquery(source).action
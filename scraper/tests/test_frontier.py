@@ -0,0 +1,46 @@
+from unittest.mock import Mock, patch
+
+from scraper.frontier import chain_id, Frontier
+from scraper.tests.fake_redis import FakeRedis
+
+
+def test_updates_are_batched():
+    """Tests that updates are only sent to Redis once a batch is full."""
+    redis = FakeRedis()
+    frontier = Frontier(redis, batch_size=3)
+    frontier.add('http://example.com/a', {'entity_set': 'ASet'})
+    frontier.add('http://example.com/b', {'entity_set': 'BSet'})
+    assert redis.data == {}
+
+    frontier.remove('http://example.com/a')
+    assert redis.data == {Frontier.pending_key: {b'http://example.com/b': b'{"entity_set": "BSet"}'}}
+
+
+def test_updates_are_flushed_after_interval():
+    """Tests that buffered updates are sent once the flush interval passes."""
+    redis = FakeRedis()
+    frontier = Frontier(redis, batch_size=100, flush_interval=5)
+    with patch('scraper.frontier.time.monotonic', side_effect=[0, 1, 6, 6, 6]):
+        frontier.add('http://example.com/a', {'entity_set': 'ASet'})
+        frontier.mark_done('BSet')
+        assert redis.data == {}
+        frontier.mark_done('CSet')
+    assert redis.data[Frontier.done_key] == {b'BSet', b'CSet'}
+
+
+def test_flush_records_stats():
+    """Tests that flushes are counted and timed."""
+    stats = Mock()
+    frontier = Frontier(FakeRedis(), stats=stats)
+    frontier.mark_done('ASet')
+    frontier.mark_done('BSet')
+    assert frontier.done() == {'ASet', 'BSet'}
+    stats.inc_value.assert_any_call('frontier/flushes')
+    stats.inc_value.assert_any_call('frontier/updates', 2)
+    assert stats.max_value.call_args[0][0] == 'frontier/flush_seconds_max'
+
+
+def test_chain_id():
+    """Tests that partitions of an entity set are separate chains."""
+    assert chain_id({'entity_set': 'ASet'}) == 'ASet'
+    assert chain_id({'entity_set': 'ASet', 'partition': 0, 'remaining': 10}) == 'ASet#0'
@@ -0,0 +1,115 @@
+from unittest import mock
+
+import scrapy
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Response
+from scrapy.settings import Settings
+from twisted.internet import defer
+
+from scraper.middleware import DeferredHttpCacheMiddleware
+
+URL = 'http://cdms.example.com/ContactSet'
+
+
+def _make_middleware(**settings):
+    """Returns the middleware with a mock storage and stats."""
+    settings = Settings(dict({'HTTPCACHE_ENABLED': True, 'HTTPCACHE_IGNORE_HTTP_CODES': [500]}, **settings))
+    middleware = DeferredHttpCacheMiddleware(settings, mock.Mock())
+    middleware.storage = mock.Mock()
+    return middleware
+
+
+def _results(d):
+    """Returns lists collecting the results and failures of a Deferred."""
+    results, failures = [], []
+    d.addCallbacks(results.append, failures.append)
+    return results, failures
+
+
+def _stats(middleware):
+    """Returns the names of the stats incremented by the middleware."""
+    return [args[0] for args, _ in middleware.stats.inc_value.call_args_list]
+
+
+def test_deferred_store_is_waited_on():
+    """Tests that the response is returned once the storage's Deferred fires."""
+    middleware = _make_middleware()
+    request = scrapy.Request(URL)
+    response = Response(URL, body=b'{}', request=request)
+    stored = middleware.storage.store_response.return_value = defer.Deferred()
+
+    results, failures = _results(middleware.process_response(request, response, None))
+    middleware.storage.store_response.assert_called_once_with(None, request, response)
+    assert results == []
+    stored.callback(None)
+    assert results == [response]
+    assert failures == []
+    assert _stats(middleware) == ['httpcache/firsthand', 'httpcache/store']
+
+    middleware.storage.store_response.return_value = None
+    assert middleware.process_response(request, response, None) is response
+
+
+def test_storage_errors_are_propagated():
+    """Tests that failed cache lookups and writes fail the request."""
+    middleware = _make_middleware()
+    request = scrapy.Request(URL)
+    middleware.storage.retrieve_response.side_effect = IOError('lookup failed')
+    _, failures = _results(middleware.process_request(request, None))
+    assert [failure.type for failure in failures] == [IOError]
+
+    response = Response(URL, body=b'{}', request=request)
+    middleware.storage.store_response.return_value = defer.fail(IOError('write failed'))
+    _, failures = _results(middleware.process_response(request, response, None))
+    assert [failure.type for failure in failures] == [IOError]
+
+    middleware = _make_middleware(HTTPCACHE_IGNORE_MISSING=True)
+    middleware.storage.retrieve_response.return_value = None
+    _, failures = _results(middleware.process_request(request, None))
+    assert [failure.type for failure in failures] == [IgnoreRequest]
+
+
+def test_cache_policy_is_checked():
+    """Tests that uncacheable requests and responses aren't looked up or stored."""
+    middleware = _make_middleware(HTTPCACHE_IGNORE_SCHEMES=['file'])
+    request = scrapy.Request('file:///tmp/ContactSet')
+    assert middleware.process_request(request, None) is None
+    middleware.storage.retrieve_response.assert_not_called()
+    response = Response(request.url, body=b'{}', request=request)
+    assert middleware.process_response(request, response, None) is response
+    assert '_dont_cache' not in request.meta
+
+    request = scrapy.Request(URL)
+    for response in [Response(URL, status=500, request=request),
+                     Response(URL, body=b'{}', request=request, flags=['cached'])]:
+        assert middleware.process_response(request, response, None) is response
+    request = scrapy.Request(URL, meta={'dont_cache': True})
+    response = Response(URL, body=b'{}', request=request)
+    assert middleware.process_response(request, response, None) is response
+
+    middleware.storage.store_response.assert_not_called()
+    assert _stats(middleware) == ['httpcache/firsthand', 'httpcache/uncacheable']
+
+
+def test_cached_responses_are_revalidated():
+    """Tests that stale cached responses are returned if still valid, else replaced."""
+    middleware = _make_middleware()
+    request = scrapy.Request(URL)
+    cached = Response(URL, body=b'{}', request=request)
+    middleware.storage.retrieve_response.return_value = cached
+    middleware.policy = mock.Mock()
+    middleware.policy.is_cached_response_fresh.return_value = False
+    results, _ = _results(middleware.process_request(request, None))
+    assert results == [None]
+    assert request.meta['cached_response'] is cached
+
+    response = Response(URL, status=304, request=request)
+    assert middleware.process_response(request, response, None) is cached
+    middleware.storage.store_response.assert_not_called()
+
+    request.meta['cached_response'] = cached
+    middleware.policy.is_cached_response_valid.return_value = False
+    middleware.storage.store_response.return_value = None
+    response = Response(URL, body=b'{"d": {}}', request=request)
+    assert middleware.process_response(request, response, None) is response
+    middleware.storage.store_response.assert_called_once_with(None, request, response)
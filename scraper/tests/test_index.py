@@ -0,0 +1,102 @@
+import hashlib
+from unittest import mock
+
+import botocore
+
+from scraper import index
+
+
+def _fingerprint(i):
+    return hashlib.sha1(str(i).encode()).hexdigest()
+
+
+def test_bloom_filter_has_no_false_negatives():
+    """Tests that every added digest is reported as present."""
+    bloom = index.BloomFilter(1000)
+    digests = [hashlib.sha1(str(i).encode()).digest() for i in range(1000)]
+    for digest in digests:
+        bloom.add(digest)
+    assert all(digest in bloom for digest in digests)
+
+    others = [hashlib.sha1(str(-i).encode()).digest() for i in range(1, 1001)]
+    assert sum(digest in bloom for digest in others) < 10
+
+
+def test_rebuild_lists_cache_keys():
+    """Tests that the base index is built from the record keys."""
+    keys = {
+        index.delta_key_prefix: ["INDEX/delta/1-abc"],
+        "CACHE/": [
+            "CACHE/a/b/{}/record".format(_fingerprint(1)),
+            "CACHE/a/{}/pickled_meta".format(_fingerprint(2)),
+            "CACHE/a/{}/response_body".format(_fingerprint(2)),
+            "CACHE/a/{}/response_body".format(_fingerprint(3))],
+    }
+    bucket = mock.Mock()
+    with mock.patch("scraper.index.s3.list_keys", lambda bucket, prefix: keys[prefix]), \
+            mock.patch("scraper.index.s3.put_object") as put:
+        digests = index.rebuild(bucket)
+
+    assert len(digests) == 2
+    [(_, (_, key, data), _)] = put.mock_calls
+    assert key == index.base_key
+    assert index._unpack_digests(data) == digests
+    bucket.delete_objects.assert_called_once_with(
+        Delete={'Objects': [{'Key': "INDEX/delta/1-abc"}]})
+
+
+def test_load_builds_missing_index_and_applies_deltas():
+    """Tests that the index is built if missing, and deltas are loaded."""
+    objects = {
+        "INDEX/delta/1-abc": index._pack_digests([bytes.fromhex(_fingerprint(2))]),
+    }
+
+    def get_object(bucket, key):
+        if key not in objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return objects[key]
+
+    fingerprint_index = index.FingerprintIndex(mock.Mock(), capacity=100)
+    with mock.patch("scraper.index.s3.get_object", get_object), \
+            mock.patch("scraper.index.s3.list_keys", return_value=list(objects)), \
+            mock.patch("scraper.index.rebuild", return_value=[bytes.fromhex(_fingerprint(1))]):
+        fingerprint_index.load()
+
+    assert _fingerprint(1) in fingerprint_index
+    assert _fingerprint(2) in fingerprint_index
+    assert _fingerprint(3) not in fingerprint_index
+
+    fingerprint_index.add(_fingerprint(3))
+    assert _fingerprint(3) in fingerprint_index
+    with mock.patch("scraper.index.s3.put_object") as put:
+        fingerprint_index.save()
+    [(_, (_, key, data), _)] = put.mock_calls
+    assert key.startswith(index.delta_key_prefix)
+    assert index._unpack_digests(data) == [bytes.fromhex(_fingerprint(3))]
+
+
+def test_new_fingerprints_are_flushed_periodically():
+    """Tests that deltas are written as fingerprints are added, not just at close."""
+    fingerprint_index = index.FingerprintIndex(mock.Mock(), capacity=100, flush_size=2)
+    with mock.patch("scraper.index.s3.put_object") as put:
+        fingerprint_index.add(_fingerprint(1))
+        fingerprint_index.flush()
+        assert not put.called
+
+        fingerprint_index.add(_fingerprint(2))
+        fingerprint_index.flush()
+        [(_, (_, _, data), _)] = put.mock_calls
+        assert index._unpack_digests(data) == [bytes.fromhex(_fingerprint(i)) for i in (1, 2)]
+
+        fingerprint_index.add(_fingerprint(3))
+        put.side_effect = IOError('upload failed')
+        try:
+            fingerprint_index.save()
+        except IOError:
+            pass
+        else:
+            raise AssertionError('Expected IOError')
+        put.side_effect = None
+        fingerprint_index.save()
+    assert index._unpack_digests(put.mock_calls[-1][1][2]) == [bytes.fromhex(_fingerprint(3))]
+    assert fingerprint_index.added == []
@@ -0,0 +1,61 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from scraper.items import ScraperItem
+from scraper.pipelines import ExportPipeline
+
+
+def _item(entity_type, name):
+    """Returns an item for a record."""
+    return ScraperItem(entity_set=entity_type + "Set", entity_type=entity_type,
+                       uri=name, data={'Name': name})
+
+
+def _read(path):
+    """Returns the names of the records in a JSON lines file."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line)['Name'] for line in f]
+
+
+def test_records_are_written_in_batches():
+    """Tests that records are buffered per entity type, and flushed on close."""
+    with tempfile.TemporaryDirectory() as directory, \
+            mock.patch("time.strftime", return_value="20170214T130000"):
+        pipeline = ExportPipeline(directory, batch_size=2, worker_id="w1")
+        pipeline.open_spider(None)
+        for item in [_item("Contact", "a"), _item("Account", "b"), _item("Contact", "c")]:
+            assert pipeline.process_item(item, None) is item
+
+        contacts = os.path.join(pipeline.run_dir, "Contact.20170214T130000-w1.jsonlines")
+        accounts = os.path.join(pipeline.run_dir, "Account.20170214T130000-w1.jsonlines")
+        pipeline.writers.close()
+        assert _read(contacts) == ["a", "c"]
+        assert _read(accounts) == []
+
+        pipeline.close_spider(None)
+        assert sorted(os.listdir(directory)) == [
+            "Account.20170214T130000-w1.jsonlines", "Contact.20170214T130000-w1.jsonlines"]
+        assert _read(os.path.join(directory, "Account.20170214T130000-w1.jsonlines")) == ["b"]
+
+
+def test_workers_and_runs_write_their_own_files():
+    """Tests that files are only moved into place on close, and never shared."""
+    with tempfile.TemporaryDirectory() as directory:
+        runs = []
+        for run, worker_id in [("1", "w1"), ("1", "w2"), ("2", "w1")]:
+            with mock.patch("time.strftime", return_value=run):
+                pipeline = ExportPipeline(directory, worker_id=worker_id)
+                pipeline.open_spider(None)
+            pipeline.process_item(_item("Contact", run + worker_id), None)
+            runs.append(pipeline)
+        assert [name for name in os.listdir(directory) if not name.startswith(".")] == []
+
+        for pipeline in runs:
+            pipeline.close_spider(None)
+        assert sorted(os.listdir(directory)) == [
+            "Contact.1-w1.jsonlines", "Contact.1-w2.jsonlines", "Contact.2-w1.jsonlines"]
+        assert _read(os.path.join(directory, "Contact.1-w2.jsonlines")) == ["1w2"]
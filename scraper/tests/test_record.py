@@ -0,0 +1,96 @@
+import io
+import zlib
+
+from scraper import record
+
+METADATA = {'status': 200, 'url': "http://example.com/req"}
+PARTS = {
+    'request_headers': b"Accept: application/json",
+    'request_body': b"",
+    'response_headers': b"Content-Type: application/json",
+    'response_body': b'{"d": {"results": []}}' * 1000,
+}
+
+
+def _codecs():
+    return [False, True] + [codec for codec in sorted(record.codecs)
+                            if codec != 'zstd' or record.zstd is not None]
+
+
+def test_pack_and_unpack():
+    """Tests that records round trip with each codec."""
+    for compress in _codecs():
+        data = record.pack(METADATA, PARTS, compress=compress)
+        assert record.unpack(data) == (METADATA, PARTS)
+        assert len(data) < len(PARTS['response_body']) or not compress
+
+
+def test_read_decompresses_in_chunks():
+    """Tests that records are read from file objects, a chunk at a time."""
+    for compress in _codecs():
+        for level in (None, 1):
+            fileobj = io.BytesIO(record.pack(METADATA, PARTS, compress=compress, level=level))
+            assert record.read(fileobj) == (METADATA, PARTS)
+
+
+def test_zlib_records_are_still_read():
+    """Tests reading records compressed before codecs could be chosen."""
+    payload = b''.join(
+        len(value).to_bytes(4, 'big') + value
+        for value in [b'{"status": 200}', b"", b"", b"", b"body"])
+    data = b'SCR\x01\x01' + zlib.compress(payload)
+    assert record.unpack(data) == ({'status': 200}, {
+        'request_headers': b"", 'request_body': b"", 'response_headers': b"", 'response_body': b"body"})
+    assert record.read(io.BytesIO(data)) == record.unpack(data)
+    assert record.unpack_metadata(data) == {"status": 200}
+
+
+def test_unpack_metadata_from_start_of_record():
+    """Tests that metadata is read from the start of a record, ahead of its compressed sections."""
+    for compress in _codecs():
+        data = record.pack(METADATA, PARTS, compress=compress)
+        assert record.unpack_metadata(data[:100]) == METADATA
+        try:
+            record.unpack_metadata(data[:20])
+        except record.RecordError:
+            pass
+        else:
+            raise AssertionError('Expected RecordError')
+
+
+def test_parse_legacy_metadata():
+    """Tests that legacy metadata is parsed as a literal, and nothing else."""
+    assert record.parse_legacy_metadata(repr(METADATA).encode('utf8')) == METADATA
+    try:
+        record.parse_legacy_metadata(b"__import__('os').system('echo unsafe')")
+    except record.RecordError:
+        pass
+    else:
+        raise AssertionError('Expected RecordError')
+
+
+def test_codec_name():
+    """Tests choosing codecs."""
+    assert record.codec_name(True) == 'zlib'
+    assert record.codec_name('gzip') == 'gzip'
+    for compress in (False, None, '', 'none'):
+        assert record.codec_name(compress) is None
+    try:
+        record.codec_name('lz4')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected ValueError')
+
+
+def test_truncated_records_are_rejected():
+    """Tests that truncated records raise a RecordError."""
+    for compress in _codecs():
+        data = record.pack(METADATA, PARTS, compress=compress)[:-10]
+        for read in (record.unpack, lambda data: record.read(io.BytesIO(data))):
+            try:
+                read(data)
+            except record.RecordError:
+                pass
+            else:
+                raise AssertionError('Expected RecordError')
@@ -0,0 +1,71 @@
+from unittest import mock
+
+import scrapy
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Response
+from scrapy.settings import Settings
+from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.python.failure import Failure
+
+from scraper.middleware import ReplayMiddleware
+from scraper.spiders import odata
+
+
+def _make_crawler(**settings):
+    """Returns a mock crawler with the given settings."""
+    return mock.Mock(settings=Settings(dict({'CACHE_REPLAY': True}, **settings)))
+
+
+def _process(middleware, request):
+    """Passes a request to the middleware, expecting it to be ignored."""
+    try:
+        middleware.process_request(request, None)
+    except IgnoreRequest:
+        pass
+    else:
+        raise AssertionError('Expected IgnoreRequest')
+
+
+def test_replay_middleware_is_disabled_by_default():
+    """Tests that the middleware is only enabled when replaying."""
+    try:
+        ReplayMiddleware.from_crawler(_make_crawler(CACHE_REPLAY=False))
+    except NotConfigured:
+        pass
+    else:
+        raise AssertionError('Expected NotConfigured')
+
+
+def test_replay_ignores_and_counts_misses():
+    """Tests that uncached requests are counted, and not downloaded."""
+    crawler = _make_crawler()
+    middleware = ReplayMiddleware.from_crawler(crawler)
+    for name in ('ContactSet', 'AccountSet'):
+        _process(middleware, scrapy.Request('http://cdms.example.com/{}'.format(name)))
+
+    assert crawler.stats.inc_value.call_count == 2
+    crawler.stats.inc_value.assert_called_with('replay/miss', spider=None)
+    crawler.engine.close_spider.assert_not_called()
+
+
+def test_replay_fails_fast():
+    """Tests that the first miss closes the spider when failing fast."""
+    crawler = _make_crawler(CACHE_REPLAY_FAIL_FAST=True)
+    middleware = ReplayMiddleware.from_crawler(crawler)
+    for name in ('ContactSet', 'AccountSet'):
+        _process(middleware, scrapy.Request('http://cdms.example.com/{}'.format(name)))
+
+    crawler.engine.close_spider.assert_called_once_with(None, 'cache_miss')
+
+
+def test_ignored_requests_are_not_retried():
+    """Tests that the spider drops ignored requests, but still retries 302s."""
+    spider = odata.OdataSpider()
+    request = scrapy.Request('http://cdms.example.com/ContactSet')
+    with mock.patch.object(odata, 'logger') as logger:
+        assert list(spider._handle_error(Failure(IgnoreRequest()))) == []
+    logger.error.assert_not_called()
+
+    response = Response(request.url, status=302, request=request)
+    retries = list(spider._handle_error(Failure(HttpError(response))))
+    assert [retry.meta['retry_times'] for retry in retries] == [1]
@@ -0,0 +1,214 @@
+import os
+import stat
+import tempfile
+import time
+from unittest import mock
+
+import scrapy
+from cryptography.fernet import Fernet
+from scrapy.http import Response
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
+from twisted.internet import defer
+
+from scraper.middleware import SessionMiddleware
+from scraper.sessions import FileSessionStore, RedisSessionStore, SessionManager
+from scraper.tests.fake_redis import FakeRedis
+
+
+class FakeLogins:
+    """Mock version of deferToThread() that holds logins until finished.
+
+    Also acts as the login function, numbering each session.
+    """
+
+    def __init__(self):
+        """Initialises the list of running logins."""
+        self.running = []
+        self.count = 0
+
+    def __call__(self, func, *args):
+        """Starts a login."""
+        d = defer.Deferred()
+        self.running.append((d, func, args))
+        return d
+
+    def login(self):
+        """Returns the cookies of a new session."""
+        self.count += 1
+        return {'session': str(self.count)}
+
+    def finish(self):
+        """Completes the running logins."""
+        running, self.running = self.running, []
+        for d, func, args in running:
+            d.callback(func(*args))
+
+
+def _results(deferreds):
+    """Returns the results that Deferreds have fired with so far."""
+    results = []
+    for d in deferreds:
+        d.addCallback(results.append)
+    return results
+
+
+def test_logins_are_single_flighted():
+    """Tests that concurrent requests for a session share one login."""
+    logins = FakeLogins()
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        manager = SessionManager(logins.login)
+        results = _results([manager.get() for _ in range(10)])
+        assert len(logins.running) == 1 and results == []
+        logins.finish()
+
+    assert [session.cookies for session in results] == [{'session': '1'}] * 10
+
+
+def test_logins_are_recorded_in_stats():
+    """Tests that the number and duration of logins are recorded."""
+    logins = FakeLogins()
+    stats = MemoryStatsCollector(mock.Mock(settings=Settings()))
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        manager = SessionManager(logins.login, pool_size=2, stats=stats)
+        _results([manager.get(), manager.get()])
+        logins.finish()
+
+    assert stats.get_value('sessions/logins') == 2
+    assert stats.get_value('sessions/login_ms').count == 2
+
+
+def test_invalidate_replaces_session_once():
+    """Tests that a session is only replaced once, however often it's invalidated."""
+    logins = FakeLogins()
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        manager = SessionManager(logins.login)
+        results = _results([manager.get()])
+        logins.finish()
+        [first] = results
+        manager.invalidate(first)
+        manager.invalidate(first)
+        assert len(logins.running) == 1
+        logins.finish()
+        manager.invalidate(first)
+        [second] = _results([manager.get()])
+
+    assert logins.running == []
+    assert second.cookies == {'session': '2'}
+
+
+def test_old_sessions_are_refreshed_in_background():
+    """Tests that old sessions are still handed out while being replaced."""
+    logins = FakeLogins()
+    clock = mock.Mock(return_value=0)
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        manager = SessionManager(logins.login, max_age=100, clock=clock)
+        _results([manager.get()])
+        logins.finish()
+        clock.return_value = 150
+        [old] = _results([manager.get()])
+        assert old.cookies == {'session': '1'} and len(logins.running) == 1
+        logins.finish()
+        [new] = _results([manager.get()])
+
+    assert new.cookies == {'session': '2'}
+
+
+def test_pool_rotates_sessions():
+    """Tests that requests are given the sessions of a pool in turn."""
+    logins = FakeLogins()
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        manager = SessionManager(logins.login, pool_size=2)
+        results = _results([manager.get() for _ in range(4)])
+        logins.finish()
+
+    assert sorted(session.slot for session in results) == [0, 0, 1, 1]
+    assert len({session.cookies['session'] for session in results}) == 2
+
+
+def test_middleware_adds_cookies_and_invalidates_on_redirect():
+    """Tests that a session's cookies are added, and it's dropped on a 302."""
+    spider = mock.Mock(login=lambda: {'a': '1', 'b': '2'})
+    middleware = SessionMiddleware(Settings({'SESSION_MAX_AGE': 0}), stats=None)
+    middleware.spider_opened(spider)
+    request = scrapy.Request('http://example.com/ContactSet')
+    call_in_thread = lambda func, *args: defer.succeed(func(*args))  # noqa: E731
+    with mock.patch('scraper.sessions.threads.deferToThread', call_in_thread):
+        assert _results([middleware.process_request(request, spider)]) == [None]
+    assert request.headers['Cookie'] == b'a=1; b=2'
+
+    response = Response(request.url, status=302, request=request)
+    assert middleware.process_response(request, response, spider) is response
+    assert middleware.manager._sessions == [None]
+
+
+def test_saved_sessions_are_reused():
+    """Tests that a saved session is reused if the service accepts it."""
+    logins = FakeLogins()
+    store = RedisSessionStore(FakeRedis(), Fernet.generate_key())
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        first = SessionManager(logins.login, max_age=100, store=store, probe=lambda cookies: True)
+        _results([first.get()])
+        logins.finish()
+        second = SessionManager(logins.login, max_age=100, store=store, probe=lambda cookies: True)
+        results = _results([second.get()])
+        logins.finish()
+
+    assert logins.count == 1
+    assert results[0].cookies == {'session': '1'}
+
+
+def test_rejected_saved_sessions_are_replaced():
+    """Tests that a saved session is replaced if it is too old or rejected."""
+    logins = FakeLogins()
+    store = RedisSessionStore(FakeRedis(), Fernet.generate_key())
+    store.save(0, {'session': 'old'})
+    with mock.patch('scraper.sessions.threads.deferToThread', logins):
+        manager = SessionManager(logins.login, store=store, probe=lambda cookies: False)
+        rejected = _results([manager.get()])
+        logins.finish()
+        with mock.patch('scraper.sessions.time.time', return_value=time.time() + 200):
+            manager = SessionManager(logins.login, max_age=100, store=store, probe=lambda cookies: True)
+            expired = _results([manager.get()])
+            logins.finish()
+
+    assert [session.cookies for session in rejected + expired] == [{'session': '1'}, {'session': '2'}]
+    assert store.load(0)[0] == {'session': '2'}
+
+
+def test_file_store_is_private():
+    """Tests that saved session files are only readable by the user."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = FileSessionStore(os.path.join(temp_dir, 'session'))
+        assert store.load(0) is None
+        store.save(0, {'a': '1'})
+        cookies, created = store.load(0)
+        mode = stat.S_IMODE(os.stat(os.path.join(temp_dir, 'session.0')).st_mode)
+
+    assert cookies == {'a': '1'}
+    assert mode == 0o600
+
+
+def test_redis_store_is_encrypted():
+    """Tests that sessions are encrypted in Redis, and can't be read without the key."""
+    redis = FakeRedis()
+    store = RedisSessionStore(redis, Fernet.generate_key())
+    store.save(0, {'MSISAuth': 'secret'})
+
+    assert b'secret' not in redis.get('sessions:0')
+    assert store.load(0)[0] == {'MSISAuth': 'secret'}
+    assert RedisSessionStore(redis, Fernet.generate_key()).load(0) is None
+
+
+def test_redis_store_needs_a_key():
+    """Tests that the middleware refuses to save sessions to Redis unencrypted."""
+    crawler = mock.Mock(settings=Settings({'SESSION_STORE': 'redis'}))
+    try:
+        SessionMiddleware.from_crawler(crawler)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected ValueError')
+
+    crawler.settings.set('SESSION_STORE_KEY', Fernet.generate_key().decode())
+    assert SessionMiddleware.from_crawler(crawler).settings is crawler.settings
@@ -1,6 +1,17 @@
+import json
+import urllib.parse
 from unittest.mock import patch
 
+import scrapy
+from scrapy.http import HtmlResponse, Response
+from scrapy.settings import Settings
+from scrapy.spidermiddlewares.httperror import HttpError
+from twisted.python.failure import Failure
+
+from scraper import coordinator, watermarks
+from scraper.frontier import Frontier
 from scraper.spiders import odata
+from scraper.tests import fake_odata, fake_redis
 
 MOCK_SETTINGS = {
     "CDMS_BASE_URL": "http://flim.flam.example.com",
@@ -59,3 +70,380 @@ def test_get_cookies():
     expected = [".flam.example.com"]
     result = odata._get_cookies(MOCK_SETTINGS)
     assert result == expected, (result, expected)
+
+
+def _make_spider(**settings):
+    """Returns a spider using the given settings."""
+    spider = odata.OdataSpider()
+    spider.settings = Settings(dict(MOCK_SETTINGS, **settings))
+    return spider
+
+
+def _item_page(url, *names, next_url=None):
+    """Returns a response for a page of contacts."""
+    results = [
+        {'__metadata': {'uri': "{}('{}')".format(url, name),
+                        'type': "Microsoft.Crm.Sdk.Data.Services.Contact"},
+         'Name': name}
+        for name in names]
+    data = {'d': {'results': results}}
+    if next_url:
+        data['d']['__next'] = next_url
+    request = scrapy.Request(url, meta={'entity_set': "ContactSet"})
+    return HtmlResponse(url, body=json.dumps(data).encode('utf-8'), request=request)
+
+
+def test_parse_itempage_yields_items_and_next_page():
+    """Tests that a record is yielded for each result, then the next page."""
+    spider = _make_spider(EMIT_ITEMS=True)
+    response = _item_page("http://flim.flam.example.com/ContactSet", "a", "b",
+                          next_url="http://flim.flam.example.com/ContactSet?$skiptoken=1")
+    *items, request = spider.parse_itempage(response)
+
+    assert [dict(item) for item in items] == [
+        {'entity_set': "ContactSet", 'entity_type': "Contact",
+         'uri': "http://flim.flam.example.com/ContactSet('a')",
+         'data': json.loads(response.text)['d']['results'][0]},
+        {'entity_set': "ContactSet", 'entity_type': "Contact",
+         'uri': "http://flim.flam.example.com/ContactSet('b')",
+         'data': json.loads(response.text)['d']['results'][1]},
+    ]
+    assert request.url == "http://flim.flam.example.com/ContactSet?$skiptoken=1"
+    assert request.meta['entity_set'] == "ContactSet"
+
+
+def test_parse_itempage_without_items():
+    """Tests that no items are yielded if EMIT_ITEMS is disabled."""
+    spider = _make_spider(EMIT_ITEMS=False)
+    response = _item_page("http://flim.flam.example.com/ContactSet", "a")
+    assert list(spider.parse_itempage(response)) == []
+
+
+def test_parse_itempage_without_items_follows_next_page():
+    """Tests that the next page is queued without decoding the page."""
+    spider = _make_spider(EMIT_ITEMS=False)
+    response = _item_page("http://flim.flam.example.com/ContactSet", "a",
+                          next_url="http://flim.flam.example.com/ContactSet?$skiptoken=1")
+    with patch("scraper.decoding.loads") as loads:
+        [request] = spider.parse_itempage(response)
+    assert not loads.called
+    assert request.url == "http://flim.flam.example.com/ContactSet?$skiptoken=1"
+    assert request.meta['entity_set'] == "ContactSet"
+
+
+def test_frontier_pages_with_quoted_skiptokens_are_removed():
+    """Tests that pages are removed from the frontier under the URL they were added with."""
+    spider = _make_spider(EMIT_ITEMS=False)
+    spider._frontier = Frontier(fake_redis.FakeRedis(), batch_size=1)
+    url = "http://flim.flam.example.com/ContactSet"
+    next_url = url + "?$skiptoken=1,'contactid','{AB12-CD34}'"
+    spider._add_url_to_frontier(url, {'entity_set': "ContactSet"})
+
+    [request] = spider.parse_itempage(_item_page(url, "a", next_url=next_url))
+    assert list(spider._frontier.pending()) == [request.url]
+    assert request.url != next_url
+    response = HtmlResponse(request.url, body=b'{"d": {"results": []}}', request=request)
+    list(spider.parse_itempage(response))
+
+    assert spider._frontier.pending() == {}
+
+
+def _crawl(service, **settings):
+    """Crawls a fake service from its root URL, returning the items."""
+    spider = _make_spider(EMIT_ITEMS=True, **settings)
+    start = spider._make_request(service.root_url + "/", callback=spider.parse_homepage)
+    return fake_odata.crawl(service, [start])
+
+
+def test_partitioned_crawl():
+    """Tests that entity sets are crawled as independent partitions."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i)} for i in range(230)],
+         'AccountSet': [{'Name': str(i)} for i in range(20)]},
+        page_size=50)
+
+    items = _crawl(service, CRAWL_PARTITIONS=1, CRAWL_PARTITIONS_PER_SET={'ContactSet': 3})
+
+    assert sorted(int(item['data']['Name']) for item in items if item['entity_set'] == 'ContactSet') \
+        == list(range(230))
+    assert len([item for item in items if item['entity_set'] == 'AccountSet']) == 20
+    first_pages = [url.split("?")[-1] for url in service.requested if "ContactSet?" in url and "skiptoken" not in url]
+    assert first_pages == ["$top=77", "$skip=77&$top=77", "$skip=154"]
+
+
+@patch("scraper.spiders.odata.auth.login", mock_login)
+def test_resume_crawl():
+    """Tests that a killed crawl resumes from its pending pages."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i)} for i in range(230)],
+         'AccountSet': [{'Name': str(i)} for i in range(20)]},
+        page_size=50)
+    redis = fake_redis.FakeRedis()
+    settings = dict(EMIT_ITEMS=True, REDIS_ENABLED=True, FRONTIER_BATCH_SIZE=2,
+                    START_URLS=[service.root_url + "/"])
+
+    with patch("scraper.spiders.odata.StrictRedis", return_value=redis):
+        first = _make_spider(**settings)
+        first.setup()
+        first_items = fake_odata.crawl(service, first.start_requests(), max_requests=4)
+        second = _make_spider(**settings)
+        second.setup()
+
+    del service.requested[:]
+    second_items = fake_odata.crawl(service, second.start_requests())
+    second.closed('finished')
+
+    names = [int(item['data']['Name']) for item in first_items + second_items
+             if item['entity_set'] == 'ContactSet']
+    assert set(names) == set(range(230))
+    assert len(names) < 230 + 50
+    assert not [url for url in service.requested if "AccountSet" in url]
+    assert service.root_url + "/ContactSet" not in service.requested
+    assert len(second_items) < 230
+    assert redis.data == {}
+
+
+@patch("scraper.spiders.odata.auth.login", mock_login)
+def test_coordinated_crawl():
+    """Tests that workers share a crawl, reclaiming work from a dead worker."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i)} for i in range(230)],
+         'AccountSet': [{'Name': str(i)} for i in range(120)],
+         'LeadSet': [{'Name': str(i)} for i in range(60)]},
+        page_size=50)
+    redis = fake_redis.FakeRedis()
+
+    workers = []
+    with patch("scraper.spiders.odata.StrictRedis", return_value=redis):
+        for worker_id in ('a', 'b', 'c'):
+            spider = _make_spider(EMIT_ITEMS=True, COORDINATOR_ENABLED=True, COORDINATOR_CLAIMS=1,
+                                  CRAWL_PARTITIONS_PER_SET={'ContactSet': 2}, WORKER_ID=worker_id,
+                                  START_URLS=[service.root_url + "/"])
+            spider.setup()
+            workers.append(spider)
+    queues = {spider: list(spider.start_requests()) for spider in workers}
+
+    # Each worker makes one request in turn, until worker 'a' dies
+    items = []
+    for _ in range(100):
+        for spider in [spider for spider in workers if spider in queues]:
+            if queues[spider]:
+                requests, new_items = fake_odata.fetch(service, queues[spider].pop(0))
+                queues[spider].extend(requests)
+                items.extend(new_items)
+            else:
+                queues[spider] = spider._reclaim()
+                if not queues[spider] and spider._coordinator.finished():
+                    spider.closed('finished')
+                    del queues[spider]
+        if len(service.requested) >= 6 and workers[0] in queues:
+            del queues[workers[0]]
+            redis.delete(coordinator.lease_key_prefix + 'a')
+
+    assert not queues
+    for name, size in (('ContactSet', 230), ('AccountSet', 120), ('LeadSet', 60)):
+        assert {int(item['data']['Name']) for item in items if item['entity_set'] == name} == set(range(size))
+    assert redis.data.keys() == {'coordinator:done'}
+
+
+def _fail(request, status):
+    """Calls a request's error callback as Scrapy does for an error response."""
+    response = Response(request.url, status=status, request=request)
+    failure = Failure(HttpError(response))
+    failure.request = request
+    return list(request.errback(failure))
+
+
+@patch("scraper.spiders.odata.auth.login", mock_login)
+def test_coordinated_crawl_finishes_despite_failed_work():
+    """Tests that work items whose requests fail for good are completed."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i)} for i in range(120)],
+         'AccountSet': [{'Name': str(i)} for i in range(20)],
+         'LeadSet': [{'Name': str(i)} for i in range(20)]},
+        page_size=50)
+    redis = fake_redis.FakeRedis()
+    with patch("scraper.spiders.odata.StrictRedis", return_value=redis):
+        spider = _make_spider(EMIT_ITEMS=True, COORDINATOR_ENABLED=True, COORDINATOR_CLAIMS=1,
+                              WORKER_ID='a', START_URLS=[service.root_url + "/"])
+        spider.setup()
+
+    queue = list(spider.start_requests())
+    items = []
+    while queue:
+        request = queue.pop(0)
+        if "AccountSet" in request.url:
+            queue.extend(_fail(request, 403))
+        elif "LeadSet" in request.url:
+            # Sessions keep expiring, until the retries run out
+            queue.extend(_fail(request, 302))
+        else:
+            requests, new_items = fake_odata.fetch(service, request)
+            queue.extend(requests)
+            items.extend(new_items)
+        if not queue:
+            queue = spider._reclaim()
+
+    assert len(items) == 120
+    assert spider._coordinator.finished()
+
+
+def test_entity_set_config():
+    """Tests that entity sets are included, excluded and projected as configured."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i), 'Email': 'x'} for i in range(230)],
+         'ContactBaseSet': [{'Name': str(i)} for i in range(20)],
+         'AccountSet': [{'Name': str(i)} for i in range(20)],
+         'LeadSet': [{'Name': str(i)} for i in range(20)]},
+        page_size=50)
+
+    items = _crawl(service, ENTITY_SET_INCLUDE=['Contact*', 'AccountSet'], ENTITY_SET_EXCLUDE=['*BaseSet'],
+                   CRAWL_PARTITIONS=2,
+                   ENTITY_SET_OPTIONS={'ContactSet': {'select': ['Name'], 'top': 120}})
+
+    contacts = [item['data'] for item in items if item['entity_set'] == 'ContactSet']
+    assert len(contacts) == 120
+    assert set(contacts[0]) == {'__metadata', 'Name'}
+    assert len([item for item in items if item['entity_set'] == 'AccountSet']) == 20
+    assert {item['entity_set'] for item in items} == {'ContactSet', 'AccountSet'}
+    assert service.root_url + "/ContactSet?$select=Name&$top=120" in service.requested
+
+
+def test_partitioned_crawl_with_filter():
+    """Tests that a filtered entity set is counted and crawled in partitions."""
+    def modified(hour):
+        return '/Date({})/'.format(1462320000000 + hour * 3600000)
+
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i), 'ModifiedOn': modified(i % 10)} for i in range(300)]},
+        page_size=50)
+
+    items = _crawl(service, CRAWL_PARTITIONS=3,
+                   ENTITY_SET_OPTIONS={'ContactSet': {'filter': "ModifiedOn ge datetime'2016-05-04T05:00:00'"}})
+
+    assert sorted(int(item['data']['Name']) for item in items) == [i for i in range(300) if i % 10 >= 5]
+    first_pages = [dict(urllib.parse.parse_qsl(url.split("?")[-1])) for url in service.requested
+                   if "ContactSet?" in url and "skiptoken" not in url]
+    assert [(page.get('$skip'), page.get('$top')) for page in first_pages] == [
+        (None, '50'), ('50', '50'), ('100', None)]
+    assert all(page['$filter'].startswith("ModifiedOn ge") for page in first_pages)
+
+
+def test_next_links_are_followed_as_given():
+    """Tests that `__next` links aren't rewritten, and partitions stop at their size."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i), 'Email': 'x'} for i in range(230)]},
+        page_size=50, next_options=('$filter',))
+
+    items = _crawl(service, CRAWL_PARTITIONS=3, ENTITY_SET_OPTIONS={'ContactSet': {'select': ['Name']}})
+
+    assert sorted(int(item['data']['Name']) for item in items) == list(range(230))
+    next_pages = [url.split("?")[-1] for url in service.requested if "skiptoken" in url]
+    assert next_pages == ["$skiptoken=50", "$skiptoken=127", "$skiptoken=204"]
+    # Pages after the first are as the service gave them
+    assert sum(set(item['data']) == {'__metadata', 'Name'} for item in items) == 150
+
+
+def test_entity_set_options_leave_no_pending_pages():
+    """Tests that pages requested with configured query options are removed from the frontier."""
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': [{'Name': str(i), 'Email': 'x'} for i in range(120)],
+         'AccountSet': [{'Name': str(i), 'Email': 'x'} for i in range(20)]},
+        page_size=50)
+    redis = fake_redis.FakeRedis()
+    with patch("scraper.spiders.odata.StrictRedis", return_value=redis):
+        spider = _make_spider(EMIT_ITEMS=True, REDIS_ENABLED=True, START_URLS=[service.root_url + "/"],
+                              CRAWL_PARTITIONS_PER_SET={'ContactSet': 2},
+                              ENTITY_SET_OPTIONS={'ContactSet': {'select': ['Name']},
+                                                  'AccountSet': {'select': ['Name']}})
+        spider.setup()
+    items = fake_odata.crawl(service, spider.start_requests())
+
+    assert len(items) == 140
+    assert spider._frontier.pending() == {}
+
+
+def test_incremental_crawl_needs_items():
+    """Tests that incremental crawls are refused unless their records are exported."""
+    spider = _make_spider(EMIT_ITEMS=False, CRAWL_INCREMENTAL=True)
+    try:
+        spider.setup()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Expected ValueError')
+
+
+def _watermarked_crawl(service, objects):
+    """Runs an incremental crawl, with watermarks saved in `objects`."""
+    spider = _make_spider(EMIT_ITEMS=True, START_URLS=[service.root_url + "/"],
+                          ENTITY_SET_OPTIONS={'ContactSet': {'select': ['Name']}})
+    spider._watermarks = watermarks.ModifiedWatermarks(bucket=None)
+    saved = dict(objects)
+    with patch("scraper.watermarks.s3") as mock_s3:
+        mock_s3.list_keys.side_effect = lambda bucket, prefix: sorted(objects)
+        mock_s3.get_object.side_effect = lambda bucket, key: objects[key]
+        mock_s3.put_object.side_effect = lambda bucket, key, data: objects.__setitem__(key, data)
+        items = fake_odata.crawl(service, spider.start_requests())
+        # Watermarks are only saved once the records have been exported
+        assert objects == saved
+        spider.closed('finished')
+    return items
+
+
+def test_incremental_crawl():
+    """Tests that only entities modified since the last crawl are requested."""
+    def modified(hour):
+        return '/Date({})/'.format(1462320000000 + hour * 3600000)
+
+    contacts = [{'Name': str(i), 'ModifiedOn': modified(i % 10)} for i in range(120)]
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc",
+        {'ContactSet': contacts, 'AccountSet': [{'Name': 'a', 'ModifiedOn': modified(1)}]},
+        page_size=50)
+    objects = {}
+
+    def uri(index):
+        return "{}/ContactSet({})".format(service.root_url, index)
+
+    items = _watermarked_crawl(service, objects)
+    assert len(items) == 121
+    assert json.loads(objects['WATERMARKS/ContactSet'].decode('utf-8')) == {
+        'modified_on': 1462320000000 + 9 * 3600000, 'uris': sorted(uri(i) for i in range(9, 120, 10))}
+
+    contacts[3]['ModifiedOn'] = modified(12)
+    contacts.append({'Name': 'new', 'ModifiedOn': modified(11)})
+    # Modified in the same millisecond as the watermark, but not yet crawled
+    contacts.append({'Name': 'same', 'ModifiedOn': modified(9)})
+    del service.requested[:]
+    items = _watermarked_crawl(service, objects)
+
+    # Entities already crawled at the watermarks are skipped
+    assert sorted(item['data']['Name'] for item in items) == ['3', 'new', 'same']
+    url = service.root_url + "/ContactSet?$select=Name,ModifiedOn" \
+        "&$filter=ModifiedOn ge datetime'2016-05-04T09:00:00.000'"
+    assert url in [urllib.parse.unquote(url) for url in service.requested]
+    assert json.loads(objects['WATERMARKS/ContactSet'].decode('utf-8')) == {
+        'modified_on': 1462320000000 + 12 * 3600000, 'uris': [uri(3)]}
+
+
+def test_watermarks_stop_at_the_start_of_the_crawl():
+    """Tests that watermarks aren't moved past entities that could still be modified during the crawl."""
+    start = 1462320000000
+    contacts = [{'Name': str(i), 'ModifiedOn': '/Date({})/'.format(start + i * 60000)} for i in range(10)]
+    service = fake_odata.FakeODataService(
+        "http://flim.flam.example.com/XRMServices/2011/OrganizationData.svc", {'ContactSet': contacts})
+    objects = {}
+
+    with patch("scraper.spiders.odata.time.time", return_value=start / 1000 + 600):
+        _watermarked_crawl(service, objects)
+
+    assert json.loads(objects['WATERMARKS/ContactSet'].decode('utf-8')) == {'modified_on': start + 300000, 'uris': []}
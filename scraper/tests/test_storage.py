@@ -1,16 +1,24 @@
-import pickle
+import contextlib
+import hashlib
+import tempfile
 from unittest import mock
 
+import botocore
 import freezegun
 
 import scrapy
+from scrapy.settings import Settings
+from scrapy.statscollectors import MemoryStatsCollector
 
-from scraper.storage import S3CacheStorage
+from twisted.internet import defer
+
+from scraper import record
+from scraper.storage import AsyncS3CacheStorage, S3CacheStorage, TieredCacheStorage
 
 key = "CACHE/req/2658b62c0bbafabe653244ce31a10d647fd45a5e/"
 mock_data = {
-    '{}pickled_meta'.format(key): pickle.dumps(
-        {'response_url': "http://example.com/res", 'status': 200}),
+    '{}meta'.format(key): repr(
+        {'response_url': "http://example.com/res", 'status': 200}).encode('utf8'),
     '{}response_body'.format(key): b'''{"name": "value"}''',
     '{}response_headers'.format(key): b'''X-Example: foo\nX-Other: bar'''
 }
@@ -25,9 +33,13 @@ mock_settings = {
 def mock_get_s3_text(bucket, fingerprint):
     """Mock version of _get_s3_text().
 
-    Returns mock data data.
+    Returns mock data data, or raises a 404 error for unknown keys.
     """
-    return mock_data[fingerprint]
+    try:
+        return mock_data[fingerprint]
+    except KeyError:
+        raise botocore.exceptions.ClientError(
+            {'Error': {'Code': '404'}}, 'HeadObject')
 
 
 @mock.patch("scraper.storage.boto3")
@@ -45,6 +57,34 @@ def test_retrieve_response(mock_boto3):
     assert res.headers == {b"X-Example": [b"foo"], b"X-Other": [b"bar"]}
 
 
+@mock.patch("scraper.storage.boto3")
+def test_retrieve_packed_response(mock_boto3):
+    """Tests that a packed record is retrieved with a single call."""
+    s3_cache_storage = S3CacheStorage(mock_settings)
+    packed = record.pack(
+        {'response_url': "http://example.com/res", 'status': 200},
+        {'response_headers': b"X-Example: foo", 'response_body': b"{}"},
+        compress=True)
+    request = scrapy.http.Request("http://example.com/req")
+
+    with mock.patch("scraper.storage._get_s3_text", return_value=packed) as get:
+        res = s3_cache_storage.retrieve_response(None, request)
+
+    assert get.mock_calls == [mock.call(s3_cache_storage.bucket, "{}record".format(key))]
+    assert res.url == "http://example.com/res"
+    assert res.body == b"{}"
+    assert res.headers == {b"X-Example": [b"foo"]}
+
+
+@mock.patch("scraper.storage.boto3")
+@mock.patch("scraper.storage._get_s3_text", mock_get_s3_text)
+def test_retrieve_response_missing(mock_boto3):
+    """Tests that uncached requests are reported as cache misses."""
+    s3_cache_storage = S3CacheStorage(mock_settings)
+    request = scrapy.http.Request("http://example.com/other")
+    assert s3_cache_storage.retrieve_response(None, request) is None
+
+
 @freezegun.freeze_time("2017-02-14 13:00")
 @mock.patch("scraper.storage.boto3")
 @mock.patch("scraper.storage._send_s3_text")
@@ -66,33 +106,229 @@ def test_store_response(mock_send_s3_text, mock_boto3):
 
     fingerprint = "CACHE/flumble/d5b392310d7376bf4f739105b25ad1b7e5d52f19"
 
-    expected_calls = [
-        mock.call(
-            mock_bucket,
-            '{}/meta'.format(fingerprint),
-            b" ".join([
-                b"{'url': 'http://example.com/flumble', 'method': 'GET',",
-                b"'status': 200, 'response_url': 'http://example.com/flumble',",
-                b"'timestamp': 1487077200.0}"])),
-        mock.call(
-            mock_bucket,
-            '{}/pickled_meta'.format(fingerprint),
-            b"\x80\x02}q\x00(X\x03\x00\x00\x00urlq\x01X\x1a\x00\x00\x00http://example.com/flumbleq\x02X\x06\x00\x00\x00methodq\x03X\x03\x00\x00\x00GETq\x04X\x06\x00\x00\x00statusq\x05K\xc8X\x0c\x00\x00\x00response_urlq\x06X\x1a\x00\x00\x00http://example.com/flumbleq\x07X\t\x00\x00\x00timestampq\x08GA\xd6(\xbf\xd4\x00\x00\x00u."),  # noqa
-        mock.call(
-            mock_bucket,
-            '{}/request_headers'.format(fingerprint),
-            b'X-Example: foo'),
-        mock.call(
-            mock_bucket,
-            '{}/request_body'.format(fingerprint),
-            b"Sample Request Body"),
-        mock.call(
-            mock_bucket,
-            '{}/response_headers'.format(fingerprint),
-            b'X-Other: bar'),
-        mock.call(
-            mock_bucket,
-            '{}/response_body'.format(fingerprint),
-            b"Sample Response Body")]
-
-    assert mock_send_s3_text.mock_calls == expected_calls
+    [call] = mock_send_s3_text.mock_calls
+    _, (bucket, path, body), _ = call
+    assert bucket == mock_bucket
+    assert path == '{}/record'.format(fingerprint)
+
+    metadata, parts = record.unpack(body)
+    assert metadata == {
+        'version': 2,
+        'url': 'http://example.com/flumble',
+        'method': 'GET',
+        'status': 200,
+        'response_url': 'http://example.com/flumble',
+        'timestamp': 1487077200.0,
+        'body_sha256': hashlib.sha256(b"Sample Response Body").hexdigest(),
+        'body_length': 20,
+        'encoding': None}
+    assert parts == {
+        'request_headers': b'X-Example: foo',
+        'request_body': b"Sample Request Body",
+        'response_headers': b'X-Other: bar',
+        'response_body': b"Sample Response Body"}
+
+
+def _call_in_thread(reactor, pool, func, *args):
+    """Mock version of deferToThreadPool() that runs `func` immediately."""
+    return defer.maybeDeferred(func, *args)
+
+
+@mock.patch("scraper.storage.boto3")
+@mock.patch("scraper.storage._get_s3_text", mock_get_s3_text)
+@mock.patch("scraper.storage.threads.deferToThreadPool", _call_in_thread)
+def test_async_retrieve_response(mock_boto3):
+    """Tests that the async storage returns cached responses via a Deferred."""
+    s3_cache_storage = AsyncS3CacheStorage(mock_settings)
+    request = scrapy.http.Request("http://example.com/req")
+    d = s3_cache_storage.retrieve_response(None, request)
+    assert isinstance(d, defer.Deferred)
+
+    results = []
+    d.addCallback(results.append)
+    [res] = results
+    assert res.url == "http://example.com/res"
+    assert res.status == 200
+
+
+@mock.patch("scraper.storage.boto3")
+@mock.patch("scraper.storage._get_s3_text", mock_get_s3_text)
+@mock.patch("scraper.storage.threads.deferToThreadPool", _call_in_thread)
+def test_cache_lookups_are_recorded_in_stats(mock_boto3):
+    """Tests that hits, misses and lookup times are recorded in the crawler's stats."""
+    stats = MemoryStatsCollector(mock.Mock(settings=Settings()))
+    for storage_class in (S3CacheStorage, AsyncS3CacheStorage):
+        s3_cache_storage = storage_class(mock_settings)
+        s3_cache_storage.stats = stats
+        for url in ("http://example.com/req", "http://example.com/other"):
+            s3_cache_storage.retrieve_response(None, scrapy.http.Request(url))
+
+    assert stats.get_value('s3cache/hit') == 2
+    assert stats.get_value('s3cache/miss') == 2
+    assert stats.get_value('s3cache/latency_ms').count == 4
+
+
+@mock.patch("scraper.storage.boto3")
+@mock.patch("scraper.storage.threads.deferToThreadPool")
+def test_async_store_response_is_written_behind(mock_defer, mock_boto3):
+    """Tests that stores are buffered until close_spider flushes them."""
+    writes = [defer.Deferred() for _ in range(3)]
+    mock_defer.side_effect = writes
+    s3_cache_storage = AsyncS3CacheStorage(dict(mock_settings, S3CACHE_MAX_PENDING_WRITES=2))
+    s3_cache_storage._pool = mock.Mock()
+
+    results = []
+    for i in range(3):
+        request = scrapy.http.Request("http://example.com/{}".format(i))
+        response = scrapy.http.Response(request.url, body=b"body")
+        results.append(s3_cache_storage.store_response(None, request, response))
+
+    # only the write that exceeded the buffer is waited on
+    assert results[:2] == [None, None]
+    assert results[2] is writes[2]
+
+    closed = []
+    s3_cache_storage.close_spider(None).addCallback(closed.append)
+    assert not closed
+    for write in writes:
+        write.callback(None)
+    assert closed
+    assert not s3_cache_storage._pending_writes
+    s3_cache_storage._pool.stop.assert_called_once_with()
+
+
+@mock.patch("scraper.storage.boto3")
+@mock.patch("scraper.storage._send_s3_text")
+@mock.patch("scraper.storage._get_s3_text", mock_get_s3_text)
+def test_tiered_storage_reads_and_writes_through(mock_send_s3_text, mock_boto3):
+    """Tests that the local tier is filled on reads and stores."""
+    with tempfile.TemporaryDirectory() as directory:
+        storage = TieredCacheStorage(dict(mock_settings, HTTPCACHE_DIR=directory))
+        storage.open_spider(None)
+
+        request = scrapy.http.Request("http://example.com/req")
+        assert storage.retrieve_response(None, request).status == 200
+        assert len(storage.local) == 1
+        with mock.patch("scraper.storage._get_s3_text") as get:
+            res = storage.retrieve_response(None, request)
+        assert not get.called
+        assert res.body == b'{"name": "value"}'
+
+        request = scrapy.http.Request("http://example.com/new")
+        storage.store_response(None, request, scrapy.http.Response(request.url, body=b"new"))
+        assert mock_send_s3_text.called
+        assert len(storage.local) == 2
+
+
+@mock.patch("scraper.storage.boto3")
+def test_legacy_metadata_is_not_unpickled(mock_boto3):
+    """Tests that legacy entries are read from their repr() metadata, never unpickled."""
+    objects = dict(mock_data)
+    del objects['{}meta'.format(key)]
+    objects['{}pickled_meta'.format(key)] = b"cos\nsystem\n(S'echo unsafe'\ntR."
+    storage = S3CacheStorage(mock_settings)
+    request = scrapy.http.Request("http://example.com/req")
+    with mock.patch("scraper.storage._get_s3_text", lambda bucket, key: _get_mock_object(objects, key)), \
+            mock.patch("pickle.loads") as loads:
+        assert storage.retrieve_response(None, request) is None
+    assert not loads.called
+
+
+def _get_mock_object(objects, key):
+    try:
+        return objects[key]
+    except KeyError:
+        raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+
+@mock.patch("scraper.storage.boto3")
+def test_index_answers_misses_without_s3_calls(mock_boto3):
+    """Tests that requests missing from the index aren't looked up in S3."""
+    s3_cache_storage = S3CacheStorage(dict(mock_settings, S3CACHE_INDEX_ENABLED=True))
+    request = scrapy.http.Request("http://example.com/req")
+    with mock.patch("scraper.storage._get_s3_text") as get:
+        assert s3_cache_storage.retrieve_response(None, request) is None
+    assert not get.called
+
+    with mock.patch("scraper.storage._send_s3_text"):
+        s3_cache_storage.store_response(None, request, scrapy.http.Response(request.url))
+    with mock.patch("scraper.storage._get_s3_text", mock_get_s3_text):
+        assert s3_cache_storage.retrieve_response(None, request).status == 200
+
+
+@mock.patch("scraper.storage.boto3")
+def test_index_is_flushed_as_responses_are_stored(mock_boto3):
+    """Tests that new fingerprints are saved to the index during the crawl."""
+    s3_cache_storage = S3CacheStorage(dict(mock_settings, S3CACHE_INDEX_ENABLED=True, S3CACHE_INDEX_FLUSH_SIZE=2))
+    with mock.patch("scraper.storage._send_s3_text"), mock.patch("scraper.index.s3.put_object") as put:
+        for i in range(3):
+            request = scrapy.http.Request("http://example.com/{}".format(i))
+            s3_cache_storage.store_response(None, request, scrapy.http.Response(request.url))
+        assert put.call_count == 1
+        s3_cache_storage.close_spider(None)
+        assert put.call_count == 2
+
+
+def _mock_s3(objects):
+    """Returns patches for the S3 helpers that store objects in a dict."""
+    def get(bucket, key):
+        try:
+            return objects[key]
+        except KeyError:
+            raise botocore.exceptions.ClientError({'Error': {'Code': '404'}}, 'GetObject')
+
+    return [
+        mock.patch("scraper.storage._get_s3_text", get),
+        mock.patch("scraper.storage._send_s3_text", lambda bucket, key, body: objects.__setitem__(key, body)),
+        mock.patch("scraper.storage._exists", lambda bucket, key: key in objects),
+    ]
+
+
+@mock.patch("scraper.storage.boto3")
+def test_dedup_bodies(mock_boto3):
+    """Tests that identical response bodies are stored once."""
+    objects = {}
+    with contextlib.ExitStack() as stack:
+        for patch in _mock_s3(objects):
+            stack.enter_context(patch)
+        storage = S3CacheStorage(dict(mock_settings, S3CACHE_DEDUP_BODIES=True, S3CACHE_COMPRESS=True))
+        for url in ("http://example.com/a", "http://example.com/b?$skiptoken=1"):
+            request = scrapy.http.Request(url)
+            storage.store_response(None, request, scrapy.http.Response(url, body=b'{"d": {}}'))
+
+        digest = hashlib.sha256(b'{"d": {}}').hexdigest()
+        assert sorted(key for key in objects if not key.startswith("CACHE/")) == ["BLOBS/" + digest]
+        assert (storage.blobs_uploaded, storage.blobs_skipped) == (1, 1)
+        metadata, parts = record.unpack(next(data for key, data in objects.items() if key.startswith("CACHE/b")))
+        assert metadata['body_sha256'] == digest
+        assert metadata['body_blob']
+        assert parts['response_body'] == b''
+
+        # a new process finds the blob already stored
+        storage = S3CacheStorage(dict(mock_settings, S3CACHE_DEDUP_BODIES=True))
+        request = scrapy.http.Request("http://example.com/c")
+        storage.store_response(None, request, scrapy.http.Response(request.url, body=b'{"d": {}}'))
+        assert (storage.blobs_uploaded, storage.blobs_skipped) == (0, 1)
+
+        res = storage.retrieve_response(None, scrapy.http.Request("http://example.com/a"))
+        assert res.body == b'{"d": {}}'
+
+        del objects["BLOBS/" + digest]
+        assert storage.retrieve_response(None, scrapy.http.Request("http://example.com/a")) is None
+
+
+@mock.patch("scraper.storage.boto3")
+def test_tiered_storage_keeps_blobs_locally(mock_boto3):
+    """Tests that deduplicated bodies are read from the local tier."""
+    objects = {}
+    with contextlib.ExitStack() as stack, tempfile.TemporaryDirectory() as directory:
+        for patch in _mock_s3(objects):
+            stack.enter_context(patch)
+        storage = TieredCacheStorage(dict(mock_settings, HTTPCACHE_DIR=directory, S3CACHE_DEDUP_BODIES=True))
+        storage.open_spider(None)
+        request = scrapy.http.Request("http://example.com/a")
+        storage.store_response(None, request, scrapy.http.Response(request.url, body=b"body"))
+        assert len(storage.local) == 2
+
+        objects.clear()
+        assert storage.retrieve_response(None, request).body == b"body"
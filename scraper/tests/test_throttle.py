@@ -0,0 +1,77 @@
+from unittest import mock
+
+import scrapy
+from scrapy.http import Response
+from scrapy.settings import Settings
+
+from scraper.middleware import AdaptiveConcurrencyMiddleware
+from scraper.throttle import AimdController, ERROR, OK, REDIRECT
+
+
+def test_increases_additively():
+    """Tests that concurrency increases by one per round of successes."""
+    controller = AimdController(start=4, maximum=6)
+    for _ in range(4):
+        controller.record(OK, 0.5)
+    assert controller.slots == 4
+    assert 4.9 < controller.concurrency < 5
+
+    for _ in range(100):
+        controller.record(OK, 0.5)
+    assert controller.slots == 6
+
+
+def test_decreases_multiplicatively_once_per_round():
+    """Tests that errors halve concurrency, at most once per round."""
+    controller = AimdController(start=16, minimum=3)
+    controller._since_decrease = 16
+    assert controller.record(ERROR) == 'error'
+    assert controller.slots == 8
+    assert controller.record(ERROR) is None
+    assert controller.slots == 8
+
+    for _ in range(8):
+        controller.record(ERROR)
+    assert controller.slots == 4
+    for _ in range(20):
+        controller.record(ERROR)
+    assert controller.slots == 3
+
+
+def test_decreases_on_high_latency():
+    """Tests that concurrency decreases once latency doubles."""
+    controller = AimdController(start=2)
+    for _ in range(10):
+        controller.record(OK, 0.5)
+    before = controller.slots
+    reasons = [controller.record(OK, 8) for _ in range(5)]
+    assert reasons[0] == 'latency'
+    assert controller.slots < before
+
+
+def test_decreases_on_redirect_bursts():
+    """Tests that a burst of 302s decreases concurrency, but a single one doesn't."""
+    controller = AimdController(start=2, redirect_burst=3)
+    controller._since_decrease = 2
+    assert controller.record(REDIRECT) is None
+    assert controller.record(REDIRECT) is None
+    assert controller.record(REDIRECT) == 'redirects'
+
+
+def test_middleware_sets_slot_concurrency():
+    """Tests that the downloader slot's concurrency follows the controller."""
+    slot = mock.Mock(concurrency=8)
+    stats = mock.Mock()
+    middleware = AdaptiveConcurrencyMiddleware(
+        Settings({'ADAPTIVE_CONCURRENCY_MIN': 2}), stats, lambda: mock.Mock(slots={'cdms': slot}))
+    request = scrapy.Request('http://cdms.example.com/', meta={'download_slot': 'cdms', 'download_latency': 0.1})
+
+    for _ in range(20):
+        middleware.process_exception(request, IOError(), None)
+    assert slot.concurrency == 2
+
+    cached = Response(request.url, status=500, request=request, flags=['cached'])
+    assert middleware.process_response(request, cached, None) is cached
+    middleware.process_response(request, Response(request.url, request=request), None)
+    stats.set_value.assert_called_with('adaptive_concurrency/latency_ms/cdms', 100)
+    stats.inc_value.assert_any_call('adaptive_concurrency/decreases/error')
@@ -0,0 +1,93 @@
+"""Adaptive control of the number of concurrent requests made to CDMS.
+
+Concurrency is adjusted AIMD style (as TCP congestion control does): it is
+increased by one for each round of successful responses, and multiplied by
+a factor (halved, by default) when the server shows signs of overload.  The
+signs of overload are:
+
+- errors (5xx and 403 responses, and timeouts and connection failures);
+- latency above a target, which by default is a multiple of the lowest
+  latency seen (smoothed as an exponentially weighted moving average);
+- bursts of 302 responses, as CDMS expires sessions when overloaded.
+
+Concurrency is decreased at most once per round of responses (i.e. once as
+many responses as the concurrency have been received), as the responses to
+requests made before a decrease don't reflect it.
+"""
+import collections
+
+# Outcomes of requests
+OK, ERROR, REDIRECT = 'ok', 'error', 'redirect'
+
+
+class AimdController:
+    """Adjusts the concurrency of requests to one server."""
+
+    def __init__(self, minimum=1, maximum=64, start=8, decrease_factor=0.5, target_latency=None,
+                 latency_factor=2.0, redirect_burst=5, window=50, smoothing=0.2):
+        """Initialises the controller.
+
+        If `target_latency` isn't given, it is `latency_factor` times the
+        lowest smoothed latency seen.  A burst is `redirect_burst` 302s
+        among the last `window` responses.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.concurrency = float(min(max(start, minimum), maximum))
+        self.decrease_factor = decrease_factor
+        self.target_latency = target_latency
+        self.latency_factor = latency_factor
+        self.redirect_burst = redirect_burst
+        self.smoothing = smoothing
+        self.latency = None
+        self.baseline_latency = None
+        self.increases = 0
+        self.decreases = 0
+        self._redirects = collections.deque(maxlen=window)
+        self._since_decrease = 0
+
+    def record(self, outcome, latency=None):
+        """Records the outcome of a request, adjusting the concurrency.
+
+        Returns the reason for a decrease in concurrency, or None.
+        """
+        self._since_decrease += 1
+        self._redirects.append(outcome == REDIRECT)
+        if latency is not None:
+            self._record_latency(latency)
+
+        reason = self._congestion(outcome)
+        if reason is None:
+            if outcome == OK and self.concurrency < self.maximum:
+                self.concurrency = min(self.concurrency + 1 / self.concurrency, self.maximum)
+                self.increases += 1
+            return None
+        if self._since_decrease < self.concurrency:
+            return None
+        self.concurrency = max(self.concurrency * self.decrease_factor, self.minimum)
+        self.decreases += 1
+        self._since_decrease = 0
+        return reason
+
+    @property
+    def slots(self):
+        """Returns the (whole) number of concurrent requests to allow."""
+        return int(self.concurrency)
+
+    def _record_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        if self.baseline_latency is None or self.latency < self.baseline_latency:
+            self.baseline_latency = self.latency
+
+    def _congestion(self, outcome):
+        if outcome == ERROR:
+            return 'error'
+        if outcome == REDIRECT and sum(self._redirects) >= self.redirect_burst:
+            return 'redirects'
+        target = self.target_latency or (self.baseline_latency or 0) * self.latency_factor
+        if self.latency is not None and target and self.latency > target:
+            return 'latency'
+        return None
@@ -0,0 +1,98 @@
+"""High-watermarks of the entities crawled from each entity set.
+
+For incremental crawls, the latest `ModifiedOn` time seen in each entity set
+is saved to S3 (next to the cache) once the set has been crawled, and later
+crawls only request entities modified since then.  Times are held as
+milliseconds since the epoch, as in OData's `/Date(...)/` JSON values.
+
+Entities modified at the watermark itself are requested again, as others
+may have been modified in the same millisecond after it was taken, so the
+URIs of those already crawled are saved with it, for them to be skipped.
+"""
+import json
+import logging
+import re
+import time
+
+import botocore
+
+from scraper import s3
+
+logger = logging.getLogger(__name__)
+
+key_prefix = "WATERMARKS/"
+
+_date = re.compile(r'/Date\((-?\d+)')
+
+
+class ModifiedWatermarks:
+    """The watermark of each entity set, stored in an S3 bucket."""
+
+    def __init__(self, bucket):
+        """Initialises the watermarks."""
+        self.bucket = bucket
+        self._values = {}
+        self._uris = {}
+
+    def load(self):
+        """Loads the saved watermarks."""
+        for key in s3.list_keys(self.bucket, key_prefix):
+            try:
+                data = json.loads(s3.get_object(self.bucket, key).decode('utf-8'))
+                self._values[key[len(key_prefix):]] = data['modified_on']
+                self._uris[key[len(key_prefix):]] = frozenset(data.get('uris', ()))
+            except botocore.exceptions.ClientError:
+                logger.exception('Error loading watermark: %s', key)
+        logger.info('Loaded watermarks for %d entity sets', len(self._values))
+
+    def get(self, entity_set):
+        """Returns an entity set's watermark, or None if it has none."""
+        return self._values.get(entity_set)
+
+    def uris(self, entity_set):
+        """Returns the URIs of the entities crawled that were modified at an entity set's watermark."""
+        return self._uris.get(entity_set, frozenset())
+
+    def save(self, entity_set, modified_on, uris=()):
+        """Saves a new watermark for an entity set, with the URIs of the entities modified then."""
+        self._values[entity_set] = modified_on
+        self._uris[entity_set] = frozenset(uris)
+        s3.put_object(
+            self.bucket, key_prefix + entity_set,
+            json.dumps({'modified_on': modified_on, 'uris': sorted(uris)}).encode('utf-8'))
+        logger.info('Saved watermark for %s: %s', entity_set, format_datetime(modified_on))
+
+
+def parse_date(value):
+    """Returns the milliseconds since the epoch of an OData JSON date.
+
+    >>> parse_date('/Date(1462356000000+0060)/')
+    1462356000000
+    """
+    match = _date.match(value or '')
+    return int(match.group(1)) if match else None
+
+
+def format_datetime(milliseconds):
+    """Returns an OData datetime literal for milliseconds since the epoch.
+
+    >>> format_datetime(1462356000123)
+    "datetime'2016-05-04T10:00:00.123'"
+    """
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return "datetime'{}.{:03d}'".format(
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)), milliseconds)
+
+
+def modified_since(milliseconds, expression=None):
+    """Returns a filter for entities modified since a time.
+
+    The time itself is included, as other entities may have been modified
+    in the same millisecond after the watermark was taken.  Any existing
+    filter expression is kept.
+
+    >>> modified_since(1462356000123, "StateCode/Value eq 0")
+    "(StateCode/Value eq 0) and ModifiedOn ge datetime'2016-05-04T10:00:00.123'"
+    """
+    condition = 'ModifiedOn ge {}'.format(format_datetime(milliseconds))
+    return '({}) and {}'.format(expression, condition) if expression else condition